@@ -5,7 +5,7 @@
 #  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
 from __future__ import annotations
 
-from collections import deque
+from collections import deque, OrderedDict
 from enum import Enum, auto
 
 import numpy as np
@@ -16,10 +16,13 @@ from hima.modules.belief.utils import normalize
 from hima.common.smooth_values import SSValue
 from hima.modules.belief.cortial_column.cortical_column import CorticalColumn
 from hima.modules.baselines.srtd import SRTD
-from hima.agents.succesor_representations.striatum import Striatum
+from hima.agents.succesor_representations.striatum import Striatum, RowSparseWeights
+from hima.agents.succesor_representations.planner import BackgroundPlanner
 from hima.modules.baselines.lstm import to_numpy, TLstmLayerHiddenState
-from copy import copy
+from copy import copy, deepcopy
+import os
 import torch
+from hima.common.checkpoint import save_object, load_object
 from hima.modules.belief.utils import EPS
 
 
@@ -67,8 +70,25 @@ class BioHIMA:
             srtd: SRTD | None,
             pattern_memory: Striatum | None,
             use_sf_as_state: bool = False,
+            sf_weights_threshold: float = 0.0,
+            plan_cache_size: int = 128,
+            plan_cache_tolerance: float = 0.0,
+            background_planning: bool = False,
+            background_planning_tolerance: float = 1e-3,
             seed: int | None,
     ):
+        """
+            sf_weights_threshold: SF weights of cells with belief
+                not greater than the threshold aren't updated
+            plan_cache_size: number of SF rollouts kept in LRU cache, 0 disables caching
+            plan_cache_tolerance: beliefs are quantised with this step for cache keys,
+                0 means only identical beliefs share rollouts
+            background_planning: evaluate actions for the next step on a worker thread
+                while the environment steps, using a copy of the agent made at action
+                selection. The result is used if the observed belief is within
+                background_planning_tolerance of the expected one, so it may come
+                from the model before the last learning step.
+        """
         self.observation_reward_lr = observation_reward_lr
         self.max_striatum_lr = striatum_lr
         self.cortical_column = cortical_column
@@ -113,12 +133,26 @@ class BioHIMA:
 
         # TODO move it to Striatum class
         if self.use_sf_as_state:
-            self.striatum_weights = np.zeros((layer_obs_size, layer_obs_size))
+            n_sf_inputs = layer_obs_size
         else:
-            self.striatum_weights = np.zeros((layer_hidden_size, layer_obs_size))
+            n_sf_inputs = layer_hidden_size
+        self.sf_weights = RowSparseWeights(
+            n_sf_inputs, layer_obs_size, row_threshold=sf_weights_threshold
+        )
 
         self.state_snapshot_stack = deque()
 
+        # rollouts are cached until the model changes
+        self.plan_cache_size = plan_cache_size
+        self.plan_cache_tolerance = plan_cache_tolerance
+        self.plan_cache = OrderedDict()
+        self.model_version = 0
+
+        if background_planning:
+            self.planner = BackgroundPlanner(background_planning_tolerance)
+        else:
+            self.planner = None
+
         self.predicted_sf = None
         self.generated_sf = None
         self.action_values = None
@@ -136,6 +170,9 @@ class BioHIMA:
     def reset(self, initial_context_message, initial_external_message):
         assert len(self.state_snapshot_stack) == 0
 
+        if self.planner is not None:
+            self.planner.cancel()
+
         self.predicted_sf = None
         self.generated_sf = None
         self.action_values = None
@@ -148,15 +185,91 @@ class BioHIMA:
         self.previous_state = self.cortical_column.layer.internal_forward_messages.copy()
         self.previous_observation = np.zeros_like(self.observation_rewards)
 
+    def save(self, path):
+        """
+            Save learned state of the agent to the directory: its own state,
+            the striatum and the layer of the cortical column if it supports saving.
+        """
+        save_object(
+            self, path,
+            arrays=('observation_rewards', ),
+            children=('pattern_memory', 'sf_weights'),
+            skip=('cortical_column', 'srtd', 'state_snapshot_stack', 'plan_cache', 'planner')
+        )
+
+        layer = self.cortical_column.layer
+        if hasattr(layer, 'save'):
+            layer.save(os.path.join(path, 'layer'))
+
+    def load(self, path, mmap_mode='c'):
+        """
+            Restore state saved with save into this agent.
+            The cortical column keeps its encoder and decoder, only its layer is replaced.
+        """
+        assert len(self.state_snapshot_stack) == 0
+
+        agent = load_object(type(self), path, mmap_mode=mmap_mode)
+        self.__dict__.update(agent.__dict__)
+        if self.planner is not None:
+            self.planner.cancel()
+        self._invalidate_plan_cache()
+
+        layer_path = os.path.join(path, 'layer')
+        if os.path.isdir(layer_path):
+            self.cortical_column.layer = type(self.cortical_column.layer).load(
+                layer_path, mmap_mode=mmap_mode
+            )
+
     def sample_action(self):
         """Evaluate and sample actions."""
-        self.action_values = self.evaluate_actions(with_planning=True)
+        action_values = None
+        if self.planner is not None:
+            action_values = self.planner.take(self.cortical_column.layer.context_messages)
+
+        if action_values is None:
+            action_values = self.evaluate_actions(with_planning=True)
+
+        self.action_values = action_values
         self.action_dist = self._get_action_selection_distribution(
             self.action_values, on_policy=True
         )
         self.action = self._rng.choice(self.n_actions, p=self.action_dist)
+
+        if self.planner is not None:
+            self.planner.submit(self._make_planning_copy(), self.action)
+
         return self.action
 
+    def _make_planning_copy(self):
+        """
+            Copy of the agent that plans on another thread while the environment steps.
+            Messages and other per-step state are copied, learned parameters are shared,
+            so the agent waits for the planner before it learns.
+            Encoder, decoder and the planner itself aren't needed for planning.
+        """
+        assert len(self.state_snapshot_stack) == 0
+
+        agent = copy(self)
+        agent.planner = None
+        agent.state_snapshot_stack = deque()
+        agent.plan_cache = self.plan_cache.copy()
+        agent._rng = deepcopy(self._rng)
+
+        layer = self.cortical_column.layer
+        agent.cortical_column = copy(self.cortical_column)
+        agent.cortical_column.encoder = None
+        agent.cortical_column.decoder = None
+        if hasattr(layer, 'planning_copy'):
+            agent.cortical_column.layer = layer.planning_copy()
+        else:
+            agent.cortical_column.layer = deepcopy(layer)
+
+        if self.pattern_memory is not None:
+            # prediction without learning only reassigns its attributes
+            agent.pattern_memory = copy(self.pattern_memory)
+
+        return agent
+
     def observe(self, observation, learn=True):
         """
         Main learning routine
@@ -166,6 +279,10 @@ class BioHIMA:
         """
         events, action = observation
 
+        if self.planner is not None and learn:
+            # the planning copy shares learned parameters with the agent
+            self.planner.wait()
+
         if events is not None:
             # predict current events using observed action
             self.cortical_column.observe(events, action, learn=learn)
@@ -177,6 +294,8 @@ class BioHIMA:
         if not learn:
             return
 
+        self._invalidate_plan_cache()
+
         # striatum TD learning
         if self.td_steps > 0:
             self.predicted_sf, self.generated_sf, td_error = self.td_update_sf()
@@ -186,6 +305,7 @@ class BioHIMA:
             self.update_planned_sf()
 
         self.ss_surprise.update(self.cortical_column.surprise)
+        self._invalidate_plan_cache()
 
         return self.predicted_sf, self.generated_sf
 
@@ -194,10 +314,14 @@ class BioHIMA:
         Adapt prior distribution of observations according to external reward.
             reward: float
         """
+        if self.planner is not None:
+            self.planner.wait()
+
         # learn with mse loss
         lr, messages = self.observation_reward_lr, self.observation_messages
 
         self.observation_rewards += lr * messages * (reward - self.observation_rewards)
+        self._invalidate_plan_cache()
 
     def evaluate_actions(self, *, with_planning: bool = False):
         """Evaluate Q[s,a] for each action."""
@@ -209,30 +333,81 @@ class BioHIMA:
 
         estimate_strategy = self._get_action_value_estimate_strategy(with_planning)
 
-        for action in range(n_actions):
-            # hacky way to clean previous one-hot, for 0-th does nothing
-            dense_action[action - 1] = 0
-            # set current one-hot
-            dense_action[action] = 1
-
-            self.cortical_column.predict(
-                context_messages=self.cortical_column.layer.context_messages,
-                external_messages=dense_action
+        cached_plans = None
+        if estimate_strategy == ActionValueEstimate.PLAN and not self.use_cached_plan:
+            plan_keys = [
+                self._plan_cache_key(
+                    'action', action, self.plan_steps, self.approximate_tail,
+                    arrays=(self.cortical_column.layer.context_messages, )
+                )
+                for action in range(n_actions)
+            ]
+            cached_plans = [self._get_cached_plan(key) for key in plan_keys]
+            if any(plan is None for plan in cached_plans):
+                cached_plans = None
+
+        predict = cached_plans is None or estimate_strategy != ActionValueEstimate.PLAN
+        batched_prediction = predict and hasattr(self.cortical_column.layer, 'predict_batch')
+        if batched_prediction:
+            # all actions share the same context, so one-step predictions are made at once
+            batch_prediction_cells, batch_prediction_columns = self.cortical_column.predict_batch(
+                self.cortical_column.layer.context_messages,
+                np.eye(n_actions)
             )
 
+        batched_rollout = (
+            batched_prediction
+            and estimate_strategy == ActionValueEstimate.PLAN
+            and not self.use_cached_plan
+        )
+        if batched_rollout:
+            # plan for all actions together
+            batch_sf, sf_steps = self.generate_sf_batch(
+                self.plan_steps,
+                initial_messages=batch_prediction_cells,
+                initial_prediction=batch_prediction_columns,
+                approximate_tail=self.approximate_tail,
+            )
+            self.sf_steps = sf_steps[-1]
+
+        for action in range(n_actions):
+            if not predict:
+                pass
+            elif batched_prediction:
+                prediction_cells = batch_prediction_cells[action]
+                prediction_columns = batch_prediction_columns[action]
+            else:
+                # hacky way to clean previous one-hot, for 0-th does nothing
+                dense_action[action - 1] = 0
+                # set current one-hot
+                dense_action[action] = 1
+
+                self.cortical_column.predict(
+                    context_messages=self.cortical_column.layer.context_messages,
+                    external_messages=dense_action
+                )
+                prediction_cells = self.cortical_column.layer.prediction_cells
+                prediction_columns = self.cortical_column.layer.prediction_columns
+
             if estimate_strategy == ActionValueEstimate.PLAN:
-                if self.use_cached_plan:
-                    sf = self.predict_sf(self.cortical_column.layer.prediction_cells, area=1)
+                if cached_plans is not None:
+                    sf, self.sf_steps = cached_plans[action]
+                elif batched_rollout:
+                    sf = batch_sf[action]
+                    self._cache_plan(plan_keys[action], (sf, sf_steps[action]))
+                elif self.use_cached_plan:
+                    sf = self.predict_sf(prediction_cells, area=1)
                 else:
                     sf, self.sf_steps = self.generate_sf(
                         self.plan_steps,
-                        initial_messages=self.cortical_column.layer.prediction_cells,
-                        initial_prediction=self.cortical_column.layer.prediction_columns,
+                        initial_messages=prediction_cells,
+                        initial_prediction=prediction_columns,
                         approximate_tail=self.approximate_tail,
                         save_state=False,
                     )
+                    self._cache_plan(plan_keys[action], (sf, self.sf_steps))
             else:
-                sf = self.predict_sf(self.cortical_column.layer.prediction_cells)
+                sf = self.predict_sf(prediction_cells)
 
             # average value predicted by all variables
             action_values[action] = np.sum(
@@ -241,7 +416,7 @@ class BioHIMA:
 
             self._restore_last_snapshot(pop=False)
 
-        self.state_snapshot_stack.pop()
+        self.cortical_column.release_snapshot(self.state_snapshot_stack.pop())
         return action_values
 
     def generate_sf(
@@ -257,6 +432,22 @@ class BioHIMA:
             n_steps: number of prediction steps. If n_steps is 0 and approximate_tail is True,
             then this function is equivalent to predict_sr.
         """
+        plan_key = None
+        if not return_predictions:
+            # the policy is evaluated with the current context of the layer
+            plan_key = self._plan_cache_key(
+                'sf', n_steps, approximate_tail,
+                arrays=(
+                    self.cortical_column.layer.context_messages,
+                    initial_messages,
+                    initial_prediction
+                )
+            )
+            plan = self._get_cached_plan(plan_key)
+            if plan is not None:
+                sr, steps = plan
+                return sr.copy(), steps
+
         predictions = []
 
         if save_state:
@@ -304,11 +495,158 @@ class BioHIMA:
         if save_state:
             self._restore_last_snapshot()
 
+        self._cache_plan(plan_key, (sr.copy(), t+1))
+
         if return_predictions:
             return sr, t+1, predictions
         else:
             return sr, t+1
 
+    def generate_sf_batch(
+            self,
+            n_steps,
+            initial_messages,
+            initial_prediction,
+            approximate_tail=True,
+    ):
+        """
+            Batched version of generate_sf that unrolls all rows of initial_messages
+            together and doesn't change the agent's state. The layer must support predict_batch.
+                initial_messages: (batch_size, internal_cells)
+                initial_prediction: (batch_size, n_obs_states * n_obs_vars)
+            returns sf: (batch_size, n_obs_states * n_obs_vars) and the number of steps
+                made by each row, both equal to what generate_sf returns for the row.
+        """
+        layer = self.cortical_column.layer
+        batch_size = initial_messages.shape[0]
+
+        sr = np.zeros((batch_size, self.observation_messages.size))
+
+        context_messages = np.array(initial_messages)
+        predicted_observation = np.array(initial_prediction)
+        # generate_sf evaluates policy with the context used at the previous step
+        policy_context_messages = np.tile(layer.context_messages, (batch_size, 1))
+
+        discount = np.ones(batch_size)
+        steps = np.zeros(batch_size, dtype=int)
+        running = np.ones(batch_size, dtype=bool)
+
+        for t in range(n_steps):
+            rows = np.flatnonzero(running)
+            early_stop = self._early_stop_planning(predicted_observation[rows])
+
+            sr[rows] += predicted_observation[rows] * discount[rows].reshape((-1, 1))
+
+            if self.sr_estimate_planning == SrEstimatePlanning.UNIFORM:
+                action_dist = normalize(
+                    np.zeros(layer.external_input_size).reshape((layer.n_external_vars, -1))
+                ).flatten()
+                action_dist = np.tile(action_dist, (len(rows), 1))
+            else:
+                # on/off-policy
+                # NB: evaluate actions directly with prediction, not with n-step planning!
+                action_dist = self._get_action_selection_distribution_batch(
+                    policy_context_messages[rows],
+                    on_policy=self.sr_estimate_planning == SrEstimatePlanning.ON_POLICY
+                )
+
+            policy_context_messages[rows] = context_messages[rows]
+
+            context_messages[rows], predicted_observation[rows] = self.cortical_column.predict_batch(
+                context_messages[rows], action_dist
+            )
+
+            discount[rows] *= self.gamma
+            steps[rows] = t + 1
+            running[rows[early_stop]] = False
+
+            if not np.any(running):
+                break
+
+        if approximate_tail:
+            sr += self.predict_sf_batch(context_messages) * discount.reshape((-1, 1))
+
+        return sr, steps
+
+    def _get_action_selection_distribution_batch(self, context_messages, on_policy: bool = True):
+        """Action distribution for each row of context_messages: (batch_size, context_input_size)."""
+        n_actions = self.n_actions
+        batch_size = context_messages.shape[0]
+
+        prediction_cells, _ = self.cortical_column.predict_batch(
+            np.repeat(context_messages, n_actions, axis=0),
+            np.tile(np.eye(n_actions), (batch_size, 1))
+        )
+        sf = self.predict_sf_batch(prediction_cells)
+        action_values = np.sum(
+            sf * self.observation_rewards, axis=-1
+        ).reshape((batch_size, n_actions)) / self.cortical_column.layer.n_obs_vars
+
+        return np.stack([
+            self._get_action_selection_distribution(values, on_policy=on_policy)
+            for values in action_values
+        ])
+
+    def _plan_cache_key(self, *params, arrays):
+        """
+            Key of a rollout in the plan cache or None if it can't be cached.
+            Arrays are quantised with plan_cache_tolerance, which also drops values below it.
+        """
+        if self.plan_cache_size <= 0:
+            return None
+
+        key = [self.model_version, self.sr_estimate_planning, *params]
+        for x in arrays:
+            if not isinstance(x, np.ndarray):
+                return None
+
+            if self.plan_cache_tolerance > 0:
+                x = np.round(x / self.plan_cache_tolerance).astype(np.int64)
+            key.append(x.tobytes())
+
+        return tuple(key)
+
+    def _get_cached_plan(self, key):
+        if key is None:
+            return None
+
+        plan = self.plan_cache.get(key)
+        if plan is not None:
+            self.plan_cache.move_to_end(key)
+        return plan
+
+    def _cache_plan(self, key, plan):
+        if key is None:
+            return
+
+        self.plan_cache[key] = plan
+        self.plan_cache.move_to_end(key)
+        if len(self.plan_cache) > self.plan_cache_size:
+            self.plan_cache.popitem(last=False)
+
+    def _invalidate_plan_cache(self):
+        """Model or rewards changed, so cached rollouts are outdated."""
+        self.model_version += 1
+        self.plan_cache.clear()
+
+    def predict_sf_batch(self, hidden_vars_dist, area=0):
+        """Predict SF for each row of hidden_vars_dist."""
+        if self.srtd is None and self.pattern_memory is None:
+            return self.predict_sf(hidden_vars_dist, area=area)
+        elif self.srtd is None:
+            if self.use_sf_as_state and area == 0:
+                sr = self.pattern_memory.predict_batch(hidden_vars_dist, areas=1)
+                sr = sr.reshape(len(hidden_vars_dist) * self.cortical_column.layer.n_obs_vars, -1)
+                sr = self.sf_weights.predict(
+                    normalize(sr).reshape(len(hidden_vars_dist), -1)
+                )
+                sr /= self.cortical_column.layer.n_obs_vars
+            else:
+                sr = self.pattern_memory.predict_batch(hidden_vars_dist, areas=area)
+            return sr
+
+        return np.stack([self.predict_sf(x, area=area) for x in hidden_vars_dist])
+
     def predict_sf(self, hidden_vars_dist, area=0):
         if self.srtd is not None:
             msg = torch.tensor(hidden_vars_dist).float().to(self.srtd.device)
@@ -317,13 +655,13 @@ class BioHIMA:
             if self.use_sf_as_state and area == 0:
                 sr = self.pattern_memory.predict(hidden_vars_dist, area=1, learn=False)
                 sr = sr.reshape(self.cortical_column.layer.n_obs_vars, -1)
-                sr = np.dot(normalize(sr).flatten(), self.striatum_weights)
+                sr = self.sf_weights.predict(normalize(sr).flatten())
                 sr /= self.cortical_column.layer.n_obs_vars
             else:
                 sr = self.pattern_memory.predict(hidden_vars_dist, area=area, learn=False)
                 sr.reshape(self.cortical_column.layer.n_obs_vars, -1)
         else:
-            sr = np.dot(hidden_vars_dist, self.striatum_weights)
+            sr = self.sf_weights.predict(hidden_vars_dist)
             sr /= self.cortical_column.layer.n_hidden_vars
         return sr
 
@@ -357,10 +695,7 @@ class BioHIMA:
                 error_sr = target_sf - predicted_sf
 
                 # dSR / dW for linear model
-                delta_w = np.outer(prediction_cells, error_sr)
-
-                self.striatum_weights += self.striatum_lr * delta_w
-                self.striatum_weights = np.clip(self.striatum_weights, 0, None)
+                self.sf_weights.update(prediction_cells, error_sr, self.striatum_lr)
 
                 td_error = np.mean(np.power(error_sr, 2))
             else:
@@ -372,10 +707,7 @@ class BioHIMA:
             error_sr = target_sf - predicted_sf
 
             # dSR / dW for linear model
-            delta_w = np.outer(prediction_cells, error_sr)
-
-            self.striatum_weights += self.striatum_lr * delta_w
-            self.striatum_weights = np.clip(self.striatum_weights, 0, None)
+            self.sf_weights.update(prediction_cells, error_sr, self.striatum_lr)
 
             td_error = np.mean(np.power(error_sr, 2))
 
@@ -391,6 +723,11 @@ class BioHIMA:
         self.pattern_memory.predict(self.current_state, area=1, learn=True)
         self.pattern_memory.update_weights(target_sf, area=1)
 
+    @property
+    def striatum_weights(self):
+        """Dense SF weights."""
+        return self.sf_weights.to_dense()
+
     @property
     def current_state(self):
         return self.cortical_column.layer.internal_forward_messages
@@ -449,7 +786,11 @@ class BioHIMA:
         snapshot = self.state_snapshot_stack.pop() if pop else self.state_snapshot_stack[-1]
         self.cortical_column.restore_last_snapshot(snapshot)
 
-    def _early_stop_planning(self, predicted_observation: np.ndarray) -> bool:
+        if pop:
+            self.cortical_column.release_snapshot(snapshot)
+
+    def _early_stop_planning(self, predicted_observation: np.ndarray) -> bool | np.ndarray:
+        """Works both for a single prediction and for a batch of them (along the last axis)."""
         if self.sr_early_stop_uniform is not None:
             uni_dkl = (
                     np.log(self.cortical_column.layer.n_obs_states) +
@@ -458,7 +799,8 @@ class BioHIMA:
                             np.clip(
                                 predicted_observation, EPS, None
                             )
-                        )
+                        ),
+                        axis=-1
                     )
             )
 
@@ -468,7 +810,7 @@ class BioHIMA:
 
         if self.sr_early_stop_goal is not None:
             goal = (
-                np.sum(predicted_observation[self.observation_rewards > 0]) >
+                np.sum(predicted_observation[..., self.observation_rewards > 0], axis=-1) >
                 self.sr_early_stop_goal
             )
         else:
@@ -479,7 +821,7 @@ class BioHIMA:
         else:
             surprise = False
 
-        return uniform or goal or surprise
+        return uniform | goal | surprise
 
     @property
     def striatum_lr(self):
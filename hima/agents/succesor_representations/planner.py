@@ -0,0 +1,101 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+import numpy as np
+
+
+class BackgroundPlanner:
+    def __init__(self, tolerance: float = 1e-3):
+        """
+        Speculatively evaluates actions on a worker thread for the belief
+        expected after the action, while the environment makes the step.
+        The agent's copy may share learned parameters with the agent,
+        so the agent should wait for the planner before learning.
+            tolerance: maximum absolute difference between the expected
+                and the observed context messages to use the result
+        """
+        self.tolerance = tolerance
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Future | None = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, agent, action):
+        """
+            agent: a copy of the agent that isn't used by anyone else,
+                the worker changes its state freely, but not its learned parameters
+            action: action that the agent is going to make
+        """
+        self.cancel()
+        self._future = self._executor.submit(self._plan_ahead, agent, action)
+
+    def wait(self):
+        """Wait until the worker is done with the agent's copy, the result is kept."""
+        if self._future is not None:
+            wait((self._future, ))
+
+    def take(self, context_messages):
+        """
+            Waits for the speculative result.
+                returns action values if they were evaluated for context messages
+                close to the observed ones, otherwise None
+        """
+        if self._future is None:
+            return None
+
+        expected_context_messages, action_values = self._future.result()
+        self._future = None
+
+        if (
+                isinstance(context_messages, np.ndarray)
+                and expected_context_messages.shape == context_messages.shape
+                and np.max(
+                    np.abs(expected_context_messages - context_messages), initial=0
+                ) <= self.tolerance
+        ):
+            self.hits += 1
+            return action_values
+        else:
+            self.misses += 1
+            return None
+
+    def cancel(self):
+        """Drop the result, a running evaluation is finished first."""
+        if self._future is not None:
+            if not self._future.cancel():
+                wait((self._future, ))
+            self._future = None
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _plan_ahead(agent, action):
+        cortical_column = agent.cortical_column
+        layer = cortical_column.layer
+
+        external_messages = None
+        if action is not None and layer.external_input_size > 0:
+            external_messages = np.zeros(layer.external_input_size)
+            external_messages[action] = 1
+
+        cortical_column.predict(layer.context_messages, external_messages)
+
+        # expect the most probable observation
+        prediction = layer.prediction_columns.reshape(layer.n_obs_vars, -1)
+        observation = (
+                np.argmax(prediction, axis=-1) + np.arange(layer.n_obs_vars) * prediction.shape[-1]
+        )
+        layer.observe(observation, learn=False)
+        layer.set_context_messages(layer.internal_forward_messages)
+
+        return layer.context_messages.copy(), agent.evaluate_actions(with_planning=True)
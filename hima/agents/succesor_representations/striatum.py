@@ -4,10 +4,17 @@
 #
 #  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
 import numpy as np
+from itertools import chain
+
+from hima.common.checkpoint import save_object, load_object
+
 EPS = 1e-12
 
 
 class Striatum:
+    # inverted index is used when at most this fraction of cells can be active
+    INDEX_MAX_FRACTION = 0.1
+
     def __init__(
             self,
             input_size,
@@ -40,7 +47,12 @@ class Striatum:
         self.receptive_fields = np.full((max_states, input_size), fill_value=-1)
 
         self.states_in_use_mask = np.full(self.max_states, fill_value=False)
-        self.states_in_use = np.empty(0)
+        self.states_in_use = np.empty(0, dtype=np.int64)
+
+        # inverted index: cell -> states that have the cell in the receptive field
+        self.states_for_cell = dict()
+        # exact receptive field lookup: tuple of cells -> state
+        self.state_for_cells = dict()
 
         self.state_activity = np.zeros(max_states)
         self.weights = np.zeros((n_areas, max_states, output_size))
@@ -50,18 +62,12 @@ class Striatum:
         self.prediction = None
 
     def predict(self, messages: np.ndarray, area: int = 0, learn=True):
-        self.active_states = np.empty(0)
+        self.active_states = np.empty(0, dtype=np.int64)
         self.probs = np.empty(0)
-        self.states_in_use = np.flatnonzero(self.state_activity > 0)
 
         if len(self.states_in_use) > 0:
-            probs = messages[self.receptive_fields[self.states_in_use]]
-
-            probs = np.min(probs, axis=-1)
-            active_states_mask = probs > self.state_detection_threshold
-
-            self.active_states = self.states_in_use[active_states_mask]
-            self.probs = probs[active_states_mask].reshape(-1, 1)
+            self.active_states, probs = self._find_active_states(messages)
+            self.probs = probs.reshape(-1, 1)
 
         if len(self.active_states) == 0 and learn:
             messages = messages.reshape(self.input_size, -1)
@@ -74,7 +80,7 @@ class Striatum:
                 self.state_activity[new_state] = 1
                 self.weights[area, new_state] = np.zeros(self.output_size)
 
-                self.receptive_fields[new_state] = cells
+                self._set_receptive_field(new_state, cells)
 
                 self.active_states = np.array([new_state])
                 self.probs = probs
@@ -86,6 +92,12 @@ class Striatum:
                         1 - self.state_activity[self.active_states]
                 )
 
+                # activity may underflow after a long time without activation
+                exhausted = self.state_activity[self.states_in_use] <= 0
+                if np.any(exhausted):
+                    self.states_in_use_mask[self.states_in_use[exhausted]] = False
+                    self.states_in_use = self.states_in_use[~exhausted]
+
             self.prediction = np.sum(
                 self.weights[area, self.active_states] * self.probs.reshape(-1, 1), axis=0
             )
@@ -94,6 +106,102 @@ class Striatum:
 
         return self.prediction
 
+    def predict_batch(self, messages: np.ndarray, areas=0):
+        """
+            Side-effect free prediction for a batch of messages, equivalent
+            to predict with learn=False for every row.
+                messages: [batch_size, input cells]
+                areas: area or a sequence of areas
+                returns [batch_size, output_size] for a single area,
+                    [batch_size, len(areas), output_size] for a sequence of areas
+        """
+        messages = np.asarray(messages).reshape(len(messages), -1)
+        single_area = np.isscalar(areas)
+        areas = np.atleast_1d(areas)
+
+        states = self.states_in_use
+        if len(states) > 0:
+            probs = np.min(messages[:, self.receptive_fields[states]], axis=-1)
+            probs[probs <= self.state_detection_threshold] = 0
+
+            prediction = np.einsum(
+                'bs,aso->bao', probs, self.weights[areas][:, states]
+            )
+        else:
+            prediction = np.zeros((len(messages), len(areas), self.output_size))
+
+        if single_area:
+            prediction = prediction[:, 0]
+
+        return prediction
+
+    def _find_active_states(self, messages):
+        """
+            States in use with all receptive field cells above the detection threshold.
+                returns sorted states and their activation probabilities
+        """
+        candidate_cells = np.flatnonzero(messages > self.state_detection_threshold)
+
+        if len(candidate_cells) == self.input_size:
+            # near one-hot messages: only the state with exactly these cells
+            # in the receptive field can be active
+            state = self.state_for_cells.get(tuple(candidate_cells.tolist()))
+
+            if state is not None and self.states_in_use_mask[state]:
+                states = np.array([state])
+            else:
+                states = np.empty(0, dtype=np.int64)
+        elif len(candidate_cells) <= self.INDEX_MAX_FRACTION * len(messages):
+            # a state is active if all its input_size cells are candidates
+            states = np.fromiter(
+                chain.from_iterable(
+                    self.states_for_cell.get(cell, ()) for cell in candidate_cells.tolist()
+                ),
+                dtype=np.int64
+            )
+            states = np.flatnonzero(
+                np.bincount(states, minlength=self.max_states) == self.input_size
+            )
+            states = states[self.states_in_use_mask[states]]
+        else:
+            states = self.states_in_use
+            probs = np.min(messages[self.receptive_fields[states]], axis=-1)
+            active_states_mask = probs > self.state_detection_threshold
+            return states[active_states_mask], probs[active_states_mask]
+
+        probs = np.min(messages[self.receptive_fields[states]], axis=-1)
+        return states, probs
+
+    def _set_receptive_field(self, state, cells):
+        old_cells = self.receptive_fields[state].tolist()
+        if old_cells[0] >= 0:
+            # the state is reused, remove it from the index
+            for cell in old_cells:
+                self.states_for_cell[cell].discard(state)
+            if self.state_for_cells.get(tuple(old_cells)) == state:
+                del self.state_for_cells[tuple(old_cells)]
+
+        if not self.states_in_use_mask[state]:
+            self.states_in_use_mask[state] = True
+            self.states_in_use = np.flatnonzero(self.states_in_use_mask)
+
+        self.receptive_fields[state] = cells
+
+        cells = cells.tolist()
+        for cell in cells:
+            self.states_for_cell.setdefault(cell, set()).add(state)
+        self.state_for_cells[tuple(cells)] = state
+
+    def save(self, path):
+        save_object(
+            self, path,
+            arrays=('receptive_fields', 'state_activity', 'weights')
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        return load_object(cls, path, mmap_mode=mmap_mode)
+
     def update_weights(self, target: np.ndarray, area: int = 0):
         error = target - self.prediction
 
@@ -101,4 +209,76 @@ class Striatum:
             self.weights[area, self.active_states] += self.lr * error.reshape(1, -1) * self.probs
             self.weights[area] = np.clip(self.weights[area], 0, None)
 
-        return np.sum(np.power(error, 2))
\ No newline at end of file
+        return np.sum(np.power(error, 2))
+
+
+class RowSparseWeights:
+    MIN_CAPACITY = 64
+
+    def __init__(
+            self,
+            n_rows: int,
+            n_cols: int,
+            row_threshold: float = 0.0
+    ):
+        """
+        Non-negative weights of a linear model that stores only rows
+        that have been updated at least once, the rest are zero.
+            row_threshold: rows with input not greater than the threshold
+                aren't updated
+        """
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.row_threshold = row_threshold
+
+        # row -> slot in data, -1 for zero rows
+        self.slot_for_row = np.full(n_rows, fill_value=-1, dtype=np.int64)
+        # slot -> row
+        self.rows = np.empty(0, dtype=np.int64)
+        self.data = np.zeros((self.MIN_CAPACITY, n_cols))
+
+    def predict(self, x: np.ndarray):
+        """
+            x: [..., n_rows]
+            returns x @ weights: [..., n_cols]
+        """
+        return np.dot(x[..., self.rows], self.data[:len(self.rows)])
+
+    def update(self, x: np.ndarray, error: np.ndarray, lr: float):
+        """Gradient step lr * outer(x, error) followed by clipping at zero."""
+        rows = np.flatnonzero(np.abs(x) > self.row_threshold)
+        slots = self._get_slots(rows)
+
+        data = self.data[slots] + lr * np.outer(x[rows], error)
+        # only updated rows can become negative
+        self.data[slots] = np.clip(data, 0, None)
+
+    def to_dense(self):
+        weights = np.zeros((self.n_rows, self.n_cols))
+        weights[self.rows] = self.data[:len(self.rows)]
+        return weights
+
+    def save(self, path):
+        save_object(self, path, arrays=('slot_for_row', 'rows', 'data'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        return load_object(cls, path, mmap_mode=mmap_mode)
+
+    def _get_slots(self, rows):
+        new_rows = rows[self.slot_for_row[rows] < 0]
+
+        if len(new_rows) > 0:
+            n_slots = len(self.rows) + len(new_rows)
+
+            if n_slots > len(self.data):
+                capacity = max(n_slots, 2 * len(self.data))
+                self.data = np.concatenate([
+                    self.data,
+                    np.zeros((capacity - len(self.data), self.n_cols))
+                ])
+
+            self.slot_for_row[new_rows] = np.arange(len(self.rows), n_slots)
+            self.rows = np.concatenate([self.rows, new_rows])
+
+        return self.slot_for_row[rows]
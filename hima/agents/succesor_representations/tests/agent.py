@@ -0,0 +1,248 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from hima.agents.succesor_representations.agent import BioHIMA
+from hima.agents.succesor_representations.striatum import Striatum
+from hima.common.sdr import sparse_to_dense
+from hima.modules.baselines.hmm import FCHMMLayer
+from hima.modules.belief.cortial_column.cortical_column import CorticalColumn
+from hima.modules.belief.cortial_column.layer import Layer
+
+N_OBS_STATES = 5
+N_ACTIONS = 4
+SEED = 223
+
+
+def make_layer(layer_type):
+    if layer_type == 'dhtm':
+        return Layer(
+            n_obs_vars=1,
+            n_obs_states=N_OBS_STATES,
+            cells_per_column=4,
+            n_hidden_vars_per_obs_var=1,
+            n_context_vars=1,
+            n_context_states=4 * N_OBS_STATES,
+            n_external_vars=1,
+            n_external_states=N_ACTIONS,
+            external_vars_boost=10,
+            cell_activation_threshold=0.0001,
+            cells_activity_lr=0.9,
+            developmental_period=50,
+            context_factors_conf=dict(
+                n_vars_per_factor=2,
+                max_factors_per_var=2,
+                factor_lr=0.1,
+                synapse_lr=0.1,
+                initial_log_factor_value=0,
+                initial_synapse_value=0.5,
+                max_segments=400,
+                segment_activity_lr=0.01,
+                var_score_lr=0.01,
+                fraction_of_segments_to_prune=0.1,
+                max_segments_per_cell=255
+            ),
+            seed=SEED
+        )
+    else:
+        return FCHMMLayer(
+            n_obs_vars=1,
+            n_obs_states=N_OBS_STATES,
+            cells_per_column=3,
+            n_external_states=N_ACTIONS,
+            batch_size=100,
+            em_iterations=10,
+            seed=SEED
+        )
+
+
+class BioHIMATest(unittest.TestCase):
+    def _make_agent(self, layer_type, **kwargs):
+        layer = make_layer(layer_type)
+        striatum = Striatum(
+            layer.n_hidden_vars,
+            layer.input_sdr_size,
+            n_areas=2,
+            state_detection_threshold=0.1,
+            lr=0.9,
+            activity_lr=0.001,
+            seed=SEED
+        )
+        agent = BioHIMA(
+            CorticalColumn(layer, None, None),
+            srtd=None,
+            pattern_memory=striatum,
+            observation_reward_lr=0.1,
+            striatum_lr=0.1,
+            td_steps=1,
+            inverse_temp=10,
+            plan_steps=5,
+            approximate_tail=True,
+            plan_cache_size=0,
+            seed=SEED,
+            **kwargs
+        )
+
+        if layer_type == 'dhtm':
+            self.initial_context = sparse_to_dense(
+                np.arange(layer.n_hidden_vars) * layer.n_hidden_states,
+                like=layer.context_messages
+            )
+            self.initial_external_message = sparse_to_dense([0], size=N_ACTIONS)
+        else:
+            self.initial_context = np.empty(0)
+            self.initial_external_message = np.empty(0)
+
+        return agent
+
+    def _train(self, agent, n_steps):
+        rng = np.random.default_rng(SEED)
+        # a ring of observations, actions move forward or backward
+        position = 0
+        action = -1 if isinstance(agent.cortical_column.layer, FCHMMLayer) else 0
+        agent.reset(self.initial_context, self.initial_external_message)
+
+        for step in range(n_steps):
+            agent.observe((np.array([position % N_OBS_STATES]), action))
+            agent.reinforce(float(position % N_OBS_STATES == 0))
+
+            action = rng.integers(N_ACTIONS)
+            position += 1 if action % 2 == 0 else -1
+
+    def _compare_sf(self, layer_type, sr_estimate_planning):
+        agent = self._make_agent(layer_type, sr_estimate_planning=sr_estimate_planning)
+        self._train(agent, 300)
+
+        layer = agent.cortical_column.layer
+        prediction_cells, prediction_columns = agent.cortical_column.predict_batch(
+            layer.context_messages, np.eye(N_ACTIONS)
+        )
+
+        batch_sf, batch_steps = agent.generate_sf_batch(
+            agent.plan_steps,
+            initial_messages=prediction_cells,
+            initial_prediction=prediction_columns,
+            approximate_tail=agent.approximate_tail
+        )
+
+        for action in range(N_ACTIONS):
+            sf, steps = agent.generate_sf(
+                agent.plan_steps,
+                initial_messages=prediction_cells[action],
+                initial_prediction=prediction_columns[action],
+                approximate_tail=agent.approximate_tail
+            )
+
+            self.assertTrue(np.allclose(batch_sf[action], sf))
+            self.assertEqual(batch_steps[action], steps)
+
+    def _compare_background_planning(self, layer_type):
+        agent = self._make_agent(
+            layer_type, background_planning=True, background_planning_tolerance=0.0
+        )
+        self._train(agent, 300)
+
+        rng = np.random.default_rng(SEED)
+        for step in range(50):
+            action = agent.sample_action()
+
+            layer = agent.cortical_column.layer
+            if step % 2 == 0:
+                # the planner expects the most probable observation
+                _, prediction = agent.cortical_column.predict_batch(
+                    layer.context_messages, np.eye(N_ACTIONS)[action]
+                )
+                observation = np.argmax(prediction[0])
+            else:
+                observation = rng.integers(N_OBS_STATES)
+            agent.observe((np.array([observation]), action), learn=False)
+
+            action_values = agent.planner.take(layer.context_messages)
+            if action_values is not None:
+                self.assertTrue(
+                    np.allclose(action_values, agent.evaluate_actions(with_planning=True))
+                )
+
+        self.assertGreater(agent.planner.hits, 0)
+        agent.planner.close()
+
+    def _check_plan_cache(self, layer_type):
+        agent = self._make_agent(layer_type)
+        agent.plan_cache_size = 16
+        self._train(agent, 300)
+
+        def generate_sf(action):
+            layer = agent.cortical_column.layer
+            prediction_cells, prediction_columns = agent.cortical_column.predict_batch(
+                layer.context_messages, np.eye(N_ACTIONS)[action]
+            )
+            return agent.generate_sf(
+                agent.plan_steps,
+                initial_messages=prediction_cells[0],
+                initial_prediction=prediction_columns[0],
+                approximate_tail=agent.approximate_tail
+            )
+
+        for action in range(N_ACTIONS):
+            generate_sf(action)
+        # actions with the same prediction share a plan
+        self.assertTrue(0 < len(agent.plan_cache) <= N_ACTIONS)
+
+        for action in range(N_ACTIONS):
+            # a hit doesn't roll out the model
+            with mock.patch.object(
+                    agent.cortical_column, 'predict', side_effect=AssertionError
+            ):
+                sf, steps = generate_sf(action)
+
+            agent.plan_cache_size = 0
+            fresh_sf, fresh_steps = generate_sf(action)
+            agent.plan_cache_size = 16
+
+            self.assertTrue(np.allclose(sf, fresh_sf))
+            self.assertEqual(steps, fresh_steps)
+
+        # learning invalidates cached plans
+        model_version = agent.model_version
+        agent.observe((np.array([0]), 0))
+        self.assertGreater(agent.model_version, model_version)
+        self.assertEqual(len(agent.plan_cache), 0)
+
+        generate_sf(0)
+        model_version = agent.model_version
+        agent.reinforce(1.0)
+        self.assertGreater(agent.model_version, model_version)
+        self.assertEqual(len(agent.plan_cache), 0)
+
+        # a plan of the new model is computed again
+        sf, steps = generate_sf(0)
+        agent.plan_cache_size = 0
+        fresh_sf, fresh_steps = generate_sf(0)
+        self.assertTrue(np.allclose(sf, fresh_sf))
+        self.assertEqual(steps, fresh_steps)
+
+    def test_plan_cache(self):
+        for layer_type in ('dhtm', 'fchmm'):
+            with self.subTest(layer_type=layer_type):
+                self._check_plan_cache(layer_type)
+
+    def test_background_planning(self):
+        for layer_type in ('dhtm', 'fchmm'):
+            with self.subTest(layer_type=layer_type):
+                self._compare_background_planning(layer_type)
+
+    def test_generate_sf_batch(self):
+        for layer_type in ('dhtm', 'fchmm'):
+            for sr_estimate_planning in ('uniform', 'on_policy'):
+                with self.subTest(layer_type=layer_type, planning=sr_estimate_planning):
+                    self._compare_sf(layer_type, sr_estimate_planning)
+
+
+if __name__ == '__main__':
+    unittest.main()
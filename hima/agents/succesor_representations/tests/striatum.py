@@ -0,0 +1,76 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from hima.agents.succesor_representations.striatum import RowSparseWeights
+
+
+class RowSparseWeightsTest(unittest.TestCase):
+    n_rows = 200
+    n_cols = 12
+    lr = 0.3
+
+    def _inputs(self, rng):
+        # sparse non-negative inputs as beliefs of the layer
+        x = np.zeros(self.n_rows)
+        rows = rng.choice(self.n_rows, size=rng.integers(1, 10), replace=False)
+        x[rows] = rng.random(len(rows))
+        return x
+
+    def test_dense_equivalence(self):
+        rng = np.random.default_rng(0)
+        weights = RowSparseWeights(self.n_rows, self.n_cols)
+        dense_weights = np.zeros((self.n_rows, self.n_cols))
+
+        for _ in range(500):
+            x = self._inputs(rng)
+            batch = np.stack([self._inputs(rng) for _ in range(3)])
+
+            self.assertTrue(np.allclose(weights.predict(x), np.dot(x, dense_weights)))
+            self.assertTrue(np.allclose(weights.predict(batch), np.dot(batch, dense_weights)))
+
+            target = rng.random(self.n_cols)
+            error = target - np.dot(x, dense_weights)
+
+            weights.update(x, error, self.lr)
+            dense_weights += self.lr * np.outer(x, error)
+            dense_weights = np.clip(dense_weights, 0, None)
+
+        self.assertTrue(np.allclose(weights.to_dense(), dense_weights))
+        # rows that aren't stored are zero
+        zero_rows = np.setdiff1d(np.arange(self.n_rows), weights.rows)
+        self.assertFalse(dense_weights[zero_rows].any())
+
+    def test_row_threshold(self):
+        rng = np.random.default_rng(0)
+        weights = RowSparseWeights(self.n_rows, self.n_cols, row_threshold=0.5)
+
+        x = self._inputs(rng)
+        weights.update(x, rng.random(self.n_cols), self.lr)
+
+        updated = weights.to_dense().any(axis=1)
+        self.assertTrue(np.array_equal(updated, x > 0.5))
+
+    def test_save_load(self):
+        rng = np.random.default_rng(0)
+        weights = RowSparseWeights(self.n_rows, self.n_cols)
+        for _ in range(100):
+            weights.update(self._inputs(rng), rng.random(self.n_cols) - 0.3, self.lr)
+
+        with TemporaryDirectory() as path:
+            weights.save(path)
+            loaded = RowSparseWeights.load(path, mmap_mode=None)
+
+        x = self._inputs(rng)
+        self.assertTrue(np.array_equal(weights.to_dense(), loaded.to_dense()))
+        self.assertTrue(np.array_equal(weights.predict(x), loaded.predict(x)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+from __future__ import annotations
+
+import os
+import pickle
+
+import numpy as np
+
+STATE_FILE = 'state.pkl'
+
+
+def save_object(
+        obj,
+        path: str,
+        arrays: tuple[str, ...] = (),
+        children: tuple[str, ...] = (),
+        skip: tuple[str, ...] = ()
+):
+    """
+        Save object's attributes to the directory.
+            arrays: array attributes stored as raw .npy files, they are memory-mapped on load
+            children: attributes saved to subdirectories with their own save method
+            skip: attributes that aren't saved, the class should restore them on load
+        The rest of the attributes are pickled.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    state = obj.__dict__.copy()
+    for name in skip:
+        state.pop(name, None)
+
+    for name in arrays:
+        np.save(os.path.join(path, f'{name}.npy'), state.pop(name))
+
+    children_types = dict()
+    for name in children:
+        child = state.pop(name)
+        if child is not None:
+            child.save(os.path.join(path, name))
+        children_types[name] = type(child) if child is not None else None
+
+    with open(os.path.join(path, STATE_FILE), 'wb') as file:
+        pickle.dump(
+            dict(state=state, arrays=arrays, children=children_types),
+            file
+        )
+
+
+def load_object(cls, path: str, mmap_mode: str | None = 'c'):
+    """
+        Load object saved with save_object without calling its constructor.
+            mmap_mode: mode of memory-mapping for arrays, see np.load.
+                Default 'c' (copy-on-write) reads arrays lazily
+                and keeps changes in memory only.
+    """
+    with open(os.path.join(path, STATE_FILE), 'rb') as file:
+        data = pickle.load(file)
+
+    obj = cls.__new__(cls)
+    obj.__dict__.update(data['state'])
+
+    for name in data['arrays']:
+        setattr(
+            obj, name,
+            np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        )
+
+    for name, child_type in data['children'].items():
+        if child_type is not None:
+            child = child_type.load(os.path.join(path, name), mmap_mode=mmap_mode)
+        else:
+            child = None
+        setattr(obj, name, child)
+
+    return obj
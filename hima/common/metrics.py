@@ -7,7 +7,13 @@
 import os
 import numpy as np
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from operator import attrgetter
+from time import perf_counter
 from hima.common.lazy_imports import lazy_import
+from hima.common.run.wandb import turn_off_gui_backend_for_matplotlib
 from typing import Dict, Literal, Optional
 from hima.modules.belief.utils import normalize
 from scipy.special import rel_entr
@@ -18,6 +24,256 @@ imageio = lazy_import('imageio')
 minisom = lazy_import('minisom')
 
 
+class AttributeCache:
+    def __init__(self, obj):
+        """
+        Attributes of the object accessed by dotted paths. Accessors are
+        compiled once per path and values are cached until reset, so
+        an expensive property is evaluated at most once per step
+        no matter how many metrics read it.
+        """
+        self.obj = obj
+        self.accessors = dict()
+        self.values = dict()
+
+        # path -> total time spent evaluating it
+        self.timings = dict()
+
+    def get(self, attr):
+        try:
+            return self.values[attr]
+        except KeyError:
+            pass
+
+        accessor = self.accessors.get(attr)
+        if accessor is None:
+            accessor = self.accessors[attr] = attrgetter(attr)
+            self.timings[attr] = 0.0
+
+        start = perf_counter()
+        value = self.values[attr] = accessor(self.obj)
+        self.timings[attr] += perf_counter() - start
+
+        return value
+
+    def reset(self):
+        self.values.clear()
+
+
+class Aggregator:
+    # functions that can be computed without keeping the values
+    STREAMING = {
+        np.sum: np.add,
+        np.mean: np.add,
+        np.max: np.maximum,
+        np.min: np.minimum
+    }
+
+    def __init__(self, func, axis=None):
+        """
+        Incremental equivalent of func(values, axis=axis) for values added
+        one by one. Sum, mean, max and min are reduced on the fly,
+        other functions get the values stacked in an ArrayBuffer.
+            axis: None to reduce all elements of all values, 0 to reduce
+                values elementwise
+        """
+        assert axis in {None, 0}
+        self.func = func
+        self.axis = axis
+        self.combine = self.STREAMING.get(func)
+
+        self.total = None
+        self.count = 0
+        self.buffer = ArrayBuffer() if self.combine is None else None
+
+    def add(self, value):
+        if self.combine is None:
+            self.buffer.append(value)
+            self.count += 1
+            return
+
+        if self.axis is None:
+            value = np.asarray(value)
+            self.count += value.size
+            value = np.sum(value) if self.func is np.mean else self.func(value)
+        else:
+            self.count += 1
+
+        if self.total is None:
+            # copy, the value may change after it's added
+            self.total = value if self.axis is None else np.array(value)
+        else:
+            self.total = self.combine(self.total, value)
+
+    def result(self):
+        if self.combine is None:
+            if self.axis is None:
+                return self.func(self.buffer.values())
+            return self.func(self.buffer.values(), axis=self.axis)
+        elif self.func is np.mean:
+            return self.total / self.count
+        else:
+            return self.total
+
+    def reset(self):
+        self.total = None
+        self.count = 0
+        if self.buffer is not None:
+            self.buffer.clear()
+
+    def __len__(self):
+        return self.count
+
+
+class ArrayBuffer:
+    def __init__(self, capacity: int = 64):
+        """
+        Values of the same shape stacked in a preallocated array,
+        the capacity doubles when it's exhausted.
+        """
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+
+    def append(self, value):
+        value = np.asarray(value)
+
+        if self.data is None:
+            self.data = np.empty((self.capacity, *value.shape), dtype=value.dtype)
+        elif value.shape != self.data.shape[1:]:
+            raise ValueError(
+                f'Value of shape {value.shape} is added to the buffer'
+                f' of shape {self.data.shape[1:]}!'
+            )
+        elif not np.can_cast(value.dtype, self.data.dtype, casting='same_kind'):
+            self.data = self.data.astype(np.result_type(self.data, value))
+
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.empty_like(self.data)])
+
+        self.data[self.size] = value
+        self.size += 1
+
+    def values(self):
+        if self.data is None:
+            return np.empty(0)
+        return self.data[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
+class MetricsRenderer:
+    def __init__(self, n_workers: int = 0, max_pending: int = 16):
+        """
+        Renders figures and videos of metrics and logs them.
+            n_workers: number of worker processes, 0 renders in the calling process
+            max_pending: maximum number of records submitted to workers and not
+                logged yet. When it's reached, submit waits for the oldest record,
+                so rendering can't fall behind the run indefinitely.
+        Records are logged in the order of submission.
+        """
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+
+        if n_workers > 0:
+            # spawn doesn't copy threads and locks of the runner into workers
+            self._executor = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=get_context('spawn'),
+                initializer=turn_off_gui_backend_for_matplotlib
+            )
+        else:
+            self._executor = None
+
+        self._pending = deque()
+
+    def submit(self, logger, log_dict, render, *args):
+        """
+            render(*args) returns images: name -> RGB array
+            and videos: name -> file path, they are added to the log_dict
+            as wandb media before logging. render and its arguments
+            are pickled for workers, so render should be a module-level function.
+        """
+        if self._executor is None:
+            self._log(logger, log_dict, render(*args))
+            return
+
+        while len(self._pending) >= self.max_pending:
+            self._log_oldest()
+
+        self._pending.append(
+            (logger, log_dict, self._executor.submit(render, *args))
+        )
+
+    def poll(self):
+        """Log rendered records without waiting for the rest."""
+        while len(self._pending) > 0 and self._pending[0][-1].done():
+            self._log_oldest()
+
+    def close(self):
+        """Wait for all submitted records and log them."""
+        while len(self._pending) > 0:
+            self._log_oldest()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _log_oldest(self):
+        logger, log_dict, future = self._pending.popleft()
+        self._log(logger, log_dict, future.result())
+
+    @staticmethod
+    def _log(logger, log_dict, media):
+        images, videos = media
+        log_dict.update({name: wandb.Image(image) for name, image in images.items()})
+        log_dict.update({name: wandb.Video(path) for name, path in videos.items()})
+        logger.log(log_dict)
+
+
+def figure_to_array(fig):
+    fig.canvas.draw()
+    return np.array(fig.canvas.buffer_rgba())[..., :3]
+
+
+def render_heatmaps(values, **kwargs):
+    """
+        values: name -> 2d array
+        returns heatmap images
+    """
+    from matplotlib import pyplot as plt
+
+    images = dict()
+    for name, value in values.items():
+        fig = plt.figure()
+        sns.heatmap(value, **kwargs)
+        images[name] = figure_to_array(fig)
+        plt.close(fig)
+
+    return images, dict()
+
+
+def render_gifs(frames, fps):
+    """
+        frames: file path -> (name, [n_frames, height, width] gray 8-bit frames)
+        returns GIF videos
+    """
+    videos = dict()
+    for gif_path, (name, values) in frames.items():
+        # use new v3 API
+        imageio.v3.imwrite(
+            # mode 'L': gray 8-bit ints; duration = 1000 / fps; loop == 0: infinitely
+            gif_path, values, mode='L', duration=1000/fps, loop=0
+        )
+        videos[name] = gif_path
+
+    return dict(), videos
+
+
 class BaseMetric:
     def __init__(self, logger, runner,
                  update_step, log_step, update_period, log_period):
@@ -28,10 +284,18 @@ class BaseMetric:
         self.update_period = update_period
         self.log_period = log_period
 
+        # replaced with the shared cache and renderer in MetricsRack
+        self.attributes = AttributeCache(runner)
+        self.shared_attributes = False
+        self.renderer = MetricsRenderer()
+
         self.last_update_step = None
         self.last_log_step = None
 
     def step(self):
+        if not self.shared_attributes:
+            self.attributes.reset()
+
         update_step = self.get_attr(self.update_step)
         log_step = self.get_attr(self.log_step)
 
@@ -53,26 +317,88 @@ class BaseMetric:
         raise NotImplementedError
 
     def get_attr(self, attr):
-        obj = self.runner
-        for a in attr.split('.'):
-            obj = getattr(obj, a)
-        return obj
+        return self.attributes.get(attr)
 
 
 class MetricsRack:
     metrics: Dict[str, BaseMetric]
 
-    def __init__(self, logger, runner, **kwargs):
+    def __init__(self, logger, runner, render_workers: int = 0, max_pending_renders: int = 16,
+                 **kwargs):
+        """
+            render_workers: number of processes that render figures and videos
+                of metrics, 0 renders them synchronously
+            max_pending_renders: maximum number of records waiting for rendering
+        """
         self.metrics = dict()
+        self.attributes = AttributeCache(runner)
+        self.renderer = MetricsRenderer(render_workers, max_pending_renders)
 
         for name, params in kwargs.items():
             cls = params['class']
             params = params['params']
-            self.metrics[name] = eval(cls)(**params, logger=logger, runner=runner)
+            metric = eval(cls)(**params, logger=logger, runner=runner)
+            metric.attributes = self.attributes
+            metric.shared_attributes = True
+            metric.renderer = self.renderer
+            self.metrics[name] = metric
+
+        # time spent in metrics and between steps of the rack
+        self.timings = {name: 0.0 for name in self.metrics.keys()}
+        self.runner_time = 0.0
+        self.n_steps = 0
+        self.last_step_end = None
 
     def step(self):
-        for name in self.metrics.keys():
-            self.metrics[name].step()
+        start = perf_counter()
+        if self.last_step_end is not None:
+            self.runner_time += start - self.last_step_end
+
+        self.attributes.reset()
+
+        for name, metric in self.metrics.items():
+            metric_start = perf_counter()
+            metric.step()
+            self.timings[name] += perf_counter() - metric_start
+
+        self.renderer.poll()
+
+        self.n_steps += 1
+        self.last_step_end = perf_counter()
+
+    def close(self):
+        self.renderer.close()
+
+    def timing_report(self):
+        """
+            Time spent in each metric and in the runner between steps of the rack.
+            Time of an attribute is counted in the first metric that reads it
+            during a step, so attributes are listed separately.
+        """
+        runner_time = max(self.runner_time, 1e-12)
+        n_steps = max(self.n_steps, 1)
+
+        def row(name, total):
+            return (
+                f'{name:<40} {total:>10.3f} {1e3 * total / n_steps:>10.3f}'
+                f' {100 * total / runner_time:>9.1f}%'
+            )
+
+        lines = [
+            f'{"":<40} {"total, s":>10} {"step, ms":>10} {"of runner":>10}',
+            row('runner', self.runner_time),
+            row('metrics', sum(self.timings.values()))
+        ]
+        lines.extend(
+            row(f'  {name}', total)
+            for name, total in sorted(self.timings.items(), key=lambda x: -x[1])
+        )
+        lines.append('attributes')
+        lines.extend(
+            row(f'  {name}', total)
+            for name, total in sorted(self.attributes.timings.items(), key=lambda x: -x[1])
+        )
+        return '\n'.join(lines)
 
 
 class ScalarMetrics(BaseMetric):
@@ -80,8 +406,6 @@ class ScalarMetrics(BaseMetric):
                  update_step, log_step, update_period, log_period):
         super().__init__(logger, runner, update_step, log_step, update_period, log_period)
 
-        self.metrics = {metric: [] for metric in metrics.keys()}
-
         for metric in metrics.keys():
             self.logger.define_metric(metric, step_metric=self.log_step)
 
@@ -89,6 +413,10 @@ class ScalarMetrics(BaseMetric):
             metric: eval(params['agg']) if type(params['agg']) is str else params['agg']
             for metric, params in metrics.items()
         }
+        self.metrics = {
+            metric: Aggregator(self.agg_func[metric])
+            for metric in metrics.keys()
+        }
         self.att_to_log = {
             metric: params['att']
             for metric, params in metrics.items()
@@ -97,7 +425,7 @@ class ScalarMetrics(BaseMetric):
     def update(self):
         for name in self.metrics.keys():
             value = self.get_attr(self.att_to_log[name])
-            self.metrics[name].append(value)
+            self.metrics[name].add(value)
 
     def log(self, step):
         log_dict = {self.log_step: step}
@@ -106,11 +434,12 @@ class ScalarMetrics(BaseMetric):
         self._reset()
 
     def _reset(self):
-        self.metrics = {metric: [] for metric in self.metrics.keys()}
+        for values in self.metrics.values():
+            values.reset()
 
     def _summarize(self):
         return {
-            key: self.agg_func[key](values)
+            key: values.result()
             for key, values in self.metrics.items()
             if len(values) > 0
         }
@@ -121,11 +450,14 @@ class HeatmapMetrics(BaseMetric):
                  update_step, log_step, update_period, log_period):
         super().__init__(logger, runner, update_step, log_step, update_period, log_period)
         self.logger = logger
-        self.metrics = {metric: [] for metric in metrics.keys()}
         self.agg_func = {
             metric: eval(params['agg']) if type(params['agg']) is str else params['agg']
             for metric, params in metrics.items()
         }
+        self.metrics = {
+            metric: Aggregator(self.agg_func[metric], axis=0)
+            for metric in metrics.keys()
+        }
         self.att_to_log = {
             metric: params['att']
             for metric, params in metrics.items()
@@ -134,28 +466,23 @@ class HeatmapMetrics(BaseMetric):
     def update(self):
         for name in self.metrics.keys():
             value = self.get_attr(self.att_to_log[name])
-            self.metrics[name].append(value)
+            self.metrics[name].add(value)
 
     def log(self, step):
-        from matplotlib import pyplot as plt
         average_metrics = self._summarize()
 
         log_dict = {self.log_step: step}
-        for key, value in average_metrics.items():
-            plt.figure()
-            log_dict[key] = wandb.Image(sns.heatmap(value))
-
-        self.logger.log(log_dict)
-        plt.close('all')
+        self.renderer.submit(self.logger, log_dict, render_heatmaps, average_metrics)
 
         self._reset()
 
     def _reset(self):
-        self.metrics = {metric: [] for metric in self.metrics.keys()}
+        for values in self.metrics.values():
+            values.reset()
 
     def _summarize(self):
         return {
-            key: self.agg_func[key](values, axis=0)
+            key: values.result()
             for key, values in self.metrics.items()
             if len(values) > 0
         }
@@ -167,7 +494,7 @@ class ImageMetrics(BaseMetric):
                  log_fps, log_dir='/tmp'):
         super().__init__(logger, runner, update_step, log_step, update_period, log_period)
 
-        self.metrics = {metric: [] for metric in metrics}
+        self.metrics = {metric: ArrayBuffer() for metric in metrics}
         self.att_to_log = {
             metric: params['att']
             for metric, params in metrics.items()
@@ -183,26 +510,25 @@ class ImageMetrics(BaseMetric):
 
     def log(self, step):
         log_dict = {self.log_step: step}
+        frames = dict()
         for metric, values in self.metrics.items():
+            # copy, buffers are reused after reset
+            values = values.values().copy()
             if len(values) > 1:
                 gif_path = os.path.join(
                     self.log_dir,
                     f'{self.logger.name}_{metric.split("/")[-1]}_{step}.gif'
                 )
-                # use new v3 API
-                imageio.v3.imwrite(
-                    # mode 'L': gray 8-bit ints; duration = 1000 / fps; loop == 0: infinitely
-                    gif_path, values, mode='L', duration=1000/self.log_fps, loop=0
-                )
-                log_dict[metric] = wandb.Video(gif_path)
+                frames[gif_path] = (metric, values)
             elif len(values) == 1:
                 log_dict[metric] = wandb.Image(values[0])
 
-        self.logger.log(log_dict)
+        self.renderer.submit(self.logger, log_dict, render_gifs, frames, self.log_fps)
         self._reset()
 
     def _reset(self):
-        self.metrics = {metric: [] for metric in self.metrics.keys()}
+        for values in self.metrics.values():
+            values.clear()
 
 
 class SRStackSurprise(BaseMetric):
@@ -283,7 +609,7 @@ class PredictionsStackSurprise(BaseMetric):
         self.normalize = normalize
         self.mode = mode
         self.predictions = []
-        self.surprises = [list() for _ in range(self.prediction_steps)]
+        self.surprises = [Aggregator(np.mean) for _ in range(self.prediction_steps)]
 
         self.logger.define_metric(self.name, step_metric=self.log_step)
 
@@ -292,7 +618,9 @@ class PredictionsStackSurprise(BaseMetric):
         predictions = value['predictions']
         events = value['events']
 
-        self.predictions.append(predictions)
+        # remove exhausted lists, copy the new one as it's popped below
+        self.predictions = [x for x in self.predictions if len(x) > 0]
+        self.predictions.append(list(predictions))
 
         # remove empty lists
         predictions = [x for x in self.predictions if len(x) > 0]
@@ -308,12 +636,12 @@ class PredictionsStackSurprise(BaseMetric):
                     mode=self.mode,
                     normalize=self.normalize
                 )
-                self.surprises[s].append(surp)
+                self.surprises[s].add(surp)
 
     def log(self, step):
         self.logger.log(
             {
-                f'{self.name}_step_{s+1}': np.mean(x) for s, x in enumerate(self.surprises)
+                f'{self.name}_step_{s+1}': x.result() for s, x in enumerate(self.surprises)
                 if len(x) > 0
             },
             step=step
@@ -322,7 +650,8 @@ class PredictionsStackSurprise(BaseMetric):
 
     def _reset(self):
         self.predictions = []
-        self.surprises = [list() for t in range(self.prediction_steps)]
+        for x in self.surprises:
+            x.reset()
 
 
 def get_surprise(probs, obs, mode='bernoulli', normalize=True):
@@ -432,7 +761,6 @@ class Histogram(BaseMetric):
             self.counts += counts
 
     def log(self, step):
-        from matplotlib import pyplot as plt
         if self.normalized:
             hist = np.divide(
                         self.hist, self.counts,
@@ -442,14 +770,9 @@ class Histogram(BaseMetric):
         else:
             hist = self.hist
 
-        plt.figure()
-        self.logger.log(
-            {
-                self.name: wandb.Image(sns.heatmap(hist)),
-                self.log_step: step
-            }
+        self.renderer.submit(
+            self.logger, {self.log_step: step}, render_heatmaps, {self.name: hist}
         )
-        plt.close('all')
         self._reset()
 
     def _reset(self):
@@ -463,28 +786,43 @@ class SFDiff(BaseMetric):
             self, name, att, state_att,
             difference_mode: Literal['dkl', 'mse'],
             normalization_mode: Optional[Literal['bernoulli', 'categorical']],
-            base_sf: Literal['uniform', 'load'],
+            base_sf: Literal['uniform', 'load', 'model'],
             base_sf_path: Optional[str],
             logger, runner,
-            update_step, log_step, update_period, log_period
+            update_step, log_step, update_period, log_period,
+            base_sf_gamma: float = 0.99,
+            base_sf_observation_radius: Optional[int] = None,
+            model_att: str = 'environment.model'
     ):
+        """
+            base_sf: 'model' computes true SF of the uniform policy
+                from the environment model, it's recomputed when the model changes
+        """
         super().__init__(logger, runner, update_step, log_step, update_period, log_period)
         self.name = name
         self.att_to_log = att
         self.state_att = state_att
 
+        self.base_sf_mode = base_sf
+        self.base_sf_gamma = base_sf_gamma
+        self.base_sf_observation_radius = base_sf_observation_radius
+        self.model_att = model_att
+        self.base_sf_model = None
+
         if base_sf == 'uniform':
             self.base_sf = None
         elif base_sf == 'load':
             # (n_true_states, sf_size)
             self.base_sf = np.load(base_sf_path)
+        elif base_sf == 'model':
+            self.base_sf = None
         else:
             raise ValueError(f'No such baseline: "{base_sf}"!')
 
         self.difference_mode = difference_mode
         self.normalization_mode = normalization_mode
 
-        self.values = list()
+        self.values = Aggregator(np.mean, axis=0)
 
     def update(self):
         # sf: (n_vars, n_states)
@@ -492,14 +830,24 @@ class SFDiff(BaseMetric):
         sf = self.get_attr(self.att_to_log)
         true_state = self.get_attr(self.state_att)
 
+        if self.base_sf_mode == 'model':
+            model = self.get_attr(self.model_att)
+            if model is not self.base_sf_model:
+                self.base_sf_model = model
+                self.base_sf = model.sf(
+                    model.sr(self.base_sf_gamma),
+                    self.base_sf_observation_radius
+                )
+
         if self.base_sf is None:
             base_sf = np.ones_like(sf)
         else:
             base_sf = self.base_sf[true_state].reshape(sf.shape)
 
+        # values may be shared with other metrics, don't change them inplace
         if self.normalization_mode == 'bernoulli':
-            base_sf /= base_sf.max()
-            sf /= sf.max()
+            base_sf = base_sf / base_sf.max()
+            sf = sf / sf.max()
         elif self.normalization_mode == 'categorical':
             base_sf = normalize(base_sf)
             sf = normalize(sf)
@@ -511,13 +859,13 @@ class SFDiff(BaseMetric):
         else:
             raise ValueError(f'Unknown difference mode: {self.difference_mode}!')
 
-        self.values.append(value)
+        self.values.add(value)
 
     def log(self, step):
         if len(self.values) == 0:
             return
 
-        values = np.array(self.values).mean(axis=0)
+        values = self.values.result()
         average = np.mean(values)
 
         log_dict = {
@@ -532,7 +880,7 @@ class SFDiff(BaseMetric):
             log_dict
         )
 
-        self.values.clear()
+        self.values.reset()
 
 
 class SOMClusters(BaseMetric):
@@ -557,8 +905,8 @@ class SOMClusters(BaseMetric):
         assert self.init in {'random', 'pca'}
         self.seed = seed
 
-        self.patterns = list()
-        self.labels = list()
+        self.patterns = ArrayBuffer()
+        self.labels = ArrayBuffer()
 
     def update(self):
         pattern = self.get_attr(self.att_to_log)
@@ -572,91 +920,95 @@ class SOMClusters(BaseMetric):
         if len(self.patterns) <= 1:
             return
 
-        import matplotlib.pyplot as plt
-
-        self.patterns = np.array(self.patterns)
-        self.labels = np.array(self.labels)
-        classes = np.unique(self.labels)
-        log_dict = dict()
-
-        dim = int(np.sqrt(self.size))
-        som = minisom.MiniSom(
-            dim, dim,
-            self.patterns.shape[-1],
-            sigma=self.sigma,
-            learning_rate=self.learning_rate,
-            random_seed=self.seed,
-            activation_distance=self.dkl
+        self.renderer.submit(
+            self.logger, {self.log_step: step}, render_som_clusters,
+            self.name, self.patterns.values().copy(), self.labels.values().copy(),
+            dict(
+                size=self.size, iterations=self.iterations, sigma=self.sigma,
+                learning_rate=self.learning_rate, seed=self.seed, init=self.init,
+                font_size=self.font_size
+            )
         )
 
-        if self.init == 'random':
-            som.random_weights_init(self.patterns)
-        elif self.init == 'pca':
-            som.pca_weights_init(self.patterns)
-
-        som.train(self.patterns, self.iterations)
-
-        activation_map = np.zeros((dim, dim, classes.size))
-        fig = plt.figure(figsize=(8, 8))
-        plt.imshow(som.distance_map(), cmap='Greys', alpha=0.5)
-        plt.colorbar()
-
-        for p, cls in zip(self.patterns, self.labels):
-            activation_map[:, :, np.flatnonzero(classes == cls)[0]] -= som.activate(p)
-
-            cell = som.winner(p)
-            plt.text(
-                cell[0] - 0.5,
-                cell[1] + 0.5,
-                str(cls),
-                color=plt.cm.rainbow(cls / classes.size),
-                alpha=0.1,
-                fontdict={'weight': 'bold', 'size': self.font_size}
-            )
-        # plt.axis([0, som.get_weights().shape[0], 0, som.get_weights().shape[1]])
+        self.patterns.clear()
+        self.labels.clear()
 
-        log_dict.update(
-            {
-                f'{self.name}_clusters': wandb.Image(fig),
-            }
-        )
-        plt.close('all')
-
-        # normalize activation map
-        activation_map /= self.patterns.shape[0]
-        activation_map /= activation_map.sum(axis=-1).reshape((dim, dim, 1))
-        # generate colormap
-        colors = [plt.cm.rainbow(c / classes.size)[:-1] for c in range(classes.size)]
-        color_map = (np.dot(activation_map.reshape((-1, classes.size)), colors) * 255)
-        color_map = color_map.reshape((dim, dim, 3))
-
-        for i in range(classes.size):
-            log_dict.update(
-                {
-                    f'{self.name}_activation_{classes[i]}': wandb.Image(
-                        sns.heatmap(activation_map[:, :, i], cmap='viridis')
-                    )
-                }
-            )
-            plt.close('all')
+    @staticmethod
+    def dkl(x, W):
+        return np.sum(rel_entr(x, W), axis=-1)
 
-        log_dict.update(
-            {
-                f'{self.name}_soft_clusters': wandb.Image(
-                    plt.imshow(color_map.astype('uint8'))
-                )
-            }
-        )
 
-        log_dict[self.log_step] = step
+def render_som_clusters(name, patterns, labels, params):
+    """
+        Trains a self-organizing map on the patterns
+        and renders clusters of the labels on it.
+            params: parameters of SOMClusters
+    """
+    import matplotlib.pyplot as plt
+
+    classes = np.unique(labels)
+    images = dict()
+
+    dim = int(np.sqrt(params['size']))
+    som = minisom.MiniSom(
+        dim, dim,
+        patterns.shape[-1],
+        sigma=params['sigma'],
+        learning_rate=params['learning_rate'],
+        random_seed=params['seed'],
+        activation_distance=SOMClusters.dkl
+    )
 
-        self.logger.log(log_dict)
+    if params['init'] == 'random':
+        som.random_weights_init(patterns)
+    elif params['init'] == 'pca':
+        som.pca_weights_init(patterns)
+
+    som.train(patterns, params['iterations'])
+
+    activation_map = np.zeros((dim, dim, classes.size))
+    fig = plt.figure(figsize=(8, 8))
+    plt.imshow(som.distance_map(), cmap='Greys', alpha=0.5)
+    plt.colorbar()
+
+    for p, cls in zip(patterns, labels):
+        activation_map[:, :, np.flatnonzero(classes == cls)[0]] -= som.activate(p)
+
+        cell = som.winner(p)
+        plt.text(
+            cell[0] - 0.5,
+            cell[1] + 0.5,
+            str(cls),
+            color=plt.cm.rainbow(cls / classes.size),
+            alpha=0.1,
+            fontdict={'weight': 'bold', 'size': params['font_size']}
+        )
+    # plt.axis([0, som.get_weights().shape[0], 0, som.get_weights().shape[1]])
 
-        self.patterns = list()
-        self.labels = list()
+    images[f'{name}_clusters'] = figure_to_array(fig)
+    plt.close('all')
 
-    @staticmethod
-    def dkl(x, W):
-        return np.sum(rel_entr(x, W), axis=-1)
+    # normalize activation map
+    activation_map /= patterns.shape[0]
+    activation_map /= activation_map.sum(axis=-1).reshape((dim, dim, 1))
+    # generate colormap
+    colors = [plt.cm.rainbow(c / classes.size)[:-1] for c in range(classes.size)]
+    color_map = (np.dot(activation_map.reshape((-1, classes.size)), colors) * 255)
+    color_map = color_map.reshape((dim, dim, 3))
+
+    images.update(
+        render_heatmaps(
+            {
+                f'{name}_activation_{classes[i]}': activation_map[:, :, i]
+                for i in range(classes.size)
+            },
+            cmap='viridis'
+        )[0]
+    )
 
+    fig = plt.figure()
+    plt.imshow(color_map.astype('uint8'))
+    images[f'{name}_soft_clusters'] = figure_to_array(fig)
+    plt.close('all')
 
+    return images, dict()
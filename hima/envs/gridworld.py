@@ -6,8 +6,27 @@
 import numpy as np
 from copy import copy
 
+from hima.common.checkpoint import save_object, load_object
+
+
+class GridWorldModel:
+    # format of the saved tables, bump it when they change,
+    # so models cached by older versions are rebuilt
+    VERSION = 1
+
+    TABLES = (
+        'colors',
+        'rewards',
+        'terminals',
+        'unique_colors',
+        'transition_table',
+        'collision_table',
+        'hint_table',
+        'observation_table',
+        'reward_table',
+        'terminal_table'
+    )
 
-class GridWorld:
     def __init__(
             self,
             room,
@@ -15,21 +34,26 @@ class GridWorld:
             observation_radius=0,
             collision_hint=False,
             collision_reward=0,
-            seed=None,
     ):
-        self._rng = np.random.default_rng(seed)
-
+        """
+            Static tables of a GridWorld room over states r * w + c:
+            transitions and collisions per (state, action), observation windows,
+            rewards and terminals per state.
+        """
         self.colors, self.rewards, self.terminals = (
             room[0, :, :], room[1, :, :], room[2, :, :]
         )
 
         self.h, self.w = self.colors.shape
+        self.n_states = self.h * self.w
+        self.n_actions = 4
 
-        self.return_state = observation_radius < 0
+        self.default_reward = default_reward
         self.observation_radius = observation_radius
         self.collision_hint = collision_hint
         self.collision_reward = collision_reward
 
+        self.return_state = observation_radius < 0
         self.shift = max(self.observation_radius, 1)
 
         self.colors = np.pad(
@@ -44,13 +68,146 @@ class GridWorld:
         if (not self.collision_hint) and (self.observation_radius <= 0):
             self.unique_colors = self.unique_colors[self.unique_colors >= 0]
 
-        self.n_colors = len(self.unique_colors)
-
         if not self.return_state:
             self.observation_shape = (2*self.observation_radius + 1, 2*self.observation_radius + 1)
         else:
             self.observation_shape = (2,)
 
+        r, c = np.divmod(np.arange(self.n_states), self.w)
+
+        # left, right, up, down
+        shifts = np.array([[0, -1], [0, 1], [-1, 0], [1, 0]])
+        next_r = r.reshape(-1, 1) + shifts[:, 0]
+        next_c = c.reshape(-1, 1) + shifts[:, 1]
+
+        # (state, action) -> color of the target cell, negative is inaccessible
+        self.hint_table = self.colors[next_r + self.shift, next_c + self.shift]
+        self.collision_table = self.hint_table < 0
+        self.transition_table = np.where(
+            self.collision_table,
+            np.arange(self.n_states).reshape(-1, 1),
+            next_r * self.w + next_c
+        )
+
+        # state -> flattened observation window
+        if not self.return_state:
+            self.observation_table = self.observation_windows(self.observation_radius)
+        else:
+            self.observation_table = np.empty((self.n_states, 0), dtype=np.int32)
+
+        self.reward_table = self.rewards.flatten() + self.default_reward
+        self.terminal_table = self.terminals.flatten().astype(bool)
+
+    def observation_windows(self, observation_radius):
+        """returns (n_states, (2 * observation_radius + 1) ** 2) colors around every state"""
+        colors = self.colors[self.shift:-self.shift, self.shift:-self.shift]
+        colors = np.pad(
+            colors,
+            observation_radius,
+            mode='constant',
+            constant_values=-1
+        )
+
+        size = 2 * observation_radius + 1
+        window_r, window_c = np.divmod(np.arange(size * size), size)
+        r, c = np.divmod(np.arange(self.n_states), self.w)
+
+        return colors[
+            r.reshape(-1, 1) + window_r,
+            c.reshape(-1, 1) + window_c
+        ]
+
+    def transition_matrix(self, policy=None):
+        """
+            policy: (n_states, n_actions) action probabilities, uniform if None
+            returns (n_states, n_states) state transition probabilities,
+                episodes end in terminal states
+        """
+        if policy is None:
+            policy = np.full((self.n_states, self.n_actions), 1 / self.n_actions)
+
+        transitions = np.zeros((self.n_states, self.n_states))
+        np.add.at(
+            transitions,
+            (np.arange(self.n_states).reshape(-1, 1), self.transition_table),
+            policy
+        )
+        transitions[self.terminal_table] = 0
+        return transitions
+
+    def sr(self, gamma, policy=None):
+        """True successor representation: (I - gamma * P)^-1."""
+        transitions = self.transition_matrix(policy)
+        identity = np.eye(self.n_states)
+        return np.linalg.solve(identity - gamma * transitions, identity)
+
+    def sf(self, sr, observation_radius=None):
+        """
+            Convert SR to successor features of observation windows.
+                sr: (n_states, n_states)
+                returns (n_states, n_features * n_colors), features are window cells
+                    and colors are unique_colors
+        """
+        if observation_radius is None:
+            observation_radius = max(self.observation_radius, 0)
+
+        windows = self.observation_windows(observation_radius)
+        # (n_states, n_features, n_colors)
+        masks = windows[:, :, None] == self.unique_colors
+        sf = np.einsum('ij,jfk->ifk', sr, masks)
+        return sf.reshape(sr.shape[0], -1)
+
+    def save(self, path):
+        save_object(self, path, arrays=self.TABLES)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        return load_object(cls, path, mmap_mode=mmap_mode)
+
+
+class GridWorld:
+    def __init__(
+            self,
+            room=None,
+            default_reward=0,
+            observation_radius=0,
+            collision_hint=False,
+            collision_reward=0,
+            seed=None,
+            model: GridWorldModel = None,
+    ):
+        """
+            model: precomputed tables of the room, if given,
+                the room and its parameters are taken from it
+        """
+        self._rng = np.random.default_rng(seed)
+
+        if model is None:
+            model = GridWorldModel(
+                room,
+                default_reward=default_reward,
+                observation_radius=observation_radius,
+                collision_hint=collision_hint,
+                collision_reward=collision_reward
+            )
+        self.model = model
+
+        self.colors, self.rewards, self.terminals = (
+            model.colors, model.rewards, model.terminals
+        )
+
+        self.h, self.w = model.h, model.w
+
+        self.return_state = model.return_state
+        self.observation_radius = model.observation_radius
+        self.collision_hint = model.collision_hint
+        self.collision_reward = model.collision_reward
+
+        self.shift = model.shift
+        self.unique_colors = model.unique_colors
+        self.n_colors = len(self.unique_colors)
+        self.observation_shape = model.observation_shape
+
         self.start_r = None
         self.start_c = None
         self.r = None
@@ -60,7 +217,7 @@ class GridWorld:
         self.temp_obs = None
         # left, right, up, down
         self.actions = {0, 1, 2, 3}
-        self.default_reward = default_reward
+        self.default_reward = model.default_reward
 
     def reset(self, start_r=None, start_c=None):
         if start_r is None:
@@ -89,12 +246,12 @@ class GridWorld:
             else:
                 obs.append(self._get_obs(self.r, self.c))
 
-        reward = self.rewards[self.r, self.c] + self.default_reward
+        reward = self.model.reward_table[self.r * self.w + self.c]
         if not self.action_success:
             reward += self.collision_reward
 
         obs.append(reward)
-        obs.append(bool(self.terminals[self.r, self.c]))
+        obs.append(bool(self.model.terminal_table[self.r * self.w + self.c]))
 
         return obs
 
@@ -107,35 +264,165 @@ class GridWorld:
             assert self.r is not None
             assert self.c is not None
 
-            prev_r = self.r
-            prev_c = self.c
-
-            if self.action == 0:
-                self.c -= 1
-            elif self.action == 1:
-                self.c += 1
-            elif self.action == 2:
-                self.r -= 1
-            elif self.action == 3:
-                self.r += 1
-
-            # Check whether action is taking to inaccessible states.
-            temp_x = self.colors[self.r+self.shift, self.c+self.shift]
-            if temp_x < 0:
-                self.r = prev_r
-                self.c = prev_c
+            state = self.r * self.w + self.c
 
+            # inaccessible states are precomputed
+            if self.model.collision_table[state, self.action]:
                 if (not self.return_state) and self.collision_hint:
-                    self.temp_obs = np.full(self.observation_shape, fill_value=temp_x)
+                    self.temp_obs = np.full(
+                        self.observation_shape,
+                        fill_value=self.model.hint_table[state, self.action]
+                    )
 
                 self.action_success = False
             else:
+                self.r, self.c = divmod(
+                    int(self.model.transition_table[state, self.action]), self.w
+                )
                 self.action_success = True
 
     def _get_obs(self, r, c):
-        r += self.shift
-        c += self.shift
-        start_r, start_c = r - self.observation_radius, c - self.observation_radius
-        end_r, end_c = r + self.observation_radius + 1, c + self.observation_radius + 1
-        obs = self.colors[start_r:end_r, start_c:end_c]
-        return obs
+        return self.model.observation_table[r * self.w + c].reshape(self.observation_shape)
+
+
+class BatchedGridWorld:
+    def __init__(
+            self,
+            room=None,
+            n_envs=1,
+            default_reward=0,
+            observation_radius=0,
+            collision_hint=False,
+            collision_reward=0,
+            seed=None,
+            model: GridWorldModel = None,
+    ):
+        """
+            Independent copies of GridWorld in the same room stepped together
+            with the precomputed tables of the room model,
+            for n_envs=1 it is equivalent to GridWorld.
+                seed: seed of the first environment, i-th environment gets seed + i,
+                    or a sequence of seeds
+        """
+        self.n_envs = n_envs
+
+        if seed is None or np.isscalar(seed):
+            seeds = [None if seed is None else seed + i for i in range(n_envs)]
+        else:
+            seeds = list(seed)
+            assert len(seeds) == n_envs
+        self._rngs = [np.random.default_rng(s) for s in seeds]
+
+        if model is None:
+            model = GridWorldModel(
+                room,
+                default_reward=default_reward,
+                observation_radius=observation_radius,
+                collision_hint=collision_hint,
+                collision_reward=collision_reward
+            )
+        self.model = model
+
+        self.colors, self.rewards, self.terminals = (
+            model.colors, model.rewards, model.terminals
+        )
+
+        self.h, self.w = model.h, model.w
+
+        self.return_state = model.return_state
+        self.observation_radius = model.observation_radius
+        self.collision_hint = model.collision_hint
+        self.collision_reward = model.collision_reward
+
+        self.shift = model.shift
+        self.unique_colors = model.unique_colors
+        self.n_colors = len(self.unique_colors)
+        self.observation_shape = model.observation_shape
+
+        # left, right, up, down
+        self.actions = {0, 1, 2, 3}
+        self.default_reward = model.default_reward
+
+        self.start_r = np.zeros(n_envs, dtype=np.int64)
+        self.start_c = np.zeros(n_envs, dtype=np.int64)
+        self.r = np.zeros(n_envs, dtype=np.int64)
+        self.c = np.zeros(n_envs, dtype=np.int64)
+        # -1 stands for no action
+        self.action = np.full(n_envs, fill_value=-1, dtype=np.int64)
+        # GridWorld.action_success is None before the first step
+        self.action_success = np.zeros(n_envs, dtype=bool)
+        self.has_temp_obs = np.zeros(n_envs, dtype=bool)
+        self.temp_obs = np.zeros(n_envs, dtype=np.int32)
+
+    def reset(self, start_r=None, start_c=None, envs=None):
+        """
+            envs: indices of environments to reset, all by default
+            start_r, start_c: scalars or arrays for envs, random if None
+        """
+        if envs is None:
+            envs = np.arange(self.n_envs)
+        envs = np.atleast_1d(envs)
+
+        if start_r is None:
+            start_r = [self._rngs[env].integers(self.h) for env in envs]
+        if start_c is None:
+            start_c = [self._rngs[env].integers(self.w) for env in envs]
+
+        self.start_r[envs], self.start_c[envs] = start_r, start_c
+        self.r[envs], self.c[envs] = start_r, start_c
+
+        self.has_temp_obs[envs] = False
+        self.action[envs] = -1
+
+    def obs(self):
+        """
+            returns observations: [n_envs, 2] positions if return_state,
+                [n_envs, n_cells] flattened observation windows otherwise;
+                rewards: [n_envs]; terminals: [n_envs]
+        """
+        states = self.r * self.w + self.c
+
+        if self.return_state:
+            obs = np.stack([self.r, self.c], axis=-1)
+        else:
+            obs = self.model.observation_table[states]
+            obs[self.has_temp_obs] = self.temp_obs[self.has_temp_obs].reshape(-1, 1)
+            self.has_temp_obs[:] = False
+
+        reward = self.model.reward_table[states]
+        reward = reward + np.where(self.action_success, 0, self.collision_reward)
+
+        return obs, reward, self.model.terminal_table[states]
+
+    def act(self, action):
+        """
+            action: [n_envs], environments with None or negative action
+                keep the previous one like GridWorld without act call
+        """
+        action = np.array(
+            [-1 if a is None else a for a in np.atleast_1d(action)], dtype=np.int64
+        )
+        assert np.all(action < len(self.actions))
+
+        mask = action >= 0
+        self.action[mask] = action[mask]
+
+    def step(self):
+        envs = np.flatnonzero(self.action >= 0)
+        if len(envs) == 0:
+            return
+
+        states = self.r[envs] * self.w + self.c[envs]
+        actions = self.action[envs]
+
+        collision = self.model.collision_table[states, actions]
+        self.r[envs], self.c[envs] = np.divmod(
+            self.model.transition_table[states, actions], self.w
+        )
+
+        if (not self.return_state) and self.collision_hint:
+            hinted = envs[collision]
+            self.temp_obs[hinted] = self.model.hint_table[states[collision], actions[collision]]
+            self.has_temp_obs[hinted] = True
+
+        self.action_success[envs] = ~collision
@@ -0,0 +1,201 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import yaml
+
+from hima.envs.gridworld import GridWorld, BatchedGridWorld, GridWorldModel
+
+
+class BatchedGridWorldTest(unittest.TestCase):
+    def setUp(self) -> None:
+        colors = np.array([
+            [0, 1, 1, 2],
+            [0, -2, 1, 2],
+            [3, 3, -1, 0],
+        ])
+        rewards = np.zeros_like(colors)
+        rewards[2, 3] = 1
+        terminals = np.zeros_like(colors)
+        terminals[2, 3] = 1
+
+        self.room = np.stack([colors, rewards, terminals])
+
+    def _compare(self, **kwargs):
+        env = GridWorld(self.room, seed=42, **kwargs)
+        batched_env = BatchedGridWorld(self.room, n_envs=1, seed=42, **kwargs)
+
+        rng = np.random.default_rng(0)
+        for episode in range(10):
+            if episode % 2 == 0:
+                env.reset()
+                batched_env.reset()
+            else:
+                env.reset(1, 2)
+                batched_env.reset(1, 2)
+
+            for _ in range(30):
+                if rng.random() < 0.8:
+                    action = rng.integers(4)
+                    env.act(action)
+                    batched_env.act([action])
+
+                env.step()
+                batched_env.step()
+
+                if rng.random() < 0.7:
+                    obs, reward, terminal = env.obs()
+                    batched_obs, batched_reward, batched_terminal = batched_env.obs()
+
+                    self.assertTrue(np.array_equal(np.array(obs).flatten(), batched_obs[0]))
+                    self.assertEqual(reward, batched_reward[0])
+                    self.assertEqual(terminal, batched_terminal[0])
+
+    def test_equivalence(self):
+        for observation_radius in (-1, 0, 1, 2):
+            for collision_hint in (False, True):
+                self._compare(
+                    observation_radius=observation_radius,
+                    collision_hint=collision_hint,
+                    default_reward=-0.01,
+                    collision_reward=-0.1
+                )
+
+    def test_batch(self):
+        batched_env = BatchedGridWorld(self.room, n_envs=3, observation_radius=1, seed=0)
+        batched_env.reset()
+        batched_env.act([0, 1, 3])
+        batched_env.step()
+
+        obs, reward, terminal = batched_env.obs()
+        self.assertEqual(obs.shape, (3, 9))
+        self.assertEqual(reward.shape, (3, ))
+        self.assertEqual(terminal.shape, (3, ))
+
+
+class GridWorldModelTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.colors = np.array([
+            [0, 1, 1, 2],
+            [0, -2, 1, 2],
+            [3, 3, -1, 0],
+        ])
+        rewards = np.zeros_like(self.colors)
+        rewards[2, 3] = 1
+        self.terminals = np.zeros_like(self.colors)
+        self.terminals[2, 3] = 1
+
+        self.room = np.stack([self.colors, rewards, self.terminals])
+
+    def _loop_sr(self, gamma, n_iterations=2000):
+        """SR of the uniform policy by iterating the Bellman equation."""
+        h, w = self.colors.shape
+        n_states = h * w
+
+        transitions = np.zeros((n_states, n_states))
+        for state in range(n_states):
+            r, c = divmod(state, w)
+            if self.terminals[r, c]:
+                continue
+
+            for dr, dc in ((0, -1), (0, 1), (-1, 0), (1, 0)):
+                next_r, next_c = r + dr, c + dc
+                if not (0 <= next_r < h and 0 <= next_c < w) or self.colors[next_r, next_c] < 0:
+                    next_r, next_c = r, c
+                transitions[state, next_r * w + next_c] += 0.25
+
+        sr = np.eye(n_states)
+        for _ in range(n_iterations):
+            sr = np.eye(n_states) + gamma * transitions @ sr
+        return sr
+
+    @staticmethod
+    def _loop_sf(env, sr, observation_radius):
+        """SR to SF conversion feature by feature, as it was done before the model."""
+        n_features = (2*observation_radius + 1)**2
+        colors = env.unique_colors
+        colors_map = env.colors
+
+        if n_features == 1:
+            colors_map = colors_map[1:-1, 1:-1]
+
+        sfs = list()
+        for feature in range(n_features):
+            row_shift = feature // (2*observation_radius + 1)
+            col_shift = feature % (2*observation_radius + 1)
+            state_to_color = colors_map[
+                row_shift:row_shift+env.h,
+                col_shift:col_shift+env.w
+            ].flatten()
+
+            masks = np.vstack([state_to_color == color for color in colors]).T
+            sfs.append(np.dot(sr, masks))
+
+        return np.hstack(sfs)
+
+    def test_sr_sf(self):
+        gamma = 0.9
+        for observation_radius in (0, 1, 2):
+            env = GridWorld(self.room, observation_radius=observation_radius, seed=0)
+            model = env.model
+
+            sr = model.sr(gamma)
+            self.assertTrue(np.allclose(sr, self._loop_sr(gamma)))
+            self.assertTrue(
+                np.allclose(model.sf(sr), self._loop_sf(env, sr, observation_radius))
+            )
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'room.yaml'), 'w') as file:
+                yaml.dump({'room': self.room.tolist(), 'default_reward': -0.01}, file)
+
+            cache = os.path.join(root, '.cache')
+
+            def make_wrapper():
+                from hima.experiments.successor_representations.runners.envs import (
+                    GridWorldWrapper
+                )
+                return GridWorldWrapper(
+                    {'observation_radius': 1, 'collision_hint': True,
+                     'model_cache': cache, 'seed': 0},
+                    'room'
+                )
+
+            with mock.patch.dict(os.environ, {'GRIDWORLD_ROOT': root}):
+                built = make_wrapper().model
+                self.assertEqual(len(os.listdir(cache)), 1)
+
+                loaded = make_wrapper().model
+                self.assertEqual(len(os.listdir(cache)), 1)
+
+                for name in GridWorldModel.TABLES:
+                    self.assertTrue(
+                        np.array_equal(getattr(built, name), getattr(loaded, name)), name
+                    )
+                self.assertEqual(
+                    {
+                        key: value for key, value in vars(built).items()
+                        if key not in GridWorldModel.TABLES
+                    },
+                    {
+                        key: value for key, value in vars(loaded).items()
+                        if key not in GridWorldModel.TABLES
+                    }
+                )
+
+                # models of another version aren't reused
+                with mock.patch.object(GridWorldModel, 'VERSION', GridWorldModel.VERSION + 1):
+                    make_wrapper()
+                self.assertEqual(len(os.listdir(cache)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
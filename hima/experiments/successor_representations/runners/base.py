@@ -5,6 +5,8 @@
 #  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
 from __future__ import annotations
 
+from copy import deepcopy
+
 import numpy as np
 from hima.common.metrics import MetricsRack
 from hima.common.scenario import Scenario
@@ -71,6 +73,9 @@ class BaseRunner:
             strategies
             setups
             setup_period
+            report_metrics_timing
+            render_workers
+            max_pending_renders
         env:
             ,,,
         agent:
@@ -87,6 +92,7 @@ class BaseRunner:
         self.frame_skip = conf['run'].get('frame_skip', 0)
         self.strategies = conf['run'].get('strategies', None)
         self.observe_actions = conf['run'].get('observe_actions', True)
+        self.report_metrics_timing = conf['run'].get('report_metrics_timing', False)
 
         assert self.frame_skip >= 0
 
@@ -114,6 +120,8 @@ class BaseRunner:
             self.metrics_rack = MetricsRack(
                 self.logger,
                 self,
+                render_workers=conf['run'].get('render_workers', 0),
+                max_pending_renders=conf['run'].get('max_pending_renders', 16),
                 **conf['metrics']
             )
         else:
@@ -179,64 +187,78 @@ class BaseRunner:
             self.prepare_episode()
 
             while not self.end_of_episode:
-                if self.scenario is not None:
-                    self.scenario.check_conditions()
+                self.step()
+        else:
+            self.environment.close()
+
+        if self.metrics_rack is not None:
+            self.metrics_rack.close()
+
+            if self.report_metrics_timing:
+                print(self.metrics_rack.timing_report())
 
-                self.reward = 0
-                self.obs = None
-                for frame in range(self.frame_skip + 1):
-                    self.environment.act(self.action)
-                    self.environment.step()
-                    self.obs, self.reward, self.is_terminal = self.environment.obs()
+    def step(self):
+        if self.scenario is not None:
+            self.scenario.check_conditions()
+
+        self.step_environment()
+        self.step_agent()
 
-                    if self.is_terminal:
+    def step_environment(self):
+        self.reward = 0
+        self.obs = None
+        for frame in range(self.frame_skip + 1):
+            self.environment.act(self.action)
+            self.environment.step()
+            self.obs, self.reward, self.is_terminal = self.environment.obs()
+
+            if self.is_terminal:
+                self.end_of_episode = True
+                break
+
+            if self.action is None:
+                break
+
+    def step_agent(self):
+        # observe events_t and action_{t-1}
+        self.agent.observe(self.obs, self.action)
+        self.agent.reinforce(self.reward)
+
+        if not self.end_of_episode:
+            if self.strategies is not None:
+                if self.steps == 0:
+                    if self.reward_free:
+                        strategy = self._rng.integers(len(self.strategies))
+                    else:
+                        strategy = self.agent.sample_action()
+
+                    self.strategy = self.strategies[strategy]
+
+                if (self.steps % self.action_inertia) == 0:
+                    if self.action_step < len(self.strategy):
+                        self.action = self.strategy[self.action_step]
+                    else:
                         self.end_of_episode = True
-                        break
-
-                    if self.action is None:
-                        break
-
-                # observe events_t and action_{t-1}
-                self.agent.observe(self.obs, self.action)
-                self.agent.reinforce(self.reward)
-
-                if not self.end_of_episode:
-                    if self.strategies is not None:
-                        if self.steps == 0:
-                            if self.reward_free:
-                                strategy = self._rng.integers(len(self.strategies))
-                            else:
-                                strategy = self.agent.sample_action()
-
-                            self.strategy = self.strategies[strategy]
-
-                        if (self.steps % self.action_inertia) == 0:
-                            if self.action_step < len(self.strategy):
-                                self.action = self.strategy[self.action_step]
-                            else:
-                                self.end_of_episode = True
-                            self.action_step += 1
+                    self.action_step += 1
+            else:
+                if (self.steps % self.action_inertia) == 0:
+                    if self.reward_free:
+                        self.action = self._rng.integers(self.environment.n_actions)
                     else:
-                        if (self.steps % self.action_inertia) == 0:
-                            if self.reward_free:
-                                self.action = self._rng.integers(self.environment.n_actions)
-                            else:
-                                self.action = self.agent.sample_action()
+                        self.action = self.agent.sample_action()
 
-                self.steps += 1
+        self.steps += 1
 
-                if self.end_of_episode:
-                    self.episodes += 1
-                    self.setup_episodes += 1
+        if self.end_of_episode:
+            self.episodes += 1
+            self.setup_episodes += 1
 
-                if (self.metrics_rack is not None) and self.logging:
-                    self.metrics_rack.step()
+        if (self.metrics_rack is not None) and self.logging:
+            self.metrics_rack.step()
 
-                if self.visualizer is not None and self.visualizing:
-                    self.visualizer.step()
-                    print(f'step: {self.steps} episode: {self.episodes}')
-        else:
-            self.environment.close()
+        if self.visualizer is not None and self.visualizing:
+            self.visualizer.step()
+            print(f'step: {self.steps} episode: {self.episodes}')
 
     def switch_logging(self):
         self.logging = not self.logging
@@ -271,3 +293,199 @@ class BaseRunner:
             path = path[:-1]
             obj = get_obj(path)
             setattr(obj, att, value)
+
+
+class LogBuffer:
+    """
+        Logger of a runner instance that keeps logs until they are merged with other instances.
+        Other attributes are taken from the wrapped logger.
+    """
+
+    def __init__(self, logger, instance: int = 0):
+        self.logger = logger
+        self.instance = instance
+        # (data, step) pairs
+        self.records = list()
+
+    @property
+    def name(self):
+        # distinct for instances, so files named after the logger don't collide
+        return f'{self.logger.name}_{self.instance}'
+
+    def __getattr__(self, name):
+        if name in ('logger', 'instance', 'records'):
+            # not initialized yet, e.g. during unpickling
+            raise AttributeError(name)
+        return getattr(self.logger, name)
+
+    def log(self, data, step=None, **kwargs):
+        self.records.append((data, step))
+
+    def pop(self):
+        records = self.records
+        self.records = list()
+        return records
+
+
+class BatchedRunner:
+    runner_class: type[BaseRunner]
+
+    def __init__(self, logger, conf):
+        """
+        Steps n_instances independent environment/agent pairs in lockstep.
+        Each instance is a runner of runner_class with its own seed,
+        episodes and scenario. Records that instances log for the same values
+        of step metrics are held until every instance that is still running
+        logged them, then they are merged into one logger call: numeric values
+        are averaged, other values are taken from the first instance.
+
+        By default, environments and agents are stepped one instance after another:
+        agents are independent models, so their predictions can't be batched
+        across instances, and each of them batches its own planning with
+        predict_batch. Subclasses may step environments of all instances at once,
+        e.g. with BatchedGridWorld, by overriding step_environments.
+
+        config_structure:
+        run:
+            n_instances
+            ...  same as runner_class
+        """
+        self.logger = logger
+        self.n_instances = conf['run']['n_instances']
+        seed = conf['run'].get('seed')
+
+        self.log_buffers = list()
+        self.runners = list()
+        for instance in range(self.n_instances):
+            instance_conf = deepcopy(conf)
+            if seed is not None:
+                instance_conf['run']['seed'] = seed + instance
+            if instance > 0:
+                instance_conf['run']['visualize'] = False
+
+            if logger is not None:
+                instance_logger = LogBuffer(logger, instance)
+                self.log_buffers.append(instance_logger)
+            else:
+                instance_logger = None
+
+            self.runners.append(self.runner_class(instance_logger, instance_conf))
+
+        # (wandb step, step metric values) -> instance -> merged records of the instance
+        self.pending_logs = dict()
+        self.step_keys = set()
+        for runner in self.runners:
+            if runner.metrics_rack is not None:
+                self.step_keys.update(
+                    metric.log_step for metric in runner.metrics_rack.metrics.values()
+                )
+        # instances that finished their runs
+        self.finished = set()
+
+    def run(self):
+        for runner in self.runners:
+            runner.episodes = 0
+            runner.setup_episodes = 0
+            # start with a new episode
+            runner.end_of_episode = True
+
+        while True:
+            runners = list()
+            for instance, runner in enumerate(self.runners):
+                if runner.end_of_episode:
+                    if not runner.running:
+                        self._finish(instance)
+                        continue
+                    runner.prepare_episode()
+                runners.append(runner)
+
+            if len(runners) == 0:
+                break
+
+            self.step(runners)
+
+        self.flush_logs(force=True)
+
+        for runner in self.runners:
+            runner.environment.close()
+
+            if runner.report_metrics_timing and runner.metrics_rack is not None:
+                print(runner.metrics_rack.timing_report())
+
+    def step(self, runners: list[BaseRunner]):
+        for runner in runners:
+            if runner.scenario is not None:
+                runner.scenario.check_conditions()
+
+        self.step_environments(runners)
+        self.step_agents(runners)
+        self.flush_logs()
+
+    def step_environments(self, runners: list[BaseRunner]):
+        """Steps environments of instances one by one, override to step them at once."""
+        for runner in runners:
+            runner.step_environment()
+
+    def step_agents(self, runners: list[BaseRunner]):
+        """Steps agents of instances one by one, override to step them at once."""
+        for runner in runners:
+            runner.step_agent()
+
+    def flush_logs(self, force=False):
+        """
+            Log merged records that every running instance has logged.
+                force: log all pending records
+        """
+        for instance, buffer in enumerate(self.log_buffers):
+            for data, step in buffer.pop():
+                key = (
+                    step,
+                    tuple(sorted(
+                        (name, data[name]) for name in self.step_keys if name in data
+                    ))
+                )
+                # records of a period from different metrics are logged together
+                self.pending_logs.setdefault(key, dict()).setdefault(
+                    instance, dict()
+                ).update(data)
+
+        running = set(range(len(self.log_buffers))) - self.finished
+        for key in list(self.pending_logs.keys()):
+            records = self.pending_logs[key]
+            if force or running.issubset(records.keys()):
+                step, _ = key
+                log_dict = self._merge_records(
+                    [records[instance] for instance in sorted(records.keys())]
+                )
+                if step is None:
+                    self.logger.log(log_dict)
+                else:
+                    self.logger.log(log_dict, step=step)
+                del self.pending_logs[key]
+
+    def _finish(self, instance):
+        """Flush logs of the instance, other instances won't wait for it anymore."""
+        if instance in self.finished:
+            return
+
+        metrics_rack = self.runners[instance].metrics_rack
+        if metrics_rack is not None:
+            # pending renders are logged on close
+            metrics_rack.close()
+
+        self.finished.add(instance)
+        self.flush_logs()
+
+    def _merge_records(self, records):
+        log_dict = dict()
+        names = dict.fromkeys(name for record in records for name in record.keys())
+        for name in names:
+            values = [record[name] for record in records if name in record]
+            if name not in self.step_keys and all(
+                    isinstance(value, (int, float, np.number)) for value in values
+            ):
+                log_dict[name] = np.mean(values)
+            else:
+                log_dict[name] = values[0]
+
+        return log_dict
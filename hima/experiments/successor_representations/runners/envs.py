@@ -8,6 +8,8 @@ import os
 import numpy as np
 from hima.common.config.base import read_config
 import io
+import hashlib
+import shutil
 
 
 class PinballWrapper(BaseEnvironment):
@@ -157,6 +159,14 @@ class GridWorldWrapper(BaseEnvironment):
         else:
             self.start_position = (None, None)
 
+        # precomputed room models are cached on disk by a hash of
+        # the setup file, parameters and the model version
+        self.model_cache = conf.pop(
+            'model_cache',
+            os.path.join(os.environ.get('GRIDWORLD_ROOT', ''), '.cache')
+        )
+        self.models = dict()
+
         self.conf = conf
         self.environment = self._start_env(setup)
         self.n_colors = self.environment.n_colors
@@ -174,16 +184,16 @@ class GridWorldWrapper(BaseEnvironment):
             )
         self.actions = tuple(self.environment.actions)
         self.n_actions = len(self.actions)
+        self.obs_offsets = (
+                np.arange(self.n_cells)*self.n_colors - self.min_color
+        ).astype(np.int32)
 
     def obs(self):
         obs, reward, is_terminal = self.environment.obs()
         if self.environment.return_state:
             obs = [obs[1] + obs[0]*self.environment.w]
         else:
-            obs = obs.flatten()
-            obs += (
-                np.arange(self.n_cells)*self.n_colors - self.min_color
-            )
+            obs = obs.flatten() + self.obs_offsets
         return obs, reward, is_terminal
 
     def act(self, action):
@@ -224,20 +234,60 @@ class GridWorldWrapper(BaseEnvironment):
         im = Image.open(buf)
         return im
 
+    @property
+    def model(self):
+        return self.environment.model
+
     def _start_env(self, setup):
         from hima.envs.gridworld import GridWorld
-        config = read_config(
-            self._get_setup_path(setup)
-        )
 
         env = GridWorld(
-                room=np.array(config['room']),
-                default_reward=config['default_reward'],
-                **self.conf
+            model=self._get_model(setup),
+            seed=self.conf.get('seed')
         )
 
         return env
 
+    def _get_model(self, setup):
+        from hima.envs.gridworld import GridWorldModel
+
+        setup_path = self._get_setup_path(setup)
+        params = {key: value for key, value in self.conf.items() if key != 'seed'}
+
+        with open(setup_path, 'rb') as file:
+            key = hashlib.sha1(file.read())
+        key.update(repr(sorted(params.items())).encode())
+        key.update(f'version={GridWorldModel.VERSION}'.encode())
+        key = key.hexdigest()
+
+        if key in self.models:
+            return self.models[key]
+
+        cache_path = None
+        if self.model_cache is not None:
+            cache_path = os.path.join(self.model_cache, key)
+
+        if cache_path is not None and os.path.isdir(cache_path):
+            model = GridWorldModel.load(cache_path)
+        else:
+            config = read_config(setup_path)
+            model = GridWorldModel(
+                room=np.array(config['room']),
+                default_reward=config['default_reward'],
+                **params
+            )
+            if cache_path is not None:
+                # other runs may write the same model concurrently
+                temp_path = f'{cache_path}.{os.getpid()}.tmp'
+                model.save(temp_path)
+                try:
+                    os.replace(temp_path, cache_path)
+                except OSError:
+                    shutil.rmtree(temp_path, ignore_errors=True)
+
+        self.models[key] = model
+        return model
+
     @staticmethod
     def _get_setup_path(setup):
         return os.path.join(
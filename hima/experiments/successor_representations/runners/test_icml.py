@@ -10,7 +10,7 @@ from typing import Union, Any
 import numpy as np
 from hima.common.config.base import read_config, override_config
 from hima.common.run.argparse import parse_arg_list
-from hima.experiments.successor_representations.runners.base import BaseRunner
+from hima.experiments.successor_representations.runners.base import BaseRunner, BatchedRunner
 from hima.experiments.successor_representations.runners.visualizers import DHTMVisualizer
 from hima.modules.belief.utils import normalize
 
@@ -135,12 +135,14 @@ class ICLRunner(BaseRunner):
 
         return values, counts
 
-    def get_true_sr(self, path=None, observation_radius=-1):
+    def get_true_sr(self, path=None, observation_radius=-1, gamma=None):
         """
             Save SR/SF formed by table-sr agent
 
             observation_radius: if greater than -1, converts SR to SF
             for corresponding observation window
+            gamma: if given, SR of the uniform policy is computed
+            from the environment model instead of the agent
 
             Feature indexing for observation radius=1:
 
@@ -148,41 +150,17 @@ class ICLRunner(BaseRunner):
             3 4 5 - center
             6 7 8
         """
-        agent = self.agent
-        env = self.environment.environment
+        model = self.environment.model
 
-        t = agent.sr
-        t = np.mean(t, axis=0)
+        if gamma is not None:
+            t = model.sr(gamma)
+        else:
+            t = self.agent.sr
+            t = np.mean(t, axis=0)
 
         if observation_radius >= 0:
             # convert sr to sf
-            n_features = (2*observation_radius + 1)**2
-            colors = env.unique_colors
-            colors_map = env.colors
-
-            if n_features == 1:
-                colors_map = colors_map[1:-1, 1:-1]
-
-            sfs = list()
-
-            for feature in range(n_features):
-                # form transformation matrix
-                row_shift = feature // (2*observation_radius + 1)
-                col_shift = feature % (2*observation_radius + 1)
-                state_to_color = colors_map[
-                    row_shift:row_shift+env.h,
-                    col_shift:col_shift+env.w
-                ].flatten()
-
-                masks = list()
-                for color in colors:
-                    masks.append(state_to_color == color)
-
-                masks = np.vstack(masks).T
-                # (n_states, colors)
-                sfs.append(np.dot(t, masks))
-
-            t = np.hstack(sfs)
+            t = model.sf(t, observation_radius)
 
         if path is not None:
             np.save(path, t)
@@ -218,6 +196,10 @@ class ICLRunner(BaseRunner):
         return np.mean(self.agent.predicted_sf - self.agent.planned_sf)
 
 
+class BatchedICLRunner(BatchedRunner):
+    runner_class = ICLRunner
+
+
 def main(config_path):
     if len(sys.argv) > 1:
         config_path = sys.argv[1]
@@ -295,7 +277,10 @@ def main(config_path):
     else:
         logger = None
 
-    runner = ICLRunner(logger, config)
+    if config['run'].get('n_instances', 1) > 1:
+        runner = BatchedICLRunner(logger, config)
+    else:
+        runner = ICLRunner(logger, config)
     runner.run()
 
 
@@ -0,0 +1,239 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from hima.experiments.successor_representations.runners.base import (
+    BaseAgent, BaseEnvironment, BaseRunner, BatchedRunner
+)
+
+N_STATES = 4
+EPISODE_LENGTH = 5
+PREDICTION_STEPS = 3
+
+
+class FakeLogger:
+    name = 'fake'
+
+    def __init__(self):
+        self.defined = dict()
+        self.records = list()
+
+    def define_metric(self, name, step_metric=None):
+        self.defined[name] = step_metric
+
+    def log(self, data, step=None):
+        self.records.append((data, step))
+
+
+class RingEnvironment(BaseEnvironment):
+    raw_obs_shape = (1, N_STATES)
+    actions = (-1, 1)
+    n_actions = 2
+
+    def __init__(self):
+        self.state = 0
+        self.steps = 0
+        self.action = 0
+
+    def obs(self):
+        return [self.state], 0, self.steps >= EPISODE_LENGTH
+
+    def act(self, action):
+        self.action = action
+
+    def step(self):
+        self.state = (self.state + self.actions[self.action]) % N_STATES
+        self.steps += 1
+
+    def reset(self):
+        self.state = 0
+        self.steps = 0
+
+    def close(self):
+        pass
+
+
+class ConstantAgent(BaseAgent):
+    initial_action = 0
+
+    def __init__(self, value):
+        # logged value is the same in all steps of an instance
+        self.value = value
+        self.events = []
+
+    def observe(self, events, action):
+        self.events = events
+
+    def reinforce(self, reward):
+        pass
+
+    def sample_action(self):
+        return 1
+
+    def reset(self):
+        self.events = []
+
+    @property
+    def frame(self):
+        frame = np.zeros((1, N_STATES), dtype=np.uint8)
+        frame[0, self.events] = 255
+        return frame
+
+    @property
+    def sr(self):
+        return {'sr': np.full(N_STATES, 1 / N_STATES), 'events': self.events}
+
+    @property
+    def predictions(self):
+        return {
+            'predictions': [np.full(N_STATES, 1 / N_STATES)] * PREDICTION_STEPS,
+            'events': self.events
+        }
+
+
+class ToyRunner(BaseRunner):
+    def __init__(self, logger, conf):
+        super().__init__(logger, conf)
+        # instances with greater seeds stop earlier
+        self.n_episodes = conf['run']['n_episodes'] - self.seed
+        self.logging = True
+
+    @staticmethod
+    def make_environment(env_type, conf, setup):
+        return RingEnvironment()
+
+    @staticmethod
+    def make_agent(agent_type, conf):
+        return ConstantAgent(conf['seed'])
+
+    def step_agent(self):
+        super().step_agent()
+
+        if self.episodes >= self.n_episodes:
+            self.stop_runner()
+
+
+class ToyBatchedRunner(BatchedRunner):
+    runner_class = ToyRunner
+
+    def __init__(self, logger, conf):
+        super().__init__(logger, conf)
+        self.max_pending_logs = 0
+
+    def step(self, runners):
+        super().step(runners)
+        self.max_pending_logs = max(self.max_pending_logs, len(self.pending_logs))
+
+
+class BatchedRunnerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.n_instances = 3
+        self.n_episodes = 6
+
+        steps = dict(
+            update_step='steps', log_step='episodes', update_period=1, log_period=1
+        )
+        self.conf = {
+            'run': {
+                'seed': 0,
+                'n_instances': self.n_instances,
+                'n_episodes': self.n_episodes,
+                'setup': None
+            },
+            'env_type': 'ring',
+            'env': dict(),
+            'agent_type': 'constant',
+            'agent': dict(),
+            'metrics': {
+                'scalar': {
+                    'class': 'ScalarMetrics',
+                    'params': {
+                        'metrics': {'agent/value': {'att': 'agent.value', 'agg': np.mean}},
+                        **steps
+                    }
+                },
+                'frames': {
+                    'class': 'ImageMetrics',
+                    'params': {
+                        'metrics': {'agent/frames': {'att': 'agent.frame'}},
+                        'log_fps': 5,
+                        'log_dir': self.log_dir.name,
+                        **steps
+                    }
+                },
+                'sr_surprise': {
+                    'class': 'SRStackSurprise',
+                    'params': {
+                        'name': 'agent/sr_surprise', 'att': 'agent.sr',
+                        'srs_size': N_STATES, **steps
+                    }
+                },
+                'predictions_surprise': {
+                    'class': 'PredictionsStackSurprise',
+                    'params': {
+                        'name': 'agent/predictions_surprise', 'att': 'agent.predictions',
+                        'prediction_steps': PREDICTION_STEPS, **steps
+                    }
+                }
+            }
+        }
+
+    def tearDown(self) -> None:
+        self.log_dir.cleanup()
+
+    def test_merged_logs(self):
+        logger = FakeLogger()
+        runner = ToyBatchedRunner(logger, self.conf)
+        runner.run()
+
+        self.assertEqual(len(runner.pending_logs), 0)
+        # logs of the stopped instances don't pile up
+        self.assertLessEqual(runner.max_pending_logs, 2)
+
+        self.assertIn('agent/sr_surprise', logger.defined)
+        self.assertIn('agent/predictions_surprise', logger.defined)
+
+        seeds = np.arange(self.n_instances)
+        n_episodes = self.n_episodes - seeds
+        scalar_steps = list()
+        surprise_steps = list()
+        for data, step in logger.records:
+            if step is None:
+                episode = data['episodes']
+                scalar_steps.append(episode)
+
+                # average over instances that reached the episode
+                self.assertAlmostEqual(
+                    data['agent/value'], seeds[n_episodes >= episode].mean()
+                )
+                if episode > 0:
+                    gif_path = data['agent/frames']._path
+                    self.assertTrue(os.path.basename(gif_path).startswith('fake_0_'))
+            else:
+                self.assertIn('agent/sr_surprise_0', data)
+                self.assertIn('agent/predictions_surprise_step_1', data)
+                surprise_steps.append(step)
+
+        # every episode is logged once for all instances
+        self.assertEqual(scalar_steps, list(range(self.n_episodes + 1)))
+        self.assertEqual(surprise_steps, list(range(self.n_episodes + 1)))
+
+        # instances write their own files
+        for instance in range(self.n_instances):
+            self.assertTrue(
+                any(
+                    name.startswith(f'fake_{instance}_')
+                    for name in os.listdir(self.log_dir.name)
+                )
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
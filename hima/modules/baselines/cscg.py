@@ -26,6 +26,7 @@ import numpy as np
 import numba as nb
 from tqdm import trange
 import sys
+import os
 
 
 def validate_seq(x, a, n_clones=None):
@@ -127,15 +128,20 @@ def datagen_structured_obs_room(
 
 
 class CHMM(object):
-    def __init__(self, n_clones, x, a, pseudocount=0.0, dtype=np.float32, seed=42):
+    def __init__(
+            self, n_clones, x, a, pseudocount=0.0, dtype=np.float32, seed=42, verbose=True
+    ):
         """Construct a CHMM objct. n_clones is an array where n_clones[i] is the
         number of clones assigned to observation i. x and a are the observation sequences
-        and action sequences, respectively."""
+        and action sequences, respectively. verbose=False turns off printing
+        and progress bars."""
         self._rng = np.random.default_rng(seed)
         self.n_clones = n_clones
+        self.verbose = verbose
         validate_seq(x, a, self.n_clones)
         assert pseudocount >= 0.0, "The pseudocount should be positive"
-        print("Average number of clones:", n_clones.mean())
+        if verbose:
+            print("Average number of clones:", n_clones.mean())
         self.pseudocount = pseudocount
         self.dtype = dtype
         n_states = self.n_clones.sum()
@@ -229,7 +235,7 @@ class CHMM(object):
         """Run EM training, keeping E deterministic and fixed, learning T"""
         sys.stdout.flush()
         convergence = []
-        pbar = trange(n_iter, position=0)
+        pbar = trange(n_iter, position=0, disable=not self.verbose)
         log2_lik_old = -np.inf
         for it in pbar:
             # E
@@ -254,11 +260,102 @@ class CHMM(object):
             log2_lik_old = log2_lik.mean()
         return convergence
 
+    def learn_em_T_Pi_x_streaming(self, chunks, n_iter=100, lag=100, term_early=True):
+        """Run EM training over a sequence given in chunks, keeping E deterministic
+        and fixed, learning T. chunks() returns an iterable over (x, a) chunks
+        of the sequence, it's called once per iteration. Expected counts are
+        computed by a fixed-lag smoother, so memory doesn't depend on the sequence length.
+        As in learn_em_T_Pi_x, a negative action ends a sequence and the next step
+        starts from Pi_x."""
+        sys.stdout.flush()
+        convergence = []
+        pbar = trange(n_iter, position=0, disable=not self.verbose)
+        log2_lik_old = -np.inf
+        for it in pbar:
+            # E
+            smoother = FixedLagSmoother(
+                self.T, self.Pi_x, self.n_clones, self.C, self.C_Pi_x, lag=lag
+            )
+            for x, a in chunks():
+                smoother.update(x, a)
+            log2_lik = smoother.finish()
+            # M
+            self.update_T()
+            self.update_Pi_x()
+            convergence.append(-log2_lik)
+            pbar.set_postfix(train_bps=convergence[-1])
+            if log2_lik <= log2_lik_old:
+                if term_early:
+                    break
+            log2_lik_old = log2_lik
+        return convergence
+
+    def decode_streaming(self, chunks, path):
+        """Compute the MAP assignment of latent variables for a sequence given in chunks
+        using max-product message passing. chunks() returns an iterable over (x, a) chunks
+        of the sequence, it's called twice. Forward messages, observations and
+        actions are spilled to memory-mapped files in the path directory.
+        As in decode, a negative action ends a sequence and the next step
+        starts from Pi_x."""
+        n_steps, n_messages = 0, 0
+        for x, a in chunks():
+            validate_seq(x, a, self.n_clones)
+            n_steps += len(x)
+            n_messages += self.n_clones[x].sum()
+
+        os.makedirs(path, exist_ok=True)
+
+        def open_buffer(name, dtype, size):
+            return np.lib.format.open_memmap(
+                os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=(size,)
+            )
+
+        x_all = open_buffer('x', np.int64, n_steps)
+        a_all = open_buffer('a', np.int64, n_steps)
+        log2_lik = open_buffer('log2_lik', self.T.dtype, n_steps)
+        mess_fwd = open_buffer('mess_fwd', self.T.dtype, n_messages)
+
+        T_tr = self.T.transpose(0, 2, 1)
+        state_loc = np.hstack(([0], self.n_clones)).cumsum()
+        t, m, message = 0, 0, None
+        for x, a in chunks():
+            if message is None:
+                j_start, j_stop = state_loc[x[0]: x[0] + 2]
+                message = self.Pi_x[j_start:j_stop].astype(self.T.dtype)
+                p_obs = message.max()
+                assert p_obs > 0
+                message /= p_obs
+                log2_lik[0] = np.log2(p_obs)
+                x_all[0], a_all[0] = x[0], a[0]
+                mess_fwd[:len(message)] = message
+                t, m = 1, len(message)
+                x, a = x[1:], a[1:]
+                if len(x) == 0:
+                    continue
+
+            chunk_log2_lik, chunk_mess_fwd = forward_window(
+                T_tr, self.Pi_x, self.n_clones,
+                np.hstack((x_all[t - 1: t], x)), np.hstack((a_all[t - 1: t], a)),
+                message, True
+            )
+            chunk_mess_fwd = chunk_mess_fwd[len(message):]
+
+            x_all[t: t + len(x)], a_all[t: t + len(x)] = x, a
+            log2_lik[t: t + len(x)] = chunk_log2_lik
+            mess_fwd[m: m + len(chunk_mess_fwd)] = chunk_mess_fwd
+            message = chunk_mess_fwd[-self.n_clones[x[-1]]:]
+            t, m = t + len(x), m + len(chunk_mess_fwd)
+
+        states = backtrace(
+            self.T, self.n_clones, np.asarray(x_all), np.asarray(a_all), np.asarray(mess_fwd)
+        )
+        return -log2_lik, states
+
     def learn_viterbi_T(self, x, a, n_iter=100):
         """Run Viterbi training, keeping E deterministic and fixed, learning T"""
         sys.stdout.flush()
         convergence = []
-        pbar = trange(n_iter, position=0)
+        pbar = trange(n_iter, position=0, disable=not self.verbose)
         log2_lik_old = -np.inf
         for it in pbar:
             # E
@@ -278,7 +375,8 @@ class CHMM(object):
                     states[t - 1],
                     states[t],
                 )  # at time t-1 -> t we go from observation i to observation j
-                self.C[aij, i, j] += 1.0
+                if aij >= 0:
+                    self.C[aij, i, j] += 1.0
             # M
             self.update_T()
 
@@ -296,7 +394,7 @@ class CHMM(object):
         CE = np.ones((n_states, n_emissions), self.dtype)
         E = self.update_E(CE + pseudocount_extra)
         convergence = []
-        pbar = trange(n_iter, position=0)
+        pbar = trange(n_iter, position=0, disable=not self.verbose)
         log2_lik_old = -np.inf
         for it in pbar:
             # E
@@ -375,6 +473,362 @@ class CHMM(object):
         return s_a
 
 
+class BlockSparseCHMM(object):
+    def __init__(
+            self, n_clones, x, a, pseudocount=0.0, dtype=np.float32, seed=42, n_actions=None,
+            verbose=True
+    ):
+        """CHMM that stores only blocks of clone transitions (action, obs_i, obs_j)
+        which occur in the sequence x, a. Counts of the other transitions are zero,
+        so their probabilities are pseudocount / norm of the row. Memory and time of EM
+        scale with the number of observed blocks instead of n_states ** 2."""
+        self._rng = np.random.default_rng(seed)
+        self.n_clones = n_clones
+        self.verbose = verbose
+        validate_seq(x, a, self.n_clones)
+        assert pseudocount >= 0.0, "The pseudocount should be positive"
+        self.pseudocount = pseudocount
+        self.dtype = dtype
+        self.n_states = self.n_clones.sum()
+        self.n_actions = a.max() + 1 if n_actions is None else n_actions
+        self.state_loc = np.hstack(([0], self.n_clones)).cumsum()
+
+        self.index, self.loc, self.blocks = make_clone_blocks(
+            self.n_clones, x, a, self.n_actions
+        )
+        # entries of the blocks in the dense (n_actions, n_states, n_states) matrix
+        self.entries = get_block_entries(self.n_clones, self.loc, self.blocks, self.n_states)
+        self.rows = self.entries // self.n_states
+
+        self.C = self._rng.random(self.loc[-1]).astype(dtype)
+        self.C_Pi_x = self._rng.random(self.n_states).astype(dtype)
+        self.Pi_x = np.ones(self.n_states) / self.n_states
+        self.Pi_a = np.ones(self.n_actions) / self.n_actions
+        self.update_T()
+
+    def update_T(self):
+        """Update transitions of the blocks and the rest of the rows
+        given the accumulated counts."""
+        norm = np.bincount(
+            self.rows, weights=self.C, minlength=self.n_actions * self.n_states
+        ) + self.pseudocount * self.n_states
+        norm[norm == 0] = 1
+        self.T = ((self.C + self.pseudocount) / norm[self.rows]).astype(self.dtype)
+        # probability of transitions outside of the blocks
+        self.T_default = (self.pseudocount / norm).reshape(self.n_actions, self.n_states)
+
+    def update_Pi_x(self):
+        self.Pi_x = self.C_Pi_x + self.pseudocount
+        norm = self.C_Pi_x.sum()
+        if norm > 0:
+            self.Pi_x /= norm
+
+    def set_T(self, T):
+        """Set blocks from the dense (n_actions, n_states, n_states) transition matrix."""
+        self.T = T.reshape(-1)[self.entries].astype(self.dtype)
+
+    def to_dense(self):
+        """Dense (n_actions, n_states, n_states) transition matrix."""
+        T = np.repeat(self.T_default[:, :, None], self.n_states, axis=2).astype(self.dtype)
+        T.reshape(-1)[self.entries] = self.T
+        return T
+
+    def bps(self, x, a):
+        """Compute the log likelihood (log base 2) of a sequence of observations and actions.
+        Transitions of the sequence should be in the blocks."""
+        validate_seq(x, a, self.n_clones)
+        log2_lik = forward_blocks(
+            self.T, self.index, self.loc, self.Pi_x, self.n_clones, x, a
+        )[0]
+        return -log2_lik
+
+    def e_step(self, x, a):
+        """Replace counts C, C_Pi_x with the expected counts of the sequence.
+        Returns log likelihood (log base 2) of the sequence."""
+        log2_lik, mess_fwd = forward_blocks(
+            self.T,
+            self.index,
+            self.loc,
+            self.Pi_x,
+            self.n_clones,
+            x,
+            a,
+            store_messages=True,
+        )
+        mess_bwd = backward_blocks(self.T, self.index, self.loc, self.n_clones, x, a)
+        updateC_Pi_x_blocks(
+            self.C_Pi_x, self.C, self.T, self.index, self.loc, self.n_clones,
+            mess_fwd, mess_bwd, x, a
+        )
+        return log2_lik
+
+    def learn_em_T_Pi_x(self, x, a, n_iter=100, term_early=True):
+        """Run EM training, keeping E deterministic and fixed, learning T.
+        Transitions of the sequence should be in the blocks."""
+        sys.stdout.flush()
+        convergence = []
+        pbar = trange(n_iter, position=0, disable=not self.verbose)
+        log2_lik_old = -np.inf
+        for it in pbar:
+            # E
+            log2_lik = self.e_step(x, a)
+            # M
+            self.update_T()
+            self.update_Pi_x()
+            convergence.append(-log2_lik.mean())
+            pbar.set_postfix(train_bps=convergence[-1])
+            if log2_lik.mean() <= log2_lik_old:
+                if term_early:
+                    break
+            log2_lik_old = log2_lik.mean()
+        return convergence
+
+
+def make_clone_blocks(n_clones, x, a, n_actions):
+    """Blocks of clone transitions (action, obs_i, obs_j) occurring in the sequence.
+    Returns index of the block for each (action, obs_i, obs_j) or -1,
+    offsets of the blocks in the flat storage and (action, obs_i, obs_j) of the blocks."""
+    n_emissions = len(n_clones)
+    valid = a[:-1] >= 0
+    blocks = np.unique(
+        np.stack([a[:-1][valid], x[:-1][valid], x[1:][valid]], axis=1), axis=0
+    ).reshape(-1, 3)
+
+    index = np.full((n_actions, n_emissions, n_emissions), -1, dtype=np.int64)
+    index[blocks[:, 0], blocks[:, 1], blocks[:, 2]] = np.arange(len(blocks))
+
+    sizes = n_clones[blocks[:, 1]] * n_clones[blocks[:, 2]]
+    loc = np.hstack(([0], sizes)).cumsum()
+    return index, loc, blocks
+
+
+def get_block_entries(n_clones, loc, blocks, n_states):
+    """Index in the flattened dense (n_actions, n_states, n_states) matrix
+    of each entry of the flat block storage."""
+    state_loc = np.hstack(([0], n_clones)).cumsum()
+    entries = np.empty(loc[-1], dtype=np.int64)
+    for b, (aij, i, j) in enumerate(blocks):
+        rows = aij * n_states + np.arange(state_loc[i], state_loc[i + 1])
+        cols = np.arange(state_loc[j], state_loc[j + 1])
+        entries[loc[b]: loc[b + 1]] = (rows.reshape(-1, 1) * n_states + cols).flatten()
+    return entries
+
+
+@nb.njit
+def get_block(T, index, loc, n_clones, aij, i, j):
+    b = index[aij, i, j]
+    assert b >= 0, "Transition is out of the blocks"
+    return T[loc[b]: loc[b + 1]].reshape(n_clones[i], n_clones[j])
+
+
+@nb.njit
+def updateC_Pi_x_blocks(C_Pi_x, C, T, index, loc, n_clones, mess_fwd, mess_bwd, x, a):
+    mess_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones[x])).cumsum()
+    state_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones)).cumsum()
+    timesteps = len(x)
+    C[:] = 0
+    C_Pi_x[:] = 0
+    first = True
+    for t in range(1, timesteps):
+        aij, i, j = (
+            a[t - 1],
+            x[t - 1],
+            x[t],
+        )  # at time t-1 -> t we go from observation i to observation j
+
+        if aij >= 0:
+            (tm1_start, tm1_stop), (t_start, t_stop) = (
+                mess_loc[t - 1: t + 1],
+                mess_loc[t: t + 2],
+            )
+            q = (
+                mess_fwd[tm1_start:tm1_stop].reshape(-1, 1)
+                * get_block(T, index, loc, n_clones, aij, i, j)
+                * mess_bwd[t_start:t_stop].reshape(1, -1)
+            )
+            q /= q.sum()
+            b = index[aij, i, j]
+            C[loc[b]: loc[b + 1]] += q.flatten()
+            if first:
+                i_start, i_stop = state_loc[i: i + 2]
+                C_Pi_x[i_start:i_stop] += (
+                        mess_fwd[tm1_start:tm1_stop] *
+                        mess_bwd[tm1_start:tm1_stop]
+                )
+                first = False
+        else:
+            first = True
+
+
+@nb.njit
+def forward_blocks(T, index, loc, Pi, n_clones, x, a, store_messages=False):
+    """Log-probability of a sequence, and optionally, messages"""
+    state_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones)).cumsum()
+    dtype = T.dtype.type
+
+    # forward pass
+    t, log2_lik = 0, np.zeros(len(x), dtype)
+    j = x[t]
+    j_start, j_stop = state_loc[j: j + 2]
+
+    message = Pi[j_start:j_stop].copy().astype(dtype)
+    p_obs = message.sum()
+    assert p_obs > 0
+    message /= p_obs
+    log2_lik[0] = np.log2(p_obs)
+    if store_messages:
+        mess_loc = np.hstack(
+            (np.array([0], dtype=n_clones.dtype), n_clones[x])
+        ).cumsum()
+        mess_fwd = np.empty(mess_loc[-1], dtype=dtype)
+        t_start, t_stop = mess_loc[t: t + 2]
+        mess_fwd[t_start:t_stop] = message
+    else:
+        mess_fwd = None
+
+    for t in range(1, x.shape[0]):
+        aij, i, j = (
+            a[t - 1],
+            x[t - 1],
+            x[t],
+        )  # at time t-1 -> t we go from observation i to observation j
+        (j_start, j_stop) = state_loc[j: j + 2]
+
+        if aij >= 0:
+            message = np.dot(message, get_block(T, index, loc, n_clones, aij, i, j))
+        else:
+            message = Pi[j_start:j_stop].copy().astype(dtype)
+
+        p_obs = message.sum()
+        assert p_obs > 0
+        message /= p_obs
+        log2_lik[t] = np.log2(p_obs)
+        if store_messages:
+            t_start, t_stop = mess_loc[t: t + 2]
+            mess_fwd[t_start:t_stop] = message
+    return log2_lik, mess_fwd
+
+
+@nb.njit
+def backward_blocks(T, index, loc, n_clones, x, a):
+    """Compute backward messages."""
+    dtype = T.dtype.type
+
+    # backward pass
+    t = x.shape[0] - 1
+    i = x[t]
+    message = np.ones(n_clones[i], dtype) / n_clones[i]
+    message /= message.sum()
+    mess_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones[x])).cumsum()
+    mess_bwd = np.empty(mess_loc[-1], dtype)
+    t_start, t_stop = mess_loc[t: t + 2]
+    mess_bwd[t_start:t_stop] = message
+    for t in range(x.shape[0] - 2, -1, -1):
+        aij, i, j = (
+            a[t],
+            x[t],
+            x[t + 1],
+        )  # at time t -> t+1 we go from observation i to observation j
+
+        if aij >= 0:
+            message = np.dot(get_block(T, index, loc, n_clones, aij, i, j), message)
+        else:
+            message = np.ones(n_clones[i], dtype) / n_clones[i]
+
+        p_obs = message.sum()
+        assert p_obs > 0
+        message /= p_obs
+        t_start, t_stop = mess_loc[t: t + 2]
+        mess_bwd[t_start:t_stop] = message
+    return mess_bwd
+
+
+class FixedLagSmoother(object):
+    def __init__(self, T, Pi, n_clones, C, C_Pi_x, lag=100):
+        """Streaming forward-backward smoothing of a sequence fed in chunks.
+        Expected counts are accumulated into C and C_Pi_x, they are zeroed first.
+        Backward messages of a step are computed from at least lag next steps,
+        the rest of the sequence is ignored, so memory is O(lag + chunk size).
+        With lag not less than the sequence length counts are exact."""
+        self.T = T
+        self.T_tr = T.transpose(0, 2, 1)
+        self.Pi = Pi
+        self.n_clones = n_clones
+        self.state_loc = np.hstack(([0], n_clones)).cumsum()
+        self.C = C
+        self.C_Pi_x = C_Pi_x
+        self.lag = lag
+        self.dtype = T.dtype
+
+        C[:] = 0
+        C_Pi_x[:] = 0
+
+        # steps that aren't smoothed yet, the first one is the last smoothed step
+        self.x = np.empty(0, dtype=np.int64)
+        self.a = np.empty(0, dtype=np.int64)
+        self.mess_fwd = np.empty(0, dtype=self.dtype)
+        # whether self.x[0] starts a sequence
+        self.first = True
+
+        self.log2_lik = 0.0
+        self.n_steps = 0
+
+    def update(self, x, a):
+        """Add the next chunk of the sequence."""
+        validate_seq(x, a, self.n_clones)
+
+        if len(self.x) == 0:
+            j_start, j_stop = self.state_loc[x[0]: x[0] + 2]
+            message = self.Pi[j_start:j_stop].astype(self.dtype)
+            p_obs = message.sum()
+            assert p_obs > 0
+            message /= p_obs
+            self.log2_lik += np.log2(p_obs)
+            self.n_steps += 1
+
+            self.x, self.a, self.mess_fwd = x[:1], a[:1], message
+            x, a = x[1:], a[1:]
+            if len(x) == 0:
+                return
+
+        message = self.mess_fwd[-self.n_clones[self.x[-1]]:]
+        log2_lik, mess_fwd = forward_window(
+            self.T_tr, self.Pi, self.n_clones,
+            np.hstack((self.x[-1:], x)), np.hstack((self.a[-1:], a)),
+            message, False
+        )
+        self.log2_lik += log2_lik.sum()
+        self.n_steps += len(log2_lik)
+
+        self.x = np.hstack((self.x, x))
+        self.a = np.hstack((self.a, a))
+        self.mess_fwd = np.hstack((self.mess_fwd, mess_fwd[len(message):]))
+
+        if len(self.x) > self.lag + 1:
+            self._smooth(len(self.x) - self.lag)
+
+    def finish(self):
+        """Smooth the rest of the sequence.
+        Returns mean log likelihood (log base 2) per step."""
+        if len(self.x) > 0:
+            self._smooth(len(self.x))
+        return self.log2_lik / max(self.n_steps, 1)
+
+    def _smooth(self, n_steps):
+        """Add counts of transitions into steps 1..n_steps - 1 of the window."""
+        mess_bwd = backward(self.T, self.n_clones, self.x, self.a)
+        self.first = accumulateC_Pi_x(
+            self.C_Pi_x, self.C, self.T, self.n_clones,
+            self.mess_fwd, mess_bwd, self.x, self.a, n_steps, self.first
+        )
+
+        # keep the last smoothed step
+        start = n_steps - 1
+        self.mess_fwd = self.mess_fwd[self.n_clones[self.x[:start]].sum():]
+        self.x = self.x[start:]
+        self.a = self.a[start:]
+
+
 def updateCE(CE, E, n_clones, mess_fwd, mess_bwd, x, a):
     timesteps = len(x)
     gamma = mess_fwd * mess_bwd
@@ -485,6 +939,90 @@ def updateC_Pi_x(C_Pi_x, C, T, n_clones, mess_fwd, mess_bwd, x, a):
         else:
             first = True
 
+
+@nb.njit
+def accumulateC_Pi_x(C_Pi_x, C, T, n_clones, mess_fwd, mess_bwd, x, a, t_stop, first):
+    """Add expected counts of transitions into x[1:t_stop] to C and C_Pi_x.
+    first: whether x[0] starts a sequence.
+    Returns whether x[t_stop - 1] starts a sequence."""
+    state_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones)).cumsum()
+    mess_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones[x])).cumsum()
+    for t in range(1, t_stop):
+        aij, i, j = (
+            a[t - 1],
+            x[t - 1],
+            x[t],
+        )  # at time t-1 -> t we go from observation i to observation j
+
+        if aij >= 0:
+            (tm1_start, tm1_stop), (t_start, t_stop_) = (
+                mess_loc[t - 1: t + 1],
+                mess_loc[t: t + 2],
+            )
+            (i_start, i_stop), (j_start, j_stop) = (
+                state_loc[i: i + 2],
+                state_loc[j: j + 2],
+            )
+            q = (
+                mess_fwd[tm1_start:tm1_stop].reshape(-1, 1)
+                * T[aij, i_start:i_stop, j_start:j_stop]
+                * mess_bwd[t_start:t_stop_].reshape(1, -1)
+            )
+            q /= q.sum()
+            C[aij, i_start:i_stop, j_start:j_stop] += q
+            if first:
+                C_Pi_x[i_start:i_stop] += (
+                        mess_fwd[tm1_start:tm1_stop] *
+                        mess_bwd[tm1_start:tm1_stop]
+                )
+                first = False
+        else:
+            first = True
+    return first
+
+
+@nb.njit
+def forward_window(T_tr, Pi, n_clones, x, a, message, max_product):
+    """Forward messages of a part of a sequence starting from the normalized
+    message of x[0]. Returns log-probabilities of x[1:] and messages of x."""
+    state_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones)).cumsum()
+    mess_loc = np.hstack((np.array([0], dtype=n_clones.dtype), n_clones[x])).cumsum()
+    dtype = T_tr.dtype.type
+
+    log2_lik = np.zeros(len(x) - 1, dtype)
+    mess_fwd = np.empty(mess_loc[-1], dtype=dtype)
+    message = message.astype(dtype)
+    mess_fwd[mess_loc[0]:mess_loc[1]] = message
+
+    for t in range(1, x.shape[0]):
+        aij, i, j = (
+            a[t - 1],
+            x[t - 1],
+            x[t],
+        )  # at time t-1 -> t we go from observation i to observation j
+        (i_start, i_stop) = state_loc[i: i + 2]
+        (j_start, j_stop) = state_loc[j: j + 2]
+
+        if aij < 0:
+            message = Pi[j_start:j_stop].copy().astype(dtype)
+        elif max_product:
+            new_message = np.zeros(j_stop - j_start, dtype=dtype)
+            for d in range(len(new_message)):
+                new_message[d] = (T_tr[aij, j_start + d, i_start:i_stop] * message).max()
+            message = new_message
+        else:
+            message = np.ascontiguousarray(T_tr[aij, j_start:j_stop, i_start:i_stop]).dot(
+                message
+            )
+
+        p_obs = message.max() if max_product else message.sum()
+        assert p_obs > 0
+        message /= p_obs
+        log2_lik[t - 1] = np.log2(p_obs)
+        mess_fwd[mess_loc[t]:mess_loc[t + 1]] = message
+    return log2_lik, mess_fwd
+
+
 @nb.njit
 def forward(T_tr, Pi, n_clones, x, a, store_messages=False):
     """Log-probability of a sequence, and optionally, messages"""
@@ -613,10 +1151,15 @@ def forward_mp(T_tr, Pi, n_clones, x, a, store_messages=False):
             state_loc[i : i + 2],
             state_loc[j : j + 2],
         )
-        new_message = np.zeros(j_stop - j_start, dtype=dtype)
-        for d in range(len(new_message)):
-            new_message[d] = (T_tr[aij, j_start + d, i_start:i_stop] * message).max()
-        message = new_message
+
+        if aij >= 0:
+            new_message = np.zeros(j_stop - j_start, dtype=dtype)
+            for d in range(len(new_message)):
+                new_message[d] = (T_tr[aij, j_start + d, i_start:i_stop] * message).max()
+            message = new_message
+        else:
+            message = Pi[j_start:j_stop].copy().astype(dtype)
+
         p_obs = message.max()
         assert p_obs > 0
         message /= p_obs
@@ -630,7 +1173,7 @@ def forward_mp(T_tr, Pi, n_clones, x, a, store_messages=False):
 @nb.njit
 def rargmax(x):
     # return x.argmax()  # <- favors clustering towards smaller state numbers
-    return self._rng.choice((x == x.max()).nonzero()[0])
+    return np.random.choice((x == x.max()).nonzero()[0])
 
 
 @nb.njit
@@ -654,9 +1197,13 @@ def backtrace(T, n_clones, x, a, mess_fwd):
         )  # at time t -> t+1 we go from observation i to observation j
         (i_start, i_stop), j_start = state_loc[i : i + 2], state_loc[j]
         t_start, t_stop = mess_loc[t : t + 2]
-        belief = (
-            mess_fwd[t_start:t_stop] * T[aij, i_start:i_stop, j_start + code[t + 1]]
-        )
+        if aij >= 0:
+            belief = (
+                mess_fwd[t_start:t_stop] * T[aij, i_start:i_stop, j_start + code[t + 1]]
+            )
+        else:
+            # the next step starts a new sequence
+            belief = mess_fwd[t_start:t_stop]
         code[t] = rargmax(belief)
     states = state_loc[x] + code
     return states
@@ -8,7 +8,10 @@ from typing import Literal, Optional
 from hima.common.utils import softmax
 from hmmlearn.hmm import CategoricalHMM
 from copy import copy
-from hima.modules.baselines.cscg import CHMM
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from hima.modules.baselines.cscg import BlockSparseCHMM
 
 import warnings
 from hima.modules.belief.utils import normalize, sample_categorical_variables
@@ -18,6 +21,7 @@ from hima.modules.belief.utils import EPS, UINT_DTYPE, REAL64_DTYPE
 L_MODE = Literal['bw', 'bw_base', 'bw_iter', 'htm']
 INI_MODE = Literal['dirichlet', 'normal', 'uniform']
 P_MODE = Literal['modulate', 'replace', 'boost', 'none']
+EM_MODE = Literal['batch', 'online']
 
 
 class CHMMBasic:
@@ -409,7 +413,180 @@ class HMM:
         self.emission_probs = self.model.emissionprob_.copy()
 
 
+# n_workers -> process pool shared by all layers
+_em_executors = dict()
+
+
+def get_em_executor(n_workers):
+    executor = _em_executors.get(n_workers)
+    if executor is None:
+        # spawn doesn't copy threads and locks of the agent into workers
+        executor = _em_executors[n_workers] = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=get_context('spawn')
+        )
+    return executor
+
+
+def learn_em(n_clones, x, a, transition_probs, state_prior, n_iter, seed):
+    """
+        Fit CHMM of a single variable starting from the given parameters.
+        EM runs only over transition blocks of the sequence.
+            returns new transition probs and state prior
+    """
+    chmm = BlockSparseCHMM(
+        n_clones,
+        x,
+        a,
+        pseudocount=EPS,
+        dtype=REAL64_DTYPE,
+        seed=seed,
+        n_actions=transition_probs.shape[0],
+        verbose=False
+    )
+    chmm.set_T(transition_probs)
+    chmm.Pi_x = state_prior
+    chmm.learn_em_T_Pi_x(x, a, n_iter=n_iter, term_early=False)
+    return chmm.to_dense(), chmm.Pi_x
+
+
+def learn_online_em(
+        n_clones, x, a, transition_probs, state_prior,
+        transition_counts, transition_row_counts, state_prior_counts, counts_scale,
+        n_iter, tolerance, seed
+):
+    """
+        Stepwise EM of a single variable. Parameters are fitted to the accumulated
+        expected counts plus the expected counts of the new sequence,
+        forward-backward passes run over the new sequence only.
+        Arrays are updated inplace.
+            transition_counts: accumulated counts (n_actions, n_states, n_states)
+                divided by counts_scale
+            transition_row_counts: row sums of transition_counts (n_actions * n_states)
+            state_prior_counts: accumulated prior counts divided by counts_scale
+            n_iter: maximum number of forward-backward passes
+            tolerance: passes stop when log likelihood per step (log base 2)
+                improves less than tolerance
+            returns number of passes
+    """
+    chmm = BlockSparseCHMM(
+        n_clones,
+        x,
+        a,
+        pseudocount=EPS,
+        dtype=REAL64_DTYPE,
+        seed=seed,
+        n_actions=transition_probs.shape[0],
+        verbose=False
+    )
+    chmm.set_T(transition_probs)
+    chmm.Pi_x = state_prior
+
+    n_states = chmm.n_states
+    # old counts, only blocks of the sequence take part in passes
+    counts = transition_counts.reshape(-1)[chmm.entries] * counts_scale
+    row_counts = transition_row_counts * counts_scale
+    prior_counts = state_prior_counts * counts_scale
+
+    log2_lik_old = -np.inf
+    n_passes = 0
+    while n_passes < n_iter:
+        # E
+        log2_lik = chmm.e_step(x, a).mean()
+        n_passes += 1
+        # M
+        new_row_counts = row_counts + np.bincount(
+            chmm.rows, weights=chmm.C, minlength=len(row_counts)
+        )
+        chmm.T = (counts + chmm.C + EPS) / (new_row_counts[chmm.rows] + EPS * n_states)
+        new_prior_counts = prior_counts + chmm.C_Pi_x
+        chmm.Pi_x = (new_prior_counts + EPS) / (new_prior_counts.sum() + EPS * n_states)
+
+        if log2_lik - log2_lik_old < tolerance:
+            break
+        log2_lik_old = log2_lik
+
+    # accumulate counts of the last pass
+    transition_counts.reshape(-1)[chmm.entries] += chmm.C / counts_scale
+    transition_row_counts += np.bincount(
+        chmm.rows, weights=chmm.C, minlength=len(transition_row_counts)
+    ) / counts_scale
+    state_prior_counts += chmm.C_Pi_x / counts_scale
+
+    # only rows with new counts change
+    rows = np.unique(chmm.rows)
+    transition_probs.reshape(-1, n_states)[rows] = (
+            (transition_counts.reshape(-1, n_states)[rows] * counts_scale + EPS)
+            / (transition_row_counts[rows] * counts_scale + EPS * n_states).reshape(-1, 1)
+    )
+    state_prior[:] = chmm.Pi_x
+
+    return n_passes
+
+
+def get_em_arrays(buffer, n_vars, n_steps, n_actions, n_states):
+    """
+        Views of the buffer shared by EM workers.
+            returns observations, actions, transition probs and state priors
+            of all variables
+    """
+    shapes = (
+        (n_vars, n_steps),
+        (n_steps, ),
+        (n_vars, n_actions, n_states, n_states),
+        (n_vars, n_states)
+    )
+    dtypes = (np.int64, np.int64, REAL64_DTYPE, REAL64_DTYPE)
+
+    arrays = list()
+    offset = 0
+    for shape, dtype in zip(shapes, dtypes):
+        array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += array.nbytes
+        arrays.append(array)
+
+    return arrays
+
+
+def get_em_buffer_size(n_vars, n_steps, n_actions, n_states):
+    return 8 * (
+        n_vars * n_steps + n_steps
+        + n_vars * n_actions * n_states * n_states
+        + n_vars * n_states
+    )
+
+
+def learn_em_shared(shm_name, shape, var, n_clones, n_iter, seed):
+    """
+        Fit CHMM of the variable in a worker process. Parameters of the variable
+        in the shared memory are replaced with the new ones.
+            shape: (n_vars, n_steps, n_actions, n_states) of the shared arrays
+    """
+    shm = SharedMemory(name=shm_name)
+    try:
+        x, a, transition_probs, state_prior = get_em_arrays(shm.buf, *shape)
+        transition_probs[var], state_prior[var] = learn_em(
+            n_clones, x[var], a, transition_probs[var], state_prior[var], n_iter, seed
+        )
+        # views should be released before closing the memory
+        del x, a, transition_probs, state_prior
+    finally:
+        close_shared_memory(shm)
+
+
+def close_shared_memory(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # views are still referenced by an exception being raised,
+        # the memory is released when they are collected
+        pass
+
+
 class FCHMMLayer:
+    # accumulated counts are rescaled when their scale gets smaller
+    MIN_COUNTS_SCALE = 1e-10
+
     def __init__(
             self,
             n_obs_vars: int,
@@ -420,8 +597,24 @@ class FCHMMLayer:
             batch_size: int = 100,
             em_iterations: int = 100,
             alpha: float = 1.0,
+            em_workers: int = 0,
+            em_mode: EM_MODE = 'batch',
+            em_tolerance: float = 1e-4,
+            counts_decay: float = 0.9,
             seed: int = None,
     ):
+        """
+            em_iterations: number of EM iterations for each batch in the batch mode,
+                maximum number of iterations in the online mode
+            em_workers: number of processes fitting variables in parallel
+                in the batch mode, 0 fits them sequentially in the calling process
+            em_mode: 'batch' refits the model to each batch and blends the result
+                with lr, 'online' keeps expected transition counts across batches
+                and fits the model to them, running passes over the new batch only
+            em_tolerance: online passes stop when log likelihood per step
+                (log base 2) improves less than the tolerance
+            counts_decay: discount of the accumulated counts per batch in the online mode
+        """
         self._rng = np.random.default_rng(seed)
 
         self.timestep = 1
@@ -434,6 +627,10 @@ class FCHMMLayer:
         self.n_context_states = n_obs_states * cells_per_column
         self.batch_size = batch_size
         self.em_iterations = em_iterations
+        self.em_workers = em_workers
+        self.em_mode = em_mode
+        self.em_tolerance = em_tolerance
+        self.counts_decay = counts_decay
         self.lr = lr
 
         self.cells_per_column = cells_per_column
@@ -458,6 +655,19 @@ class FCHMMLayer:
         self.state_prior = np.zeros((self.n_hidden_vars, self.n_hidden_states))
         self.state_prior_stats = np.zeros_like(self.state_prior)
 
+        if self.em_mode == 'online':
+            if self.em_workers > 0:
+                raise ValueError('EM workers are supported only in the batch mode')
+            # expected counts divided by counts_scale, decay is applied through the scale
+            self.transition_counts = np.zeros_like(self.transition_probs)
+            self.transition_row_counts = np.zeros(
+                (self.n_hidden_vars, self.n_external_states * self.n_hidden_states)
+            )
+            self.state_prior_counts = np.zeros_like(self.state_prior)
+            self.counts_scale = 1.0
+        elif self.em_mode != 'batch':
+            raise ValueError(f'There is no such EM mode "{self.em_mode}"')
+
         for i in range(self.n_hidden_vars):
             self.transition_probs[i] = self._rng.dirichlet(
                 alpha=[alpha] * self.n_hidden_states * self.n_external_states,
@@ -566,14 +776,9 @@ class FCHMMLayer:
         if self.context_messages.size == 0:
             self.internal_forward_messages = self.state_prior.flatten()
         else:
-            trans_probs_action = np.sum(
-                self.transition_probs * self.external_messages.reshape((1, -1, 1, 1)),
-                axis=1
-            )
-            self.internal_forward_messages = np.einsum('kj,kji->ki',
-                self.context_messages.reshape((self.n_hidden_vars, -1)),
-                trans_probs_action
-            )
+            self.internal_forward_messages = self._propagate(
+                self.context_messages, self.external_messages.reshape((1, -1))
+            )[0]
             self.internal_forward_messages = normalize(
                 self.internal_forward_messages
             ).flatten()
@@ -583,6 +788,71 @@ class FCHMMLayer:
             (self.n_columns, self.cells_per_column)
         ).sum(axis=-1)
 
+    def predict_batch(self, context_messages, external_messages, **_):
+        """
+            Predict cells for a batch of external messages without changing the layer's state.
+                context_messages: (context_input_size,) shared by all rows
+                    or (batch_size, context_input_size), empty for the state prior
+                external_messages: (batch_size, external_input_size)
+            returns prediction_cells: (batch_size, internal_cells),
+                prediction_columns: (batch_size, n_columns)
+        """
+        external_messages = np.asarray(external_messages).reshape(
+            (-1, self.external_input_size)
+        )
+        batch_size = external_messages.shape[0]
+
+        if context_messages.size == 0:
+            prediction_cells = np.tile(self.state_prior.flatten(), (batch_size, 1))
+        else:
+            prediction_cells = self._propagate(context_messages, external_messages)
+            prediction_cells = normalize(
+                prediction_cells.reshape((-1, self.n_hidden_states))
+            ).reshape((batch_size, -1))
+
+        prediction_columns = prediction_cells.reshape(
+            (batch_size, self.n_columns, self.cells_per_column)
+        ).sum(axis=-1)
+
+        return prediction_cells, prediction_columns
+
+    def _propagate(self, context_messages, external_messages):
+        """
+            Unnormalized messages after transition for a batch of external messages.
+            Context messages are usually non-zero only for cells of the observed columns,
+            so only their rows of the transition matrix are used.
+                context_messages: (context_input_size,) shared by all rows
+                    or (batch_size, context_input_size)
+                external_messages: (batch_size, external_input_size)
+                returns (batch_size, n_hidden_vars, n_hidden_states)
+        """
+        shared_context = context_messages.ndim == 1
+        context_messages = context_messages.reshape((-1, self.n_hidden_vars, self.n_hidden_states))
+        actions = np.flatnonzero(np.any(external_messages != 0, axis=0))
+        external_messages = external_messages[:, actions]
+
+        messages = np.zeros((len(external_messages), self.n_hidden_vars, self.n_hidden_states))
+        for var in range(self.n_hidden_vars):
+            var_context_messages = context_messages[:, var]
+            cells = np.flatnonzero(np.any(var_context_messages != 0, axis=0))
+            var_context_messages = var_context_messages[:, cells]
+
+            if shared_context:
+                subscripts = 'j,aji,ba->bi'
+                var_context_messages = var_context_messages[0]
+            else:
+                subscripts = 'bj,aji,ba->bi'
+
+            messages[:, var] = np.einsum(
+                subscripts,
+                var_context_messages,
+                self.transition_probs[var][np.ix_(actions, cells)],
+                external_messages,
+                optimize=True
+            )
+
+        return messages
+
     def observe(
             self,
             observation: np.ndarray,
@@ -637,36 +907,113 @@ class FCHMMLayer:
                 self.actions.append(-1)
                 a = np.array(self.actions[1:], dtype=np.int64)
 
-                for i in range(self.n_hidden_vars):
-                    chmm = CHMM(
-                        np.full(self.n_obs_states, fill_value=self.cells_per_column),
-                        x[i],
-                        a,
-                        pseudocount=EPS,
-                        dtype=REAL64_DTYPE,
-                        seed=self._rng.integers(np.iinfo(np.int32).max)
-                    )
-                    chmm.T = self.transition_probs[i]
-                    chmm.Pi_x = self.state_prior[i]
-                    chmm.learn_em_T_Pi_x(x[i], a, n_iter=self.em_iterations, term_early=False)
-
-                    self.transition_stats[i] += self.lr * (
-                            chmm.T.copy() - self.transition_stats[i]
-                    )
-                    self.state_prior_stats[i] += self.lr * (
-                            chmm.Pi_x.copy() - self.state_prior_stats[i]
-                    )
-
-                    self.transition_probs[i] = self.transition_stats[i] / self.transition_stats[i].sum(
-                        axis=2
-                    )[:, :, None]
-                    self.state_prior[i] = self.state_prior_stats[i] / self.state_prior_stats[i].sum()
+                seeds = [
+                    self._rng.integers(np.iinfo(np.int32).max)
+                    for _ in range(self.n_hidden_vars)
+                ]
+                if self.em_mode == 'online':
+                    self._learn_online_em(x, a, seeds)
+                else:
+                    self._learn_batch_em(x, a, seeds)
 
                 self.observations = [list() for _ in range(self.n_hidden_vars)]
                 self.actions.clear()
 
         self.timestep += 1
 
+    def _learn_batch_em(self, x, a, seeds):
+        if self.em_workers > 0:
+            new_transition_probs, new_state_prior = self._learn_em_parallel(x, a, seeds)
+        else:
+            new_transition_probs, new_state_prior = zip(*(
+                learn_em(
+                    np.full(self.n_obs_states, fill_value=self.cells_per_column),
+                    x[i],
+                    a,
+                    self.transition_probs[i],
+                    self.state_prior[i],
+                    self.em_iterations,
+                    seeds[i]
+                )
+                for i in range(self.n_hidden_vars)
+            ))
+
+        for i in range(self.n_hidden_vars):
+            self.transition_stats[i] += self.lr * (
+                    new_transition_probs[i] - self.transition_stats[i]
+            )
+            self.state_prior_stats[i] += self.lr * (
+                    new_state_prior[i] - self.state_prior_stats[i]
+            )
+
+            self.transition_probs[i] = self.transition_stats[i] / self.transition_stats[i].sum(
+                axis=2
+            )[:, :, None]
+            self.state_prior[i] = self.state_prior_stats[i] / self.state_prior_stats[i].sum()
+
+    def _learn_online_em(self, x, a, seeds):
+        self.counts_scale *= self.counts_decay
+        if self.counts_scale < self.MIN_COUNTS_SCALE:
+            self.transition_counts *= self.counts_scale
+            self.transition_row_counts *= self.counts_scale
+            self.state_prior_counts *= self.counts_scale
+            self.counts_scale = 1.0
+
+        for i in range(self.n_hidden_vars):
+            learn_online_em(
+                np.full(self.n_obs_states, fill_value=self.cells_per_column),
+                x[i],
+                a,
+                self.transition_probs[i],
+                self.state_prior[i],
+                self.transition_counts[i],
+                self.transition_row_counts[i],
+                self.state_prior_counts[i],
+                self.counts_scale,
+                self.em_iterations,
+                self.em_tolerance,
+                seeds[i]
+            )
+
+    def _learn_em_parallel(self, x, a, seeds):
+        """
+            Fit variables in worker processes. Observations, actions and
+            parameters are passed through shared memory.
+        """
+        shape = (self.n_hidden_vars, x.shape[1], self.n_external_states, self.n_hidden_states)
+        shm = SharedMemory(create=True, size=get_em_buffer_size(*shape))
+        try:
+            x_shared, a_shared, transition_probs, state_prior = get_em_arrays(shm.buf, *shape)
+            x_shared[:] = x
+            a_shared[:] = a
+            transition_probs[:] = self.transition_probs
+            state_prior[:] = self.state_prior
+
+            executor = get_em_executor(self.em_workers)
+            futures = [
+                executor.submit(
+                    learn_em_shared,
+                    shm.name,
+                    shape,
+                    i,
+                    np.full(self.n_obs_states, fill_value=self.cells_per_column),
+                    self.em_iterations,
+                    seeds[i]
+                )
+                for i in range(self.n_hidden_vars)
+            ]
+            for future in futures:
+                future.result()
+
+            new_transition_probs, new_state_prior = transition_probs.copy(), state_prior.copy()
+            # views should be released before closing the memory
+            del x_shared, a_shared, transition_probs, state_prior
+        finally:
+            close_shared_memory(shm)
+            shm.unlink()
+
+        return new_transition_probs, new_state_prior
+
     def _get_cells_for_observation(self, obs_states):
         vars_for_obs_states = obs_states // self.n_obs_states
         all_vars = np.arange(self.n_obs_vars)
@@ -12,6 +12,7 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
+from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
 
 from hima.common.sdr import sparse_to_dense
@@ -65,8 +66,18 @@ class LstmLayer:
             num_epochs: int = 10,
             early_stop_loss: float = 0.1,
             retain_old_trajectories: float = 0.5,
+            minibatch_size: int | None = None,
+            bptt_steps: int | None = None,
             seed=None,
     ):
+        """
+            use_batches: collect trajectories and train on them after batch_size episodes,
+                otherwise train online each loss_propagation_schedule steps
+            minibatch_size: number of trajectories per optimizer step,
+                None for all training trajectories
+            bptt_steps: length of truncated backpropagation through time,
+                None for whole trajectories
+        """
         torch.set_num_threads(1)
 
         # n_groups/vars
@@ -100,11 +111,14 @@ class LstmLayer:
         self.num_epochs = num_epochs
         self.early_stop_loss = early_stop_loss
         self.retain_old_trajectories = retain_old_trajectories
+        self.minibatch_size = minibatch_size
+        self.bptt_steps = bptt_steps
 
         # o_t
         self.observations = list()
         # a_{t-1}
         self.actions = list()
+        # (observations [T, input_size], actions [T, external_input_size])
         self.trajectories = list()
 
         self.lr = lr
@@ -181,14 +195,17 @@ class LstmLayer:
         self._reinit_messages_and_states()
 
         self.trajectories.append(
-            list(zip(self.observations, self.actions))
+            stack_trajectory(
+                self.observations, self.actions,
+                self.input_size, self.external_input_size, self.device
+            )
         )
 
         self.observations.clear()
         self.actions.clear()
 
         if len(self.trajectories) == self.batch_size:
-            self._train()
+            train_on_trajectories(self)
             self.trajectories = self.trajectories[
                 :int(self.batch_size * self.retain_old_trajectories)
             ]
@@ -254,6 +271,10 @@ class LstmLayer:
             target = torch.unsqueeze(torch.reshape(target, shape).T, 0)
             return self.loss_function(logits, target) / self.n_obs_vars
 
+    def get_batch_loss(self, logits, target):
+        """Loss of get_loss for each row of [batch_size, input_size] tensors."""
+        return get_batch_loss(logits, target, self.n_obs_vars, self.n_obs_states)
+
     def backpropagate_loss(self):
         if self.accumulated_loss_steps % self.loss_propagation_schedule != 0:
             return
@@ -317,91 +338,6 @@ class LstmLayer:
             self.prediction_columns
         ) = snapshot
 
-    def _train(self):
-        self.optimizer = optim.AdamW(self.model.parameters(), lr=self.lr)
-        scheduler = lr_scheduler.LinearLR(
-            self.optimizer,
-            start_factor=1.0,
-            end_factor=0.01,
-            total_iters=self.num_epochs
-        )
-        indx = np.arange(len(self.trajectories))
-        self.rng.shuffle(indx)
-
-        split_indx = len(indx) - int(len(indx) * 0.25)
-
-        val_indx = indx[split_indx:]
-        train_indx = indx[:split_indx]
-
-        previous_val_loss = 1e24
-        tolerance = 0
-
-        for epoch in (pbar := tqdm(range(self.num_epochs))):
-            accumulated_loss = 0
-            accumulated_steps = 0
-
-            for i in train_indx:
-                state = self.model.get_init_state()
-
-                for dense_obs, dense_act in self.trajectories[i]:
-                    action_probs = dense_act
-                    action_probs = torch.from_numpy(action_probs).float().to(self.device)
-
-                    state = self.transition_with_action(action_probs, state)
-                    predicted_obs_logits = self.decode_obs(state)
-
-                    loss = self.get_loss(predicted_obs_logits, dense_obs)
-                    accumulated_loss += loss
-                    accumulated_steps += 1
-
-                    state = self.transition_with_observation(dense_obs, state)
-
-            self.optimizer.zero_grad()
-            mean_loss = accumulated_loss / accumulated_steps
-            mean_loss.backward()
-            self.optimizer.step()
-            mean_loss = mean_loss.item()
-
-            if len(val_indx) != 0:
-                val_los = 0
-                val_los_steps = 0
-
-                for i in val_indx:
-                    state = self.model.get_init_state()
-
-                    for dense_obs, dense_act in self.trajectories[i]:
-                        action_probs = dense_act
-                        action_probs = torch.from_numpy(action_probs).float().to(self.device)
-
-                        with torch.no_grad():
-                            state = self.transition_with_action(action_probs, state)
-                            predicted_obs_logits = self.decode_obs(state)
-                            loss = self.get_loss(predicted_obs_logits, dense_obs)
-                            val_los += loss
-                            val_los_steps += 1
-                            state = self.transition_with_observation(dense_obs, state)
-
-                mean_val_loss = (val_los / val_los_steps).item()
-            else:
-                mean_val_loss = None
-
-            pbar.set_description(
-                f"loss: {round(mean_loss, 3)} val_loss: {round(mean_val_loss, 3)} lr: {round(scheduler.get_last_lr()[0], 3)} ",
-                refresh=True
-            )
-            scheduler.step()
-
-            if mean_val_loss < self.early_stop_loss:
-                break
-
-            if mean_val_loss > previous_val_loss:
-                tolerance += 1
-                if tolerance >= 3:
-                    break
-            else:
-                tolerance = 0
-                previous_val_loss = mean_val_loss
-
 
 class LstmWorldModel(nn.Module):
     def __init__(
@@ -439,7 +375,7 @@ class LstmWorldModel(nn.Module):
         pinball_raw_image = self.n_obs_vars == 50 * 36 and self.n_obs_states == 1
         if pinball_raw_image:
             self.encoder = nn.Sequential(
-                nn.Unflatten(0, (1, 50, 36)),
+                nn.Unflatten(-1, (1, 50, 36)),
                 # 50x36x1
                 nn.Conv2d(1, 4, 5, 3, 2),
                 # 17x11x2
@@ -447,7 +383,7 @@ class LstmWorldModel(nn.Module):
                 # 9x6x4
                 # nn.Conv2d(4, 8, 3, 1, 1),
                 # 9x6x4
-                nn.Flatten(0),
+                nn.Flatten(-3),
             )
             encoded_input_size = 216
         else:
@@ -480,12 +416,18 @@ class LstmWorldModel(nn.Module):
             else:
                 self.decoder = nn.Linear(self.hidden_size, self.input_size, bias=False)
 
-    def get_init_state(self) -> TLstmHiddenState:
-        return self._initial_state
+    def get_init_state(self, batch_size: int | None = None) -> TLstmHiddenState:
+        """Initial state, or its copies for a batch: [batch_size, hidden_size]."""
+        if batch_size is None:
+            return self._initial_state
+
+        state_out, state_cell = self._initial_state
+        return state_out.expand(batch_size, -1), state_cell.expand(batch_size, -1)
 
     def transition_with_observation(self, obs, state):
         if self.action_size > 0:
-            obs = torch.cat((obs, self.empty_action.detach()))
+            empty_action = self.empty_action.detach().expand(*obs.shape[:-1], -1)
+            obs = torch.cat((obs, empty_action), dim=-1)
         if self.encoder is not None:
             obs = self.encoder(obs)
 
@@ -494,8 +436,12 @@ class LstmWorldModel(nn.Module):
         return state_out, state_cell
 
     def transition_with_action(self, action_probs, state):
-        action_probs = action_probs.expand(self.action_repeat_k, -1).flatten()
-        obs = torch.cat((self.empty_obs.detach(), action_probs))
+        batch_shape = action_probs.shape[:-1]
+        action_probs = action_probs.unsqueeze(-2).expand(
+            *batch_shape, self.action_repeat_k, -1
+        ).flatten(-2)
+        empty_obs = self.empty_obs.detach().expand(*batch_shape, -1)
+        obs = torch.cat((empty_obs, action_probs), dim=-1)
 
         if self.encoder is not None:
             obs = self.encoder(obs)
@@ -720,6 +666,180 @@ class LSTMWMLayer(nn.Module):
         return prediction
 
 
+def stack_trajectory(observations, actions, obs_size, action_size, device):
+    """
+        Stack an episode into tensors.
+            observations: list of dense observation tensors
+            actions: list of dense action arrays
+            returns observations [T, obs_size] and actions [T, action_size]
+    """
+    if len(observations) > 0:
+        observations = torch.stack(observations)
+    else:
+        observations = torch.empty((0, obs_size), device=device)
+
+    actions = np.array(actions, dtype=np.float32).reshape(-1, action_size)
+    return observations, torch.from_numpy(actions).to(device)
+
+
+def pad_trajectories(trajectories):
+    """
+        Pad trajectories of different length with zeros to batch them.
+            trajectories: list of (observations [T, obs_size], actions [T, action_size])
+            returns observations [N, T_max, obs_size], actions [N, T_max, action_size]
+                and mask [N, T_max] of real steps
+    """
+    observations, actions = zip(*trajectories)
+    lengths = torch.tensor([len(obs) for obs in observations])
+
+    observations = pad_sequence(observations, batch_first=True)
+    actions = pad_sequence(actions, batch_first=True)
+    mask = torch.arange(observations.shape[1]) < lengths.unsqueeze(-1)
+    return observations, actions, mask.to(observations.device)
+
+
+def unroll_trajectories(layer, observations, actions, mask, state):
+    """
+        Predict each observation of a batch of padded trajectories
+        after the preceding action, then observe it.
+            layer: LstmLayer or RwkvLayer
+            observations: [B, T, obs_size]
+            actions: [B, T, action_size]
+            mask: [B, T] of real steps
+            state: batched model state
+            returns the sum of losses and the number of real steps, the last state
+    """
+    n_steps = int(mask.sum(dim=1).max())
+
+    loss = 0
+    for t in range(n_steps):
+        state = layer.transition_with_action(actions[:, t], state)
+        predicted_obs_logits = layer.decode_obs(state)
+
+        step_loss = layer.get_batch_loss(predicted_obs_logits, observations[:, t])
+        loss = loss + step_loss[mask[:, t]].sum()
+
+        state = layer.transition_with_observation(observations[:, t], state)
+
+    return loss, int(mask.sum()), state
+
+
+def train_on_trajectories(layer):
+    """
+        Train the layer's model on its collected trajectories for up to num_epochs
+        with a quarter of them held out for validation and early stopping.
+            layer: LstmLayer or RwkvLayer
+    """
+    layer.optimizer = optim.AdamW(layer.model.parameters(), lr=layer.lr)
+    scheduler = lr_scheduler.LinearLR(
+        layer.optimizer,
+        start_factor=1.0,
+        end_factor=0.01,
+        total_iters=layer.num_epochs
+    )
+    observations, actions, mask = pad_trajectories(layer.trajectories)
+
+    indx = np.arange(len(layer.trajectories))
+    layer.rng.shuffle(indx)
+
+    split_indx = len(indx) - int(len(indx) * 0.25)
+
+    val_indx = indx[split_indx:]
+    train_indx = indx[:split_indx]
+    minibatch_size = layer.minibatch_size or len(train_indx)
+
+    previous_val_loss = 1e24
+    tolerance = 0
+
+    for epoch in (pbar := tqdm(range(layer.num_epochs))):
+        accumulated_loss = 0
+        accumulated_steps = 0
+
+        layer.rng.shuffle(train_indx)
+        for i in range(0, len(train_indx), minibatch_size):
+            batch = train_indx[i:i + minibatch_size]
+            loss, steps = train_trajectory_batch(
+                layer, observations[batch], actions[batch], mask[batch]
+            )
+            accumulated_loss += loss
+            accumulated_steps += steps
+
+        mean_loss = accumulated_loss / accumulated_steps
+
+        if len(val_indx) != 0:
+            with torch.no_grad():
+                val_loss, val_steps, _ = unroll_trajectories(
+                    layer, observations[val_indx], actions[val_indx], mask[val_indx],
+                    layer.model.get_init_state(len(val_indx))
+                )
+            mean_val_loss = val_loss.item() / val_steps
+        else:
+            mean_val_loss = None
+
+        pbar.set_description(
+            f"loss: {round(mean_loss, 3)} val_loss: {round(mean_val_loss, 3)} lr: {round(scheduler.get_last_lr()[0], 3)} ",
+            refresh=True
+        )
+        scheduler.step()
+
+        if mean_val_loss < layer.early_stop_loss:
+            break
+
+        if mean_val_loss > previous_val_loss:
+            tolerance += 1
+            if tolerance >= 3:
+                break
+        else:
+            tolerance = 0
+            previous_val_loss = mean_val_loss
+
+
+def train_trajectory_batch(layer, observations, actions, mask):
+    """
+        Truncated BPTT over a minibatch of padded trajectories:
+        an optimizer step for each bptt_steps long segment.
+            returns the sum of losses and the number of real steps
+    """
+    n_steps = int(mask.sum(dim=1).max())
+    bptt_steps = layer.bptt_steps or n_steps
+    state = layer.model.get_init_state(len(observations))
+
+    accumulated_loss = 0
+    accumulated_steps = 0
+    for start in range(0, n_steps, bptt_steps):
+        end = min(start + bptt_steps, n_steps)
+        loss, steps, state = unroll_trajectories(
+            layer, observations[:, start:end], actions[:, start:end], mask[:, start:end],
+            state
+        )
+
+        layer.optimizer.zero_grad()
+        (loss / steps).backward()
+        layer.optimizer.step()
+
+        state = tuple(s.detach() for s in state)
+        accumulated_loss += loss.item()
+        accumulated_steps += steps
+
+    return accumulated_loss, accumulated_steps
+
+
+def get_batch_loss(logits, target, n_vars, n_states):
+    if n_states == 1:
+        # BCE with logits averaged over vars
+        return nn.functional.binary_cross_entropy_with_logits(
+            logits, target, reduction='none'
+        ).mean(dim=-1)
+    else:
+        # cross entropy over each variable: [B, n_states, n_vars] batch of distributions
+        shape = -1, n_vars, n_states
+        logits = torch.reshape(logits, shape).transpose(1, 2)
+        target = torch.reshape(target, shape).transpose(1, 2)
+        return nn.functional.cross_entropy(
+            logits, target, reduction='none'
+        ).sum(dim=-1) / n_vars
+
+
 def to_categorical_distributions(logits, n_vars, n_states):
     if n_states == 1:
         # treat it like all vars have binary states --> should sigmoid each var to have prob
@@ -728,9 +848,9 @@ def to_categorical_distributions(logits, n_vars, n_states):
     else:
         # each var has its own categorical distribution of states obtained with softmax:
         return torch.softmax(
-            torch.reshape(logits, (n_vars, n_states)),
+            torch.reshape(logits, logits.shape[:-1] + (n_vars, n_states)),
             dim=-1
-        ).flatten()
+        ).flatten(-2)
 
 
 def symlog(x):
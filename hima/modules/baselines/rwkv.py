@@ -13,7 +13,8 @@ import torch.optim as optim
 from hima.common.sdr import sparse_to_dense
 from hima.modules.baselines.lstm import (
     to_numpy, TLstmLayerHiddenState, TLstmHiddenState,
-    to_categorical_distributions, symexp
+    to_categorical_distributions, symexp, stack_trajectory, train_on_trajectories,
+    get_batch_loss
 )
 from hima.modules.baselines.rwkv_rnn import RwkvCell
 from hima.modules.belief.utils import normalize
@@ -56,8 +57,23 @@ class RwkvLayer:
             n_external_states: int = 0,
             lr=2e-3,
             loss_propagation_schedule: int = 5,
+            use_batches: bool = False,
+            batch_size: int = 50,
+            num_epochs: int = 10,
+            early_stop_loss: float = 0.1,
+            retain_old_trajectories: float = 0.5,
+            minibatch_size: int | None = None,
+            bptt_steps: int | None = None,
             seed=None,
     ):
+        """
+            use_batches: collect trajectories and train on them after batch_size episodes,
+                otherwise train online each loss_propagation_schedule steps
+            minibatch_size: number of trajectories per optimizer step,
+                None for all training trajectories
+            bptt_steps: length of truncated backpropagation through time,
+                None for whole trajectories
+        """
         torch.set_num_threads(1)
         # n_groups/vars: 6-10
         self.n_obs_vars = n_obs_vars
@@ -85,6 +101,20 @@ class RwkvLayer:
         self.internal_cells = self.hidden_size
         self.context_input_size = self.hidden_size
         self.external_input_size = self.n_external_vars * self.n_external_states
+        self.use_batches = use_batches
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.early_stop_loss = early_stop_loss
+        self.retain_old_trajectories = retain_old_trajectories
+        self.minibatch_size = minibatch_size
+        self.bptt_steps = bptt_steps
+
+        # o_t
+        self.observations = list()
+        # a_{t-1}
+        self.actions = list()
+        # (observations [T, input_size], actions [T, external_input_size])
+        self.trajectories = list()
 
         self.lr = lr
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -156,9 +186,31 @@ class RwkvLayer:
         return self.model.decode_obs(state_out)
 
     def reset(self):
-        self.backpropagate_loss()
+        if not self.use_batches:
+            self.backpropagate_loss()
+            self._reinit_messages_and_states()
+            return
+
+        # trajectories are trained from the initial state
+        self._reinit_model_state(reset_loss=False)
         self._reinit_messages_and_states()
 
+        self.trajectories.append(
+            stack_trajectory(
+                self.observations, self.actions,
+                self.input_size, self.external_input_size, self.device
+            )
+        )
+
+        self.observations.clear()
+        self.actions.clear()
+
+        if len(self.trajectories) == self.batch_size:
+            train_on_trajectories(self)
+            self.trajectories = self.trajectories[
+                :int(self.batch_size * self.retain_old_trajectories)
+            ]
+
     def observe(self, observation, learn: bool = True):
         if observation.size == self.input_size:
             dense_obs = observation
@@ -167,14 +219,21 @@ class RwkvLayer:
         dense_obs = torch.from_numpy(dense_obs).float().to(self.device)
 
         if learn:
-            loss = self.get_loss(self.predicted_obs_logits, dense_obs)
+            with torch.set_grad_enabled(not self.use_batches):
+                loss = self.get_loss(self.predicted_obs_logits, dense_obs)
+
             self.last_loss_value = loss.item()
-            self.accumulated_loss += loss
-            self.accumulated_loss_steps += 1
-            self.backpropagate_loss()
+
+            if self.use_batches:
+                self.observations.append(dense_obs)
+                self.actions.append(self.external_messages)
+            else:
+                self.accumulated_loss += loss
+                self.accumulated_loss_steps += 1
+                self.backpropagate_loss()
 
         _, state = self.internal_state
-        with torch.set_grad_enabled(learn):
+        with torch.set_grad_enabled(learn and not self.use_batches):
             state = self.transition_with_observation(dense_obs, state)
 
         self.internal_state = [True, state]
@@ -188,7 +247,7 @@ class RwkvLayer:
             action_probs = self.external_messages
             action_probs = torch.from_numpy(action_probs).float().to(self.device)
 
-        with torch.set_grad_enabled(learn):
+        with torch.set_grad_enabled(learn and not self.use_batches):
             if self.external_input_size != 0:
                 state = self.transition_with_action(action_probs, state)
             self.predicted_obs_logits = self.decode_obs(state)
@@ -213,6 +272,10 @@ class RwkvLayer:
             target = torch.unsqueeze(torch.reshape(target, shape).T, 0)
             return self.loss_function(logits, target) / self.n_obs_vars
 
+    def get_batch_loss(self, logits, target):
+        """Loss of get_loss for each row of [batch_size, input_size] tensors."""
+        return get_batch_loss(logits, target, self.n_obs_vars, self.n_obs_states)
+
     def backpropagate_loss(self):
         if self.accumulated_loss_steps % self.loss_propagation_schedule != 0:
             return
@@ -313,7 +376,7 @@ class RwkvWorldModel(nn.Module):
         pinball_raw_image = self.n_obs_vars == 50 * 36 and self.n_obs_states == 1
         if pinball_raw_image:
             self.encoder = nn.Sequential(
-                nn.Unflatten(0, (1, 50, 36)),
+                nn.Unflatten(-1, (1, 50, 36)),
                 # 50x36x1
                 nn.Conv2d(1, 4, 5, 3, 2),
                 # 17x11x2
@@ -321,7 +384,7 @@ class RwkvWorldModel(nn.Module):
                 # 9x6x4
                 # nn.Conv2d(4, 8, 3, 1, 1),
                 # 9x6x4
-                nn.Flatten(0),
+                nn.Flatten(-3),
             )
             encoded_input_size = 216
         else:
@@ -359,12 +422,24 @@ class RwkvWorldModel(nn.Module):
             else:
                 self.decoder = nn.Linear(self.hidden_size, self.input_size, bias=False)
 
-    def get_init_state(self) -> TLstmHiddenState:
-        return self._initial_state
+    def get_init_state(self, batch_size: int | None = None) -> TLstmHiddenState:
+        """
+            Initial state, or its copies for a batch:
+            [batch_size, hidden_size] output and [5, batch_size, hidden_size] cell state.
+        """
+        if batch_size is None:
+            return self._initial_state
+
+        state_out, state_cell = self._initial_state
+        return (
+            state_out.expand(batch_size, -1),
+            state_cell.unsqueeze(-2).expand(-1, batch_size, -1)
+        )
 
     def transition_with_observation(self, obs, state):
         if self.action_size > 0:
-            obs = torch.cat((obs, self.empty_action.detach()))
+            empty_action = self.empty_action.detach().expand(*obs.shape[:-1], -1)
+            obs = torch.cat((obs, empty_action), dim=-1)
         if self.encoder is not None:
             obs = self.encoder(obs)
 
@@ -374,8 +449,12 @@ class RwkvWorldModel(nn.Module):
         return state_out, state_cell
 
     def transition_with_action(self, action_probs, state):
-        action_probs = action_probs.expand(self.action_repeat_k, -1).flatten()
-        obs = torch.cat((self.empty_obs.detach(), action_probs))
+        batch_shape = action_probs.shape[:-1]
+        action_probs = action_probs.unsqueeze(-2).expand(
+            *batch_shape, self.action_repeat_k, -1
+        ).flatten(-2)
+        empty_obs = self.empty_obs.detach().expand(*batch_shape, -1)
+        obs = torch.cat((empty_obs, action_probs), dim=-1)
 
         if self.encoder is not None:
             obs = self.encoder(obs)
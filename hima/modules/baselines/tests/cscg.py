@@ -0,0 +1,134 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import tempfile
+import unittest
+import numpy as np
+
+from hima.modules.baselines.cscg import CHMM, BlockSparseCHMM
+
+
+def make_sequence(n_obs=6, n_actions=3, seed=0):
+    """Random walk in a ring room of random observations with episode boundaries."""
+    rng = np.random.default_rng(seed)
+    length = 1000
+    room = rng.integers(n_obs, size=30)
+
+    a = rng.integers(n_actions, size=length)
+    x = np.empty(length, dtype=np.int64)
+    position = 0
+    for t in range(length):
+        x[t] = room[position]
+        position = (position + (-1, 1, 3)[a[t]]) % len(room)
+    # episode boundaries, 369 is the last step of a chunk of 37 steps
+    a[[250, 369, 600, -1]] = -1
+
+    return x, a, np.full(n_obs, 4, dtype=np.int64)
+
+
+class CHMMStreamingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.x, self.a, self.n_clones = make_sequence()
+        self.length = len(self.x)
+
+    def _make_chmm(self):
+        return CHMM(
+            self.n_clones, self.x, self.a,
+            pseudocount=1e-3, dtype=np.float64, seed=1, verbose=False
+        )
+
+    def _chunks(self, size):
+        return lambda: (
+            (self.x[i: i + size], self.a[i: i + size])
+            for i in range(0, self.length, size)
+        )
+
+    def test_em(self):
+        chmm = self._make_chmm()
+        convergence = chmm.learn_em_T_Pi_x(self.x, self.a, n_iter=5, term_early=False)
+
+        streaming_chmm = self._make_chmm()
+        streaming_convergence = streaming_chmm.learn_em_T_Pi_x_streaming(
+            self._chunks(77), n_iter=5, lag=self.length, term_early=False
+        )
+
+        self.assertTrue(np.allclose(chmm.T, streaming_chmm.T))
+        self.assertTrue(np.allclose(chmm.Pi_x, streaming_chmm.Pi_x))
+        self.assertTrue(np.allclose(convergence, streaming_convergence))
+
+    def test_em_fixed_lag(self):
+        chmm = self._make_chmm()
+        chmm.learn_em_T_Pi_x(self.x, self.a, n_iter=5, term_early=False)
+
+        # the lag is shorter than chunks, so steps are smoothed with truncated windows,
+        # some of them contain boundaries
+        streaming_chmm = self._make_chmm()
+        streaming_convergence = streaming_chmm.learn_em_T_Pi_x_streaming(
+            self._chunks(37), n_iter=5, lag=10, term_early=False
+        )
+
+        self.assertTrue(np.all(np.isfinite(streaming_convergence)))
+        self.assertTrue(np.allclose(chmm.T, streaming_chmm.T, atol=1e-5))
+        self.assertTrue(np.allclose(chmm.Pi_x, streaming_chmm.Pi_x, atol=1e-5))
+
+    def test_decode(self):
+        chmm = self._make_chmm()
+        chmm.learn_em_T_Pi_x(self.x, self.a, n_iter=5, term_early=False)
+
+        neg_log2_lik, states = chmm.decode(self.x, self.a)
+        with tempfile.TemporaryDirectory() as path:
+            streaming_neg_log2_lik, streaming_states = chmm.decode_streaming(
+                self._chunks(77), path
+            )
+            self.assertTrue(np.allclose(neg_log2_lik, streaming_neg_log2_lik))
+            self.assertTrue(np.array_equal(states, streaming_states))
+
+
+
+class BlockSparseCHMMTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.x, self.a, self.n_clones = make_sequence()
+
+    def _make_chmm(self, chmm_class):
+        return chmm_class(
+            self.n_clones, self.x, self.a,
+            pseudocount=1e-3, dtype=np.float64, seed=1, verbose=False
+        )
+
+    def test_em(self):
+        block_chmm = self._make_chmm(BlockSparseCHMM)
+        chmm = self._make_chmm(CHMM)
+        # start from the same transitions
+        chmm.T = block_chmm.to_dense()
+
+        convergence = chmm.learn_em_T_Pi_x(self.x, self.a, n_iter=5, term_early=False)
+        block_convergence = block_chmm.learn_em_T_Pi_x(
+            self.x, self.a, n_iter=5, term_early=False
+        )
+
+        self.assertTrue(np.allclose(chmm.T, block_chmm.to_dense(), rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(chmm.Pi_x, block_chmm.Pi_x, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(convergence, block_convergence))
+
+    def test_set_T(self):
+        block_chmm = self._make_chmm(BlockSparseCHMM)
+        T = block_chmm.T.copy()
+
+        dense_T = block_chmm.to_dense()
+        self.assertTrue(np.allclose(dense_T.sum(axis=-1), 1))
+
+        block_chmm.set_T(dense_T)
+        self.assertTrue(np.array_equal(block_chmm.T, T))
+
+        dense_T = np.random.default_rng(0).random(dense_T.shape)
+        block_chmm.set_T(dense_T)
+        self.assertTrue(np.array_equal(
+            block_chmm.to_dense().reshape(-1)[block_chmm.entries],
+            dense_T.reshape(-1)[block_chmm.entries]
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
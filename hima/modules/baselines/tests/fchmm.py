@@ -0,0 +1,151 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import unittest
+import numpy as np
+
+from hima.modules.baselines.hmm import FCHMMLayer
+
+
+class FCHMMLayerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.layer = self._make_layer()
+        self._rng = np.random.default_rng(0)
+
+    @staticmethod
+    def _make_layer(**kwargs):
+        return FCHMMLayer(
+            n_obs_vars=2,
+            n_obs_states=4,
+            cells_per_column=3,
+            n_external_states=3,
+            batch_size=50,
+            em_iterations=10,
+            seed=0,
+            **kwargs
+        )
+
+    def _step(self, learn=True, layer=None, rng=None):
+        if layer is None:
+            layer = self.layer
+        if rng is None:
+            rng = self._rng
+
+        external_messages = np.zeros(layer.external_input_size)
+        external_messages[rng.integers(layer.external_input_size)] = 1
+
+        layer.set_external_messages(external_messages)
+        layer.predict()
+        layer.observe(
+            rng.integers(layer.n_obs_states, size=layer.n_obs_vars)
+            + np.arange(layer.n_obs_vars) * layer.n_obs_states,
+            learn=learn
+        )
+        layer.set_context_messages(layer.internal_forward_messages)
+
+    def test_predict_batch(self):
+        self.layer.reset()
+
+        for _ in range(120):
+            self._step()
+
+        n_actions = self.layer.external_input_size
+        contexts = list()
+        for _ in range(n_actions):
+            self._step(learn=False)
+            contexts.append(self.layer.context_messages.copy())
+
+        # a shared context, a context per row and a soft context
+        soft_context = np.mean(contexts, axis=0)
+        for context_messages in (contexts[-1], np.array(contexts), soft_context):
+            batch_cells, batch_columns = self.layer.predict_batch(
+                context_messages, np.eye(n_actions)
+            )
+
+            for action in range(n_actions):
+                snapshot = self.layer.make_state_snapshot()
+
+                self.layer.set_context_messages(
+                    context_messages if context_messages.ndim == 1 else context_messages[action]
+                )
+                self.layer.set_external_messages(np.eye(n_actions)[action])
+                self.layer.predict()
+
+                self.assertTrue(np.allclose(batch_cells[action], self.layer.prediction_cells))
+                self.assertTrue(
+                    np.allclose(batch_columns[action], self.layer.prediction_columns)
+                )
+
+                self.layer.restore_last_snapshot(snapshot)
+
+    def test_online_em(self):
+        # accumulated counts are rescaled every other batch
+        layer = self._make_layer(em_mode='online', counts_decay=0.5)
+        layer.MIN_COUNTS_SCALE = 0.3
+        # the same layer without rescaling
+        reference_layer = self._make_layer(em_mode='online', counts_decay=0.5)
+        reference_layer.MIN_COUNTS_SCALE = 0.0
+
+        layer.reset()
+        reference_layer.reset()
+        rescaled = False
+        for _ in range(6):
+            seed = self._rng.integers(1000)
+            rng, reference_rng = np.random.default_rng(seed), np.random.default_rng(seed)
+            for _ in range(layer.batch_size):
+                self._step(layer=layer, rng=rng)
+                self._step(layer=reference_layer, rng=reference_rng)
+
+            rescaled |= layer.counts_scale == 1.0
+
+            self.assertTrue(np.allclose(
+                layer.transition_row_counts,
+                layer.transition_counts.sum(axis=-1).reshape(layer.n_hidden_vars, -1)
+            ))
+            self.assertTrue(np.allclose(layer.transition_probs.sum(axis=-1), 1))
+            self.assertTrue(np.allclose(layer.state_prior.sum(axis=-1), 1))
+
+            # rescaling doesn't change counts
+            self.assertTrue(np.allclose(
+                layer.transition_counts * layer.counts_scale,
+                reference_layer.transition_counts * reference_layer.counts_scale
+            ))
+            self.assertTrue(np.allclose(
+                layer.state_prior_counts * layer.counts_scale,
+                reference_layer.state_prior_counts * reference_layer.counts_scale
+            ))
+            self.assertTrue(np.allclose(
+                layer.transition_probs, reference_layer.transition_probs
+            ))
+
+        self.assertTrue(rescaled)
+        self.assertLess(reference_layer.counts_scale, layer.MIN_COUNTS_SCALE)
+
+    def test_em_workers(self):
+        # workers are spawned, they import this module as non-main
+        layer = self._make_layer(em_workers=2)
+        reference_layer = self._make_layer(em_workers=0)
+
+        layer.reset()
+        reference_layer.reset()
+        for _ in range(2):
+            seed = self._rng.integers(1000)
+            rng, reference_rng = np.random.default_rng(seed), np.random.default_rng(seed)
+            for _ in range(layer.batch_size):
+                self._step(layer=layer, rng=rng)
+                self._step(layer=reference_layer, rng=reference_rng)
+
+            self.assertTrue(np.array_equal(
+                layer.transition_probs, reference_layer.transition_probs
+            ))
+            self.assertTrue(np.array_equal(layer.state_prior, reference_layer.state_prior))
+
+    def test_online_em_workers(self):
+        with self.assertRaises(ValueError):
+            self._make_layer(em_mode='online', em_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
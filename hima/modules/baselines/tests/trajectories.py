@@ -0,0 +1,114 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import unittest
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from hima.modules.baselines.lstm import (
+    LstmLayer, pad_trajectories, unroll_trajectories, train_trajectory_batch
+)
+from hima.modules.baselines.rwkv import RwkvLayer
+
+
+class TrajectoriesTest(unittest.TestCase):
+    layer_classes = (LstmLayer, RwkvLayer)
+
+    @staticmethod
+    def _make_layer(layer_class):
+        return layer_class(
+            n_obs_vars=3,
+            n_obs_states=5,
+            n_hidden_vars=4,
+            n_hidden_states=6,
+            n_external_vars=1,
+            n_external_states=4,
+            seed=0
+        )
+
+    @staticmethod
+    def _make_trajectories(layer, n_trajectories):
+        rng = np.random.default_rng(0)
+        trajectories = list()
+        for _ in range(n_trajectories):
+            length = rng.integers(1, 20)
+            observations = np.zeros((length, layer.input_size), dtype=np.float32)
+            for var in range(layer.n_obs_vars):
+                observations[
+                    np.arange(length),
+                    var * layer.n_obs_states + rng.integers(layer.n_obs_states, size=length)
+                ] = 1
+            actions = np.zeros((length, layer.external_input_size), dtype=np.float32)
+            actions[np.arange(length), rng.integers(layer.external_input_size, size=length)] = 1
+            trajectories.append((torch.from_numpy(observations), torch.from_numpy(actions)))
+        return trajectories
+
+    @staticmethod
+    def _loop_loss(layer, trajectories):
+        """Sum of losses of trajectories stepped one by one."""
+        loss, n_steps = 0, 0
+        for observations, actions in trajectories:
+            state = layer.model.get_init_state()
+            for t in range(len(observations)):
+                state = layer.transition_with_action(actions[t], state)
+                loss = loss + layer.get_loss(layer.decode_obs(state), observations[t])
+                n_steps += 1
+                state = layer.transition_with_observation(observations[t], state)
+        return loss, n_steps
+
+    def test_unroll_trajectories(self):
+        for layer_class in self.layer_classes:
+            with self.subTest(layer=layer_class.__name__):
+                layer = self._make_layer(layer_class)
+                trajectories = self._make_trajectories(layer, 10)
+                parameters = list(layer.model.parameters())
+
+                loss, n_steps, _ = unroll_trajectories(
+                    layer, *pad_trajectories(trajectories),
+                    layer.model.get_init_state(len(trajectories))
+                )
+                loop_loss, loop_n_steps = self._loop_loss(layer, trajectories)
+
+                self.assertEqual(n_steps, loop_n_steps)
+                self.assertTrue(torch.allclose(loss, loop_loss, rtol=1e-5))
+
+                gradients = torch.autograd.grad(loss, parameters, allow_unused=True)
+                loop_gradients = torch.autograd.grad(loop_loss, parameters, allow_unused=True)
+                for gradient, loop_gradient in zip(gradients, loop_gradients):
+                    self.assertEqual(gradient is None, loop_gradient is None)
+                    if gradient is not None:
+                        self.assertTrue(
+                            torch.allclose(gradient, loop_gradient, rtol=1e-4, atol=1e-6)
+                        )
+
+    def test_train_trajectory_batch(self):
+        for layer_class in self.layer_classes:
+            with self.subTest(layer=layer_class.__name__):
+                layer = self._make_layer(layer_class)
+                loop_layer = deepcopy(layer)
+                trajectories = self._make_trajectories(layer, 10)
+
+                # a single optimizer step over whole trajectories
+                layer.optimizer = torch.optim.SGD(layer.model.parameters(), lr=0.1)
+                loss, n_steps = train_trajectory_batch(layer, *pad_trajectories(trajectories))
+
+                loop_layer.optimizer = torch.optim.SGD(loop_layer.model.parameters(), lr=0.1)
+                loop_loss, loop_n_steps = self._loop_loss(loop_layer, trajectories)
+                loop_layer.optimizer.zero_grad()
+                (loop_loss / loop_n_steps).backward()
+                loop_layer.optimizer.step()
+
+                self.assertEqual(n_steps, loop_n_steps)
+                self.assertAlmostEqual(loss, loop_loss.item(), places=3)
+                for parameter, loop_parameter in zip(
+                        layer.model.parameters(), loop_layer.model.parameters()
+                ):
+                    self.assertTrue(torch.allclose(parameter, loop_parameter, atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
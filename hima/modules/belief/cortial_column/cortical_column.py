@@ -90,6 +90,13 @@ class CorticalColumn:
         else:
             self.predicted_image = self.layer.prediction_columns
 
+    def predict_batch(self, context_messages, external_messages):
+        """
+            Predict for a batch of external messages at once without changing the state.
+            Returns (prediction_cells, prediction_columns) with batch as the first axis.
+        """
+        return self.layer.predict_batch(context_messages, external_messages)
+
     def reset(self, context_messages, external_messages):
         self.layer.reset()
         self.layer.set_context_messages(context_messages)
@@ -113,3 +120,11 @@ class CorticalColumn:
         ) = snapshot
 
         self.layer.restore_last_snapshot(layer_snapshot)
+
+    def release_snapshot(self, snapshot):
+        """Notify the layer that the snapshot won't be restored anymore."""
+        if snapshot is None or not hasattr(self.layer, 'release_snapshot'):
+            return
+
+        layer_snapshot, _ = snapshot
+        self.layer.release_snapshot(layer_snapshot)
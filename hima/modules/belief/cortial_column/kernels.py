@@ -0,0 +1,118 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+import numpy as np
+import numba as nb
+
+
+@nb.njit
+def propagate_belief(
+        messages,
+        active_segments,
+        cells_for_segments,
+        factors_for_segments,
+        receptive_fields,
+        synapse_efficiency,
+        log_factor_values_per_segment,
+        n_hidden_vars,
+        n_hidden_states,
+        inverse_temperature,
+        eps
+):
+    """
+        Compiled equivalent of Layer._propagate_belief for active segments.
+        Segment likelihood, max over segments of a factor, sum over factors of a cell
+        and normalization within hidden variables are done in one pass
+        over segments sorted by (cell, factor).
+            returns next messages for internal cells
+    """
+    n_cells = n_hidden_vars * n_hidden_states
+    n_synapses = receptive_fields.shape[1]
+
+    log_next_messages = np.full(n_cells, -np.inf)
+
+    if len(active_segments) > 0:
+        n_factor_ids = factors_for_segments.max() + 1
+        keys = cells_for_segments.astype(np.int64) * n_factor_ids + factors_for_segments
+        order = np.argsort(keys)
+
+        current_cell = -1
+        current_key = -1
+        factor_excitation = -np.inf
+        cell_excitation = 0.0
+
+        for i in order:
+            segment = active_segments[i]
+
+            # segment likelihood
+            dependent_part = 0.0
+            efficiency_sum = 0.0
+            independent_part = 0.0
+            for j in range(n_synapses):
+                message = messages[receptive_fields[segment, j]]
+                efficiency = synapse_efficiency[segment, j]
+
+                dependent_part += message * efficiency
+                efficiency_sum += efficiency
+                independent_part += (1 - efficiency) * np.log(message)
+
+            excitation = (
+                efficiency_sum / n_synapses * np.log(dependent_part / n_synapses + eps)
+                + independent_part
+                + log_factor_values_per_segment[segment]
+            )
+
+            key = keys[i]
+            if key != current_key:
+                # previous factor is complete
+                if current_key != -1:
+                    cell_excitation += factor_excitation
+
+                cell = cells_for_segments[i]
+                if cell != current_cell:
+                    # previous cell is complete
+                    if current_cell != -1 and cell_excitation >= -100:
+                        log_next_messages[current_cell] = cell_excitation
+
+                    current_cell = cell
+                    cell_excitation = 0.0
+
+                current_key = key
+                factor_excitation = excitation
+            elif excitation > factor_excitation:
+                # approximate log sum with max
+                factor_excitation = excitation
+
+        cell_excitation += factor_excitation
+        if cell_excitation >= -100:
+            log_next_messages[current_cell] = cell_excitation
+
+    next_messages = np.empty(n_cells)
+
+    for var in range(n_hidden_vars):
+        start = var * n_hidden_states
+        end = start + n_hidden_states
+
+        # shift log value for stability
+        total = 0.0
+        count = 0
+        for cell in range(start, end):
+            if np.isfinite(log_next_messages[cell]):
+                total += log_next_messages[cell]
+                count += 1
+        mean = total / count if count > 0 else 0.0
+
+        norm = 0.0
+        for cell in range(start, end):
+            value = np.exp(inverse_temperature * (log_next_messages[cell] - mean))
+            next_messages[cell] = value
+            norm += value
+
+        if norm == 0:
+            next_messages[start:end] = 1 / n_hidden_states
+        else:
+            next_messages[start:end] /= norm
+
+    return next_messages
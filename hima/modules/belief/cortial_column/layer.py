@@ -9,8 +9,10 @@ import matplotlib.pyplot as plt
 
 from hima.modules.htm.connections import Connections
 from hima.modules.belief.utils import softmax, normalize, sample_categorical_variables
-from hima.modules.belief.utils import EPS, INT_TYPE, UINT_DTYPE, REAL_DTYPE, REAL64_DTYPE
+from hima.modules.belief.utils import EPS, INT_TYPE, UINT_DTYPE, REAL64_DTYPE
+from hima.modules.belief.cortial_column import kernels
 from hima.common.sdr import sparse_to_dense
+from hima.common.checkpoint import save_object, load_object
 
 from htm.bindings.sdr import SDR
 from htm.bindings.math import Random
@@ -18,11 +20,26 @@ from htm.bindings.math import Random
 from scipy.stats import entropy
 import numpy as np
 import warnings
+import heapq
+from copy import copy, deepcopy
+from itertools import chain
 import pygraphviz as pgv
 import colormap
 
 
 class Factors:
+    MIN_SEGMENTS_CAPACITY = 1024
+    # activity is renormalized when its common scale gets this small
+    MIN_ACTIVITY_SCALE = 1e-10
+    SEGMENT_ARRAYS = (
+        'receptive_fields',
+        'synapse_efficiency',
+        'log_factor_values_per_segment',
+        'segment_activity',
+        'factor_for_segment',
+        'is_segment_in_use'
+    )
+
     def __init__(
             self,
             n_cells,
@@ -41,9 +58,12 @@ class Factors:
             fraction_of_segments_to_prune,
             max_segments_per_cell,
             min_log_factor_value=-1,
+            dtype=REAL64_DTYPE,
     ):
         """
             hidden vars are those that we predict, or output vars
+            max_segments: if None, the number of segments is not limited
+            dtype: floating point type of segment parameters
         """
         self.fraction_of_segments_to_prune = fraction_of_segments_to_prune
         self.max_segments = max_segments
@@ -61,6 +81,9 @@ class Factors:
         self.n_hidden_states = n_hidden_states
         self.max_factors = n_hidden_vars * max_factors_per_var
         self.max_segments_per_cell = max_segments_per_cell
+        self.dtype = dtype
+        # EPS may underflow in low precision
+        self.eps = max(EPS, np.finfo(dtype).tiny)
 
         self.connections = Connections(
             numCells=n_cells,
@@ -72,115 +95,335 @@ class Factors:
             connectedThreshold=0.5
         )
 
-        self.receptive_fields = np.full(
-            (max_segments, n_vars_per_factor),
-            fill_value=-1,
-            dtype=INT_TYPE
-        )
-
-        self.synapse_efficiency = np.full(
-            (max_segments, n_vars_per_factor),
-            fill_value=self.initial_synapse_value,
-            dtype=REAL64_DTYPE
+        # per-segment arrays are indexed by segment id and grow on demand
+        self.segments_capacity = 0
+        self.receptive_fields = np.empty((0, n_vars_per_factor), dtype=INT_TYPE)
+        self.synapse_efficiency = np.empty((0, n_vars_per_factor), dtype=dtype)
+        self.log_factor_values_per_segment = np.empty(0, dtype=dtype)
+        self.segment_activity = np.empty(0, dtype=dtype)
+        self.factor_for_segment = np.empty(0, dtype=INT_TYPE)
+        self.is_segment_in_use = np.empty(0, dtype=bool)
+
+        # segment_activity is stored divided by the common scale,
+        # so decay of all segments is a single multiplication of the scale
+        self.activity_scale = 1.0
+
+        self._ensure_capacity(
+            self.MIN_SEGMENTS_CAPACITY if max_segments is None
+            else min(max_segments, self.MIN_SEGMENTS_CAPACITY)
         )
 
-        self.log_factor_values_per_segment = np.full(
-            max_segments,
-            fill_value=initial_log_factor_value,
-            dtype=REAL64_DTYPE
-        )
+        # inverted index: cell -> segments that have a synapse from the cell
+        self.segments_for_cell = [set() for _ in range(n_cells)]
 
-        self.segment_activity = np.ones(
-            max_segments,
-            dtype=REAL64_DTYPE
-        )
+        # incremental segment activity trackers, one for every input channel
+        self.segment_activity_trackers = dict()
 
-        self.factor_for_segment = np.full(
-            max_segments,
+        self.factor_vars = np.full(
+            (self.max_factors, n_vars_per_factor),
             fill_value=-1,
             dtype=INT_TYPE
         )
 
-        self.factor_vars = np.full(
-            (self.max_factors, n_vars_per_factor),
+        self.var_for_factor = np.full(
+            self.max_factors,
             fill_value=-1,
             dtype=INT_TYPE
         )
 
         self.var_score = np.ones(
             n_vars,
-            dtype=REAL64_DTYPE
+            dtype=dtype
+        )
+
+        # number of factors in use that include the variable
+        self.var_usage = np.zeros(
+            n_vars,
+            dtype=INT_TYPE
         )
 
         self.segments_in_use = np.empty(0, dtype=UINT_DTYPE)
         self.factors_in_use = np.empty(0, dtype=UINT_DTYPE)
-        self.factor_score = np.empty(0, dtype=REAL_DTYPE)
+        self.factor_score = np.empty(0, dtype=dtype)
 
-    def update_factor_score(self):
-        # sum factor values for every factor
-        if len(self.segments_in_use) > 0:
-            factor_for_segment = self.factor_for_segment[self.segments_in_use]
-            log_factor_values = self.log_factor_values_per_segment[self.segments_in_use]
-            segment_activation_freq = self.segment_activity[self.segments_in_use]
-
-            sort_ind = np.argsort(factor_for_segment)
-            factors_sorted = factor_for_segment[sort_ind]
-            segments_sorted_values = log_factor_values[sort_ind]
-            segments_sorted_freq = segment_activation_freq[sort_ind]
-
-            factors_with_segments, split_ind, counts = np.unique(
-                factors_sorted,
-                return_index=True,
-                return_counts=True
+        # running sums of segment scores (in units of activity_scale)
+        # and number of segments for every factor
+        self.factor_score_sums = np.zeros(self.max_factors, dtype=REAL64_DTYPE)
+        self.factor_segment_counts = np.zeros(self.max_factors, dtype=INT_TYPE)
+
+        # min-heap of (score, segment) for pruning, entries are invalidated lazily
+        self.prune_heap = []
+
+    def _ensure_capacity(self, n_segments):
+        if n_segments <= self.segments_capacity:
+            return
+
+        capacity = max(n_segments, 2 * self.segments_capacity)
+        n_new = capacity - self.segments_capacity
+
+        self.receptive_fields = np.concatenate([
+            self.receptive_fields,
+            np.full((n_new, self.n_vars_per_factor), fill_value=-1, dtype=INT_TYPE)
+        ])
+        self.synapse_efficiency = np.concatenate([
+            self.synapse_efficiency,
+            np.full(
+                (n_new, self.n_vars_per_factor),
+                fill_value=self.initial_synapse_value,
+                dtype=self.dtype
             )
+        ])
+        self.log_factor_values_per_segment = np.concatenate([
+            self.log_factor_values_per_segment,
+            np.full(n_new, fill_value=self.initial_log_factor_value, dtype=self.dtype)
+        ])
+        self.segment_activity = np.concatenate([
+            self.segment_activity,
+            np.ones(n_new, dtype=self.dtype)
+        ])
+        self.factor_for_segment = np.concatenate([
+            self.factor_for_segment,
+            np.full(n_new, fill_value=-1, dtype=INT_TYPE)
+        ])
+        self.is_segment_in_use = np.concatenate([
+            self.is_segment_in_use,
+            np.zeros(n_new, dtype=bool)
+        ])
+
+        self.segments_capacity = capacity
+
+    def add_factor(self, var, variables, rng):
+        """
+            Create a factor for the hidden variable over the variables.
+            returns id of the new factor
+        """
+        factor_id = self.factor_connections.createSegment(
+            var,
+            maxSegmentsPerCell=self.max_factors_per_var
+        )
+
+        self.factor_connections.growSynapses(
+            factor_id,
+            variables,
+            0.6,
+            rng,
+            maxNew=self.n_vars_per_factor
+        )
 
-            score = np.exp(segments_sorted_values) * segments_sorted_freq
-            factor_score = np.add.reduceat(score, split_ind) / counts
+        self.factor_vars[factor_id] = variables
+        self.var_for_factor[factor_id] = var
+        self.factors_in_use = np.append(self.factors_in_use, factor_id)
+        self.var_usage[variables] += 1
+
+        return factor_id
+
+    def add_segment(self, cell, factor_id, presynaptic_cells, rng):
+        """
+            Create a segment on the cell that belongs to the factor and
+            grow synapses from presynaptic cells.
+            returns id of the new segment
+        """
+        segment = self.connections.createSegment(cell, self.max_segments_per_cell)
+
+        self.connections.growSynapses(
+            segment,
+            presynaptic_cells,
+            0.6,
+            rng,
+            maxNew=self.n_vars_per_factor
+        )
+
+        self._ensure_capacity(segment + 1)
+
+        # segment ids are reused, so reset all segment's parameters
+        self.factor_for_segment[segment] = factor_id
+        self.log_factor_values_per_segment[segment] = self.initial_log_factor_value
+        self.synapse_efficiency[segment] = self.initial_synapse_value
+        self.segment_activity[segment] = 1 / self.activity_scale
+        self.receptive_fields[segment] = presynaptic_cells
+        self.is_segment_in_use[segment] = True
+
+        score = self._segment_scores(segment)
+        self.factor_score_sums[factor_id] += score
+        self.factor_segment_counts[factor_id] += 1
+        heapq.heappush(self.prune_heap, (float(score), int(segment)))
+
+        for presynaptic_cell in presynaptic_cells:
+            self.segments_for_cell[presynaptic_cell].add(segment)
+
+        for tracker in self.segment_activity_trackers.values():
+            tracker.add_segment(segment, presynaptic_cells)
+
+        return segment
+
+    def get_active_segments(self, active_cells, channel='default'):
+        """
+            Segments that have at least n_vars_per_factor active presynaptic cells.
+            Activity is tracked incrementally and separately for every channel,
+            so calls within a channel should have slowly changing active cells.
+        """
+        tracker = self.segment_activity_trackers.get(channel)
+
+        if tracker is None:
+            tracker = SegmentActivity(self)
+            self.segment_activity_trackers[channel] = tracker
+
+        return tracker.compute(active_cells)
+
+    def segments_for_cells(self, cells):
+        """Segments that have a synapse from at least one of the cells."""
+        segments = set().union(*(self.segments_for_cell[cell] for cell in cells))
+        return np.fromiter(segments, dtype=UINT_DTYPE, count=len(segments))
+
+    def planning_copy(self):
+        """
+            Copy that can compute active segments on another thread.
+            Segment tables and connections are shared and must not change meanwhile,
+            only activity trackers are separate.
+        """
+        factors = copy(self)
+        factors.segment_activity_trackers = dict()
+        return factors
+
+    def save(self, path):
+        """
+            Save factors to the directory: segment tables as .npy files,
+            the rest including Connections is pickled.
+        """
+        save_object(
+            self, path,
+            arrays=self.SEGMENT_ARRAYS,
+            skip=('segments_for_cell', 'segment_activity_trackers')
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        factors = load_object(cls, path, mmap_mode=mmap_mode)
+
+        # rebuild inverted index and trackers
+        factors.segments_for_cell = [set() for _ in range(factors.n_cells)]
+        for segment in factors.segments_in_use:
+            for cell in factors.receptive_fields[segment]:
+                factors.segments_for_cell[cell].add(segment)
+
+        factors.segment_activity_trackers = dict()
+        return factors
+
+    def update_factor_score(self):
+        factors_with_segments = np.flatnonzero(self.factor_segment_counts > 0)
+
+        if len(factors_with_segments) > 0:
+            factor_score = self.activity_scale * (
+                self.factor_score_sums[factors_with_segments]
+                / self.factor_segment_counts[factors_with_segments]
+            )
 
             # destroy factors without segments
-            mask = np.isin(self.factors_in_use, factors_with_segments, invert=True)
-            factors_without_segments = self.factors_in_use[mask]
+            factors_without_segments = self.factors_in_use[
+                self.factor_segment_counts[self.factors_in_use] == 0
+            ]
 
             for factor in factors_without_segments:
                 self.factor_connections.destroySegment(factor)
                 self.factor_vars[factor] = np.full(self.n_vars_per_factor, fill_value=-1)
-
-            self.factors_in_use = factors_with_segments.copy()
-            self.factor_score = factor_score
+                self.var_for_factor[factor] = -1
+                # remove accumulated rounding errors
+                self.factor_score_sums[factor] = 0
+
+            self.factors_in_use = factors_with_segments
+
+            used_vars = self.factor_vars[self.factors_in_use].flatten()
+            self.var_usage = np.bincount(
+                used_vars[used_vars >= 0],
+                minlength=self.n_vars
+            ).astype(INT_TYPE)
+            self.factor_score = factor_score.astype(self.dtype)
         else:
             self.factor_score = np.empty(0)
-    
+
     def prune_segments(self, n_segments):
-        log_value = self.log_factor_values_per_segment[self.segments_in_use]
-        activity = self.segment_activity[self.segments_in_use]
+        """
+            Destroy n_segments with the least score, i.e. factor value times activity.
+            Stale heap entries are skipped when popped.
+        """
+        segments_to_prune = list()
+        pruned = set()
 
-        score = (
-                np.exp(log_value) * activity
-        )
+        while len(segments_to_prune) < n_segments and len(self.prune_heap) > 0:
+            score, segment = heapq.heappop(self.prune_heap)
 
-        segments_to_prune = self.segments_in_use[
-            np.argpartition(score, n_segments)[:n_segments]
-        ]
+            if (
+                    self.is_segment_in_use[segment]
+                    and segment not in pruned
+                    and score == self._segment_scores(segment)
+            ):
+                segments_to_prune.append(segment)
+                pruned.add(segment)
 
+        segments_to_prune = np.array(segments_to_prune, dtype=INT_TYPE)
         self._destroy_segments(segments_to_prune)
 
         return segments_to_prune
 
+    def _segment_scores(self, segments):
+        """Segment scores in units of activity_scale."""
+        return np.exp(
+            self.log_factor_values_per_segment[segments].astype(REAL64_DTYPE)
+        ) * self.segment_activity[segments]
+
+    def _rebuild_factor_score_sums(self):
+        segments = self.segments_in_use
+        factors = self.factor_for_segment[segments]
+
+        self.factor_score_sums[:] = 0
+        np.add.at(self.factor_score_sums, factors, self._segment_scores(segments))
+        self.factor_segment_counts = np.bincount(
+            factors, minlength=self.max_factors
+        ).astype(INT_TYPE)
+
+    def _rebuild_prune_heap(self):
+        segments = self.segments_in_use
+        self.prune_heap = list(zip(
+            self._segment_scores(segments).tolist(), segments.tolist()
+        ))
+        heapq.heapify(self.prune_heap)
+
     def _destroy_segments(self, segments):
-        filter_destroyed_segments = np.isin(
-            self.segments_in_use, segments, invert=True
-        )
-        self.segments_in_use = self.segments_in_use[filter_destroyed_segments]
+        segments = np.unique(segments)
+        segments = segments[self.is_segment_in_use[segments]]
+
+        if len(segments) == 0:
+            return
+
+        self.is_segment_in_use[segments] = False
+        self.segments_in_use = self.segments_in_use[
+            self.is_segment_in_use[self.segments_in_use]
+        ]
+
+        factors = self.factor_for_segment[segments]
+        np.subtract.at(self.factor_score_sums, factors, self._segment_scores(segments))
+        np.subtract.at(self.factor_segment_counts, factors, 1)
 
         for segment in segments:
             self.connections.destroySegment(segment)
 
+            for presynaptic_cell in self.receptive_fields[segment]:
+                self.segments_for_cell[presynaptic_cell].discard(segment)
+
+        for tracker in self.segment_activity_trackers.values():
+            tracker.destroy_segments(segments)
+
     def update_factors(
             self,
             segments_to_reinforce,
             segments_to_punish,
             prune=False,
     ):
+        active_segments = np.concatenate([segments_to_reinforce, segments_to_punish])
+        changed_segments = np.unique(active_segments)
+        changed_segments = changed_segments[self.is_segment_in_use[changed_segments]]
+        old_scores = self._segment_scores(changed_segments)
+
         w = self.log_factor_values_per_segment[segments_to_reinforce]
         self.log_factor_values_per_segment[
             segments_to_reinforce
@@ -190,18 +433,31 @@ class Factors:
             segments_to_punish
         ] += np.log1p(-self.factor_lr)
 
-        active_segments = np.concatenate([segments_to_reinforce, segments_to_punish])
-        non_active_segments = self.segments_in_use[
-            np.isin(self.segments_in_use, active_segments, invert=True)
-        ]
-
-        self.segment_activity[active_segments] += self.segment_activity_lr * (
-                1 - self.segment_activity[active_segments]
-        )
-        self.segment_activity[non_active_segments] -= (
-                self.segment_activity_lr * self.segment_activity[non_active_segments]
+        # all segments decay: a -= lr * a, which only changes the common scale,
+        # and active segments also increase: a + lr * (1 - a) = (1 - lr) * a + lr
+        self.activity_scale *= 1 - self.segment_activity_lr
+        self.segment_activity[changed_segments] += (
+                self.segment_activity_lr / self.activity_scale
         )
 
+        if self.activity_scale < self.MIN_ACTIVITY_SCALE:
+            self.segment_activity[self.segments_in_use] *= self.activity_scale
+            self.activity_scale = 1.0
+            self._rebuild_factor_score_sums()
+            self._rebuild_prune_heap()
+        else:
+            new_scores = self._segment_scores(changed_segments)
+            np.add.at(
+                self.factor_score_sums,
+                self.factor_for_segment[changed_segments],
+                new_scores - old_scores
+            )
+            for score, segment in zip(new_scores.tolist(), changed_segments.tolist()):
+                heapq.heappush(self.prune_heap, (score, segment))
+
+            if len(self.prune_heap) > 2 * len(self.segments_in_use) + self.MIN_SEGMENTS_CAPACITY:
+                self._rebuild_prune_heap()
+
         w = self.log_factor_values_per_segment[active_segments]
         self._destroy_segments(active_segments[w < self.min_log_factor_value])
 
@@ -217,39 +473,118 @@ class Factors:
             active_segments,
             active_cells
     ):
-        active_synapses_dense = np.isin(
-            self.receptive_fields,
+        # only segments with synapses from active cells are changed
+        segments = self.segments_for_cells(active_cells)
+
+        if len(segments) == 0:
+            return
+
+        active_synapses = np.isin(
+            self.receptive_fields[segments],
             active_cells
-        ).astype(REAL64_DTYPE)
+        ).astype(self.dtype)
 
-        active_segments_dense = np.zeros(self.receptive_fields.shape[0])
-        active_segments_dense[active_segments] = 1
+        is_active_segment = np.isin(segments, active_segments).astype(self.dtype)
 
-        delta = active_segments_dense.reshape((-1, 1)) - self.synapse_efficiency
-        delta *= active_synapses_dense
+        delta = is_active_segment.reshape((-1, 1)) - self.synapse_efficiency[segments]
+        delta *= active_synapses
 
-        self.synapse_efficiency += self.synapse_lr * delta
+        self.synapse_efficiency[segments] += self.synapse_lr * delta
 
     def calculate_segment_likelihood(
             self,
             messages,
             active_segments
     ):
-        messages = messages[self.receptive_fields[active_segments]]
+        # works both for a single message vector and for a batch of them
+        messages = messages[..., self.receptive_fields[active_segments]]
         synapse_efficiency = self.synapse_efficiency[active_segments]
 
         dependent_part = messages * synapse_efficiency
         dependent_part = np.mean(synapse_efficiency, axis=-1) * np.log(
-            np.mean(dependent_part, axis=-1) + EPS
+            np.mean(dependent_part, axis=-1) + self.eps
         )
 
-        independent_part = np.sum((1 - synapse_efficiency) * np.log(messages), axis=-1)
+        independent_part = np.sum(
+            (1 - synapse_efficiency) * np.log(np.maximum(messages, self.eps)),
+            axis=-1
+        )
 
         log_likelihood = dependent_part + independent_part
 
         return log_likelihood
 
 
+class SegmentActivity:
+    """
+        Keeps the number of active presynaptic cells for every segment of factors
+        and updates it incrementally with cells that changed their activity.
+    """
+    def __init__(self, factors: Factors):
+        self.factors = factors
+        self.threshold = factors.n_vars_per_factor
+
+        self.active_cells = np.empty(0, dtype=INT_TYPE)
+        self.overlap = np.zeros(factors.segments_capacity, dtype=INT_TYPE)
+        self.active_segments = set()
+
+    def compute(self, active_cells):
+        """
+            active_cells: cells that are active now
+            returns sorted segments with at least n_vars_per_factor active presynaptic cells
+        """
+        active_cells = np.unique(active_cells).astype(INT_TYPE)
+
+        cells_on = np.setdiff1d(active_cells, self.active_cells, assume_unique=True)
+        cells_off = np.setdiff1d(self.active_cells, active_cells, assume_unique=True)
+        self.active_cells = active_cells
+
+        if len(cells_on) > 0 or len(cells_off) > 0:
+            self._ensure_capacity()
+
+            segments_on = self._segments_for_cells(cells_on)
+            segments_off = self._segments_for_cells(cells_off)
+
+            np.add.at(self.overlap, segments_on, 1)
+            np.subtract.at(self.overlap, segments_off, 1)
+
+            changed_segments = np.union1d(segments_on, segments_off)
+            is_active = self.overlap[changed_segments] >= self.threshold
+
+            self.active_segments.update(changed_segments[is_active])
+            self.active_segments.difference_update(changed_segments[~is_active])
+
+        return np.sort(
+            np.fromiter(self.active_segments, dtype=INT_TYPE, count=len(self.active_segments))
+        )
+
+    def add_segment(self, segment, presynaptic_cells):
+        self._ensure_capacity()
+
+        self.overlap[segment] = np.count_nonzero(
+            np.isin(presynaptic_cells, self.active_cells)
+        )
+
+        if self.overlap[segment] >= self.threshold:
+            self.active_segments.add(segment)
+
+    def destroy_segments(self, segments):
+        self.overlap[segments] = 0
+        self.active_segments.difference_update(segments)
+
+    def _segments_for_cells(self, cells):
+        # segments are repeated for every active presynaptic cell
+        return np.fromiter(
+            chain.from_iterable(self.factors.segments_for_cell[cell] for cell in cells),
+            dtype=INT_TYPE
+        )
+
+    def _ensure_capacity(self):
+        n_new = self.factors.segments_capacity - len(self.overlap)
+        if n_new > 0:
+            self.overlap = np.concatenate([self.overlap, np.zeros(n_new, dtype=INT_TYPE)])
+
+
 class Layer:
     """
         This class represents a layer of the neocortex model.
@@ -281,8 +616,17 @@ class Layer:
             replace_prior: bool = False,
             bursting_threshold: float = EPS,
             override_context: bool = True,
+            backend: str = 'numpy',
+            batched_growth: bool = False,
+            dtype: str = REAL64_DTYPE,
             seed: int = None,
     ):
+        """
+            backend: 'numpy' or 'numba', implementation of belief propagation
+            batched_growth: sample factors and receptive fields for all new segments at once
+            dtype: floating point type of messages and segment parameters,
+                it's used for both inference and learning
+        """
         self._rng = np.random.default_rng(seed)
 
         if seed:
@@ -308,6 +652,12 @@ class Layer:
         self.bursting_threshold = bursting_threshold
         self.override_context = override_context
 
+        if backend not in ('numpy', 'numba'):
+            raise ValueError(f'Unknown backend: {backend}')
+        self.backend = backend
+        self.batched_growth = batched_growth
+        self.dtype = dtype
+
         self.cells_per_column = cells_per_column
         self.n_hidden_states = cells_per_column * n_obs_states
 
@@ -348,21 +698,26 @@ class Layer:
 
         self.internal_forward_messages = np.zeros(
             self.internal_cells,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
         self.external_messages = np.zeros(
             self.external_input_size,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
         self.context_messages = np.zeros(
             self.context_input_size,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
 
         self.internal_cells_activity = np.zeros_like(
             self.internal_forward_messages
         )
 
+        # reusable buffers to avoid allocations in predict and snapshots
+        self._messages_buffer = np.zeros(self.total_cells, dtype=self.dtype)
+        self._log_messages_buffer = np.zeros(self.internal_cells, dtype=self.dtype)
+        self._snapshot_buffers = list()
+
         self.prediction_cells = None
         self.prediction_columns = None
         self.observation_messages = None
@@ -382,6 +737,24 @@ class Layer:
             self.context_cells_range[1] + self.external_input_size
         )
 
+        # variable for every cell
+        self.var_for_cell = np.concatenate(
+            [
+                np.repeat(
+                    np.arange(self.n_hidden_vars),
+                    self.n_hidden_states
+                ),
+                self.n_hidden_vars + np.repeat(
+                    np.arange(self.n_context_vars),
+                    self.n_context_states
+                ),
+                self.n_hidden_vars + self.n_context_vars + np.repeat(
+                    np.arange(self.n_external_vars),
+                    self.n_external_states
+                )
+            ]
+        ).astype(UINT_DTYPE)
+
         self.enable_context_connections = enable_context_connections
         self.enable_internal_connections = enable_internal_connections
 
@@ -390,6 +763,7 @@ class Layer:
             context_factors_conf['n_vars'] = self.total_vars
             context_factors_conf['n_hidden_states'] = self.n_hidden_states
             context_factors_conf['n_hidden_vars'] = self.n_hidden_vars
+            context_factors_conf['dtype'] = self.dtype
             self.context_factors = Factors(**context_factors_conf)
         else:
             self.context_factors = None
@@ -403,6 +777,7 @@ class Layer:
             internal_factors_conf['n_vars'] = self.total_vars
             internal_factors_conf['n_hidden_states'] = self.n_hidden_states
             internal_factors_conf['n_hidden_vars'] = self.n_hidden_vars
+            internal_factors_conf['dtype'] = self.dtype
             self.internal_factors = Factors(**internal_factors_conf)
         else:
             self.internal_factors = None
@@ -413,25 +788,32 @@ class Layer:
     def set_external_messages(self, messages=None):
         # update external cells
         if messages is not None:
-            self.external_messages = messages
+            self.external_messages = np.asarray(messages, dtype=self.dtype)
         elif self.external_input_size != 0:
             self.external_messages = normalize(
-                np.zeros(self.external_input_size).reshape((self.n_external_vars, -1))
+                np.zeros(self.external_input_size, dtype=self.dtype).reshape((self.n_external_vars, -1))
             ).flatten()
 
     def set_context_messages(self, messages=None):
         # update external cells
         if messages is not None:
-            self.context_messages = messages
+            self.context_messages = np.asarray(messages, dtype=self.dtype)
         elif self.context_input_size != 0:
             self.context_messages = normalize(
-                np.zeros(self.context_input_size).reshape((self.n_context_vars, -1))
+                np.zeros(self.context_input_size, dtype=self.dtype).reshape((self.n_context_vars, -1))
             ).flatten()
 
     def make_state_snapshot(self):
+        if len(self._snapshot_buffers) > 0:
+            internal_forward_messages = self._snapshot_buffers.pop()
+        else:
+            internal_forward_messages = np.empty_like(self.internal_forward_messages)
+
+        np.copyto(internal_forward_messages, self.internal_forward_messages)
+
         return (
             # mutable attributes:
-            self.internal_forward_messages.copy(),
+            internal_forward_messages,
             # immutable attributes:
             self.external_messages,
             self.context_messages,
@@ -444,28 +826,81 @@ class Layer:
             return
 
         (
-            self.internal_forward_messages,
+            internal_forward_messages,
             self.external_messages,
             self.context_messages,
             self.prediction_cells,
             self.prediction_columns
         ) = snapshot
 
-        # explicitly copy mutable attributes:
-        self.internal_forward_messages = self.internal_forward_messages.copy()
+        # explicitly copy mutable attributes in place,
+        # so the snapshot can be restored again
+        np.copyto(self.internal_forward_messages, internal_forward_messages)
+
+    def planning_copy(self):
+        """
+            Copy for prediction and observation without learning on another thread.
+            Messages, buffers and RNG are copied, learned factors are shared
+            and must not change while the copy is in use.
+        """
+        layer = copy(self)
+
+        layer.internal_forward_messages = self.internal_forward_messages.copy()
+        layer._messages_buffer = np.empty_like(self._messages_buffer)
+        layer._log_messages_buffer = np.empty_like(self._log_messages_buffer)
+        layer._snapshot_buffers = list()
+        layer._rng = deepcopy(self._rng)
+
+        if self.context_factors is not None:
+            layer.context_factors = self.context_factors.planning_copy()
+        if self.internal_factors is not None:
+            layer.internal_factors = self.internal_factors.planning_copy()
+
+        return layer
+
+    def save(self, path):
+        """
+            Save the layer with its factors and RNG states to the directory.
+        """
+        save_object(
+            self, path,
+            children=('context_factors', 'internal_factors'),
+            skip=('_snapshot_buffers', )
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """
+            Load the layer saved with save.
+                mmap_mode: segment tables are memory-mapped with this mode,
+                    None loads them into memory
+        """
+        layer = load_object(cls, path, mmap_mode=mmap_mode)
+        layer._snapshot_buffers = list()
+        return layer
+
+    def release_snapshot(self, snapshot):
+        """
+            Return buffers of a snapshot that won't be restored anymore
+            to the pool of snapshot buffers.
+        """
+        if snapshot is None:
+            return
+
+        self._snapshot_buffers.append(snapshot[0])
 
     def reset(self):
         self.internal_forward_messages = np.zeros(
             self.internal_cells,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
         self.external_messages = np.zeros(
             self.external_input_size,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
         self.context_messages = np.zeros(
             self.context_input_size,
-            dtype=REAL64_DTYPE
+            dtype=self.dtype
         )
 
         self.context_active_cells.sparse = []
@@ -480,7 +915,8 @@ class Layer:
         # block internal messages
         # think about it as thalamus orchestration of the neocortex
         if include_context_connections and self.enable_context_connections:
-            messages = np.zeros(self.total_cells)
+            messages = self._messages_buffer
+            messages.fill(0)
             messages[
                 self.context_cells_range[0]:
                 self.context_cells_range[1]
@@ -502,7 +938,8 @@ class Layer:
         if include_internal_connections and self.enable_internal_connections:
             previous_internal_messages = self.internal_forward_messages.copy()
 
-            messages = np.zeros(self.total_cells)
+            messages = self._messages_buffer
+            messages.fill(0)
 
             messages[
                 self.internal_cells_range[0]:
@@ -533,6 +970,85 @@ class Layer:
             -1, self.n_hidden_vars_per_obs_var, self.n_obs_states
         ).mean(axis=1).flatten()
 
+    def predict_batch(
+            self,
+            context_messages: np.ndarray,
+            external_messages: np.ndarray,
+            include_context_connections=True,
+            include_internal_connections=False
+    ):
+        """
+            Predict cells for a batch of hypotheses (e.g. actions) at once.
+            In contrast to predict, it doesn't change the layer's state.
+                context_messages: (context_input_size,) shared by all hypotheses
+                    or (batch_size, context_input_size)
+                external_messages: (batch_size, external_input_size)
+            returns prediction_cells: (batch_size, internal_cells),
+                prediction_columns: (batch_size, n_columns)
+        """
+        external_messages = np.asarray(external_messages).reshape(
+            (-1, self.external_input_size)
+        )
+        batch_size = external_messages.shape[0]
+
+        internal_messages = np.broadcast_to(
+            self.internal_forward_messages,
+            (batch_size, self.internal_cells)
+        )
+
+        if include_context_connections and self.enable_context_connections:
+            messages = np.zeros((batch_size, self.total_cells), dtype=self.dtype)
+            messages[
+                :,
+                self.context_cells_range[0]:
+                self.context_cells_range[1]
+            ] = context_messages
+
+            messages[
+                :,
+                self.external_cells_range[0]:
+                self.external_cells_range[1]
+            ] = external_messages
+
+            internal_messages = self._propagate_belief_batch(
+                messages,
+                self.context_factors,
+                self.inverse_temp_context
+            )
+
+        if include_internal_connections and self.enable_internal_connections:
+            messages = np.zeros((batch_size, self.total_cells), dtype=self.dtype)
+            messages[
+                :,
+                self.internal_cells_range[0]:
+                self.internal_cells_range[1]
+            ] = internal_messages
+
+            next_internal_messages = self._propagate_belief_batch(
+                messages,
+                self.internal_factors,
+                self.inverse_temp_internal
+            )
+
+            # consolidate previous and new messages
+            internal_messages = normalize(
+                (next_internal_messages * internal_messages).reshape(
+                    (-1, self.n_hidden_states)
+                )
+            ).reshape((batch_size, -1))
+
+        prediction_cells = np.array(internal_messages)
+
+        prediction_columns = prediction_cells.reshape(
+            (batch_size, -1, self.cells_per_column)
+        ).sum(axis=-1)
+
+        prediction_columns = prediction_columns.reshape(
+            (batch_size, -1, self.n_hidden_vars_per_obs_var, self.n_obs_states)
+        ).mean(axis=2).reshape((batch_size, -1))
+
+        return prediction_cells, prediction_columns
+
     def observe(
             self,
             observation: np.ndarray,
@@ -669,27 +1185,52 @@ class Layer:
             messages: should be an array of size total_cells
         """
         # filter dendrites that have low activation likelihood
-        active_cells = SDR(self.total_cells)
-
-        active_cells.sparse = np.flatnonzero(
-            messages >= self.cell_activation_threshold
+        active_segments = factors.get_active_segments(
+            np.flatnonzero(messages >= self.cell_activation_threshold),
+            channel='predict'
         )
+        cells_for_active_segments = factors.connections.mapSegmentsToCells(active_segments)
 
-        num_connected_segment = factors.connections.computeActivity(
-            active_cells,
-            False
-        )
+        if self.backend == 'numba':
+            next_messages = kernels.propagate_belief(
+                messages,
+                active_segments,
+                cells_for_active_segments,
+                factors.factor_for_segment[active_segments],
+                factors.receptive_fields,
+                factors.synapse_efficiency,
+                factors.log_factor_values_per_segment,
+                self.n_hidden_vars,
+                self.n_hidden_states,
+                inverse_temperature,
+                factors.eps
+            ).astype(self.dtype)
+        else:
+            next_messages = self._segments_to_messages(
+                messages,
+                active_segments,
+                cells_for_active_segments,
+                factors,
+                inverse_temperature
+            )
 
-        active_segments = np.flatnonzero(
-            num_connected_segment >= factors.n_vars_per_factor
-        )
-        cells_for_active_segments = factors.connections.mapSegmentsToCells(active_segments)
+        assert ~np.any(np.isnan(next_messages))
 
-        log_next_messages = np.full(
-            self.internal_cells,
-            fill_value=-np.inf,
-            dtype=REAL_DTYPE
-        )
+        self.internal_forward_messages = next_messages
+
+    def _segments_to_messages(
+            self,
+            messages: np.ndarray,
+            active_segments: np.ndarray,
+            cells_for_active_segments: np.ndarray,
+            factors: Factors,
+            inverse_temperature=1.0,
+    ):
+        """
+        Calculate messages for internal cells from active segments with NumPy.
+        """
+        log_next_messages = self._log_messages_buffer
+        log_next_messages.fill(-np.inf)
 
         # excitation activity
         if len(active_segments) > 0:
@@ -763,9 +1304,150 @@ class Layer:
 
         next_messages = next_messages.flatten()
 
+        return next_messages
+
+    def _propagate_belief_batch(
+            self,
+            messages: np.ndarray,
+            factors: Factors,
+            inverse_temperature=1.0,
+    ):
+        """
+        Batched version of _propagate_belief that doesn't change the layer's state.
+            messages: should be an array of shape (batch_size, total_cells)
+            returns next messages for internal cells: (batch_size, internal_cells)
+        """
+        batch_size = messages.shape[0]
+
+        # segments that might be active for at least one hypothesis
+        candidate_segments = factors.get_active_segments(
+            np.flatnonzero(np.any(messages >= self.cell_activation_threshold, axis=0)),
+            channel='predict_batch'
+        )
+
+        log_next_messages = np.full(
+            (batch_size, self.internal_cells),
+            fill_value=-np.inf,
+            dtype=self.dtype
+        )
+
+        if len(candidate_segments) > 0:
+            cells_for_segments = factors.connections.mapSegmentsToCells(candidate_segments)
+            factors_for_segments = factors.factor_for_segment[candidate_segments]
+            log_factor_value = factors.log_factor_values_per_segment[candidate_segments]
+            receptive_fields = factors.receptive_fields[candidate_segments]
+
+            # segments that see only cells with the same messages across the batch
+            # are evaluated once and shared by all hypotheses
+            varying_cells = np.any(messages != messages[:1], axis=0)
+            is_varying = np.any(varying_cells[receptive_fields], axis=-1)
+            shared = ~is_varying
+
+            is_active = np.empty((batch_size, len(candidate_segments)), dtype=bool)
+            log_likelihood = np.empty((batch_size, len(candidate_segments)))
+
+            is_active[:, shared] = np.all(
+                messages[0, receptive_fields[shared]] >= self.cell_activation_threshold,
+                axis=-1
+            )
+            is_active[:, is_varying] = np.all(
+                messages[:, receptive_fields[is_varying]] >= self.cell_activation_threshold,
+                axis=-1
+            )
+
+            # likelihood of non-active segments is discarded anyway
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_likelihood[:, shared] = factors.calculate_segment_likelihood(
+                    messages[0],
+                    candidate_segments[shared]
+                )
+                log_likelihood[:, is_varying] = factors.calculate_segment_likelihood(
+                    messages,
+                    candidate_segments[is_varying]
+                )
+
+            log_excitation_per_segment = np.where(
+                is_active,
+                log_likelihood + log_factor_value,
+                -np.inf
+            )
+
+            # uniquely encode pairs (factor, cell) for each segment
+            cell_factor_id_per_segment = (
+                    factors_for_segments * self.total_cells
+                    + cells_for_segments
+            )
+
+            # group segments by factors
+            sorting_inxs = np.argsort(cell_factor_id_per_segment)
+            cells_for_segments = cells_for_segments[sorting_inxs]
+            cell_factor_id_per_segment = cell_factor_id_per_segment[sorting_inxs]
+            log_excitation_per_segment = log_excitation_per_segment[:, sorting_inxs]
+
+            cell_factor_id_excitation, reduce_inxs = np.unique(
+                cell_factor_id_per_segment, return_index=True
+            )
+
+            # approximate log sum with max
+            log_excitation_per_factor = np.maximum.reduceat(
+                log_excitation_per_segment, reduce_inxs, axis=1
+            )
+
+            # group segments by cells
+            cells_for_factors = cells_for_segments[reduce_inxs]
+
+            sort_inxs = np.argsort(cells_for_factors)
+            cells_for_factors = cells_for_factors[sort_inxs]
+            log_excitation_per_factor = log_excitation_per_factor[:, sort_inxs]
+
+            cells_with_factors, reduce_inxs = np.unique(cells_for_factors, return_index=True)
+
+            # factors without active segments for a hypothesis are skipped
+            is_factor_active = np.isfinite(log_excitation_per_factor)
+
+            log_prediction_for_cells_with_factors = np.add.reduceat(
+                np.where(is_factor_active, log_excitation_per_factor, 0),
+                indices=reduce_inxs,
+                axis=1
+            )
+            is_cell_active = np.logical_or.reduceat(
+                is_factor_active,
+                indices=reduce_inxs,
+                axis=1
+            )
+            log_prediction_for_cells_with_factors[~is_cell_active] = -np.inf
+
+            # avoid overflow
+            log_prediction_for_cells_with_factors[
+                log_prediction_for_cells_with_factors < -100
+            ] = -np.inf
+
+            log_next_messages[:, cells_with_factors] = log_prediction_for_cells_with_factors
+
+        log_next_messages = log_next_messages.reshape((-1, self.n_hidden_states))
+
+        # shift log value for stability
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+
+            means = log_next_messages.mean(
+                axis=-1,
+                where=~np.isinf(log_next_messages)
+            ).reshape((-1, 1))
+
+        means[np.isnan(means)] = 0
+
+        log_next_messages -= means
+
+        log_next_messages = inverse_temperature * log_next_messages
+
+        next_messages = normalize(np.exp(log_next_messages))
+
+        next_messages = next_messages.reshape((batch_size, self.internal_cells))
+
         assert ~np.any(np.isnan(next_messages))
 
-        self.internal_forward_messages = next_messages
+        return next_messages
 
     def _learn(
             self,
@@ -840,15 +1522,7 @@ class Layer:
 
     def _calculate_learning_segments(self, active_cells, next_active_cells, factors: Factors):
         # determine which segments are learning and growing
-        active_cells_sdr = SDR(self.total_cells)
-        active_cells_sdr.sparse = active_cells
-
-        num_connected = factors.connections.computeActivity(
-            active_cells_sdr,
-            False
-        )
-
-        active_segments = np.flatnonzero(num_connected >= factors.n_vars_per_factor)
+        active_segments = factors.get_active_segments(active_cells, channel='learn')
 
         cells_for_active_segments = factors.connections.mapSegmentsToCells(active_segments)
 
@@ -929,9 +1603,7 @@ class Layer:
         )
 
     def _filter_cells_by_vars(self, cells, variables):
-        cells_in_vars = self._get_cells_in_vars(variables)
-
-        mask = np.isin(cells, cells_in_vars)
+        mask = np.isin(self.var_for_cell[cells], variables)
 
         return cells[mask]
 
@@ -959,39 +1631,7 @@ class Layer:
         return next_cells.astype(UINT_DTYPE)
 
     def _vars_for_cells(self, cells):
-        internal_cells_mask = (
-                (cells >= self.internal_cells_range[0]) &
-                (cells < self.internal_cells_range[1])
-            )
-        internal_cells = cells[internal_cells_mask]
-
-        context_cells_mask = (
-                (cells >= self.context_cells_range[0]) &
-                (cells < self.context_cells_range[1])
-        )
-        context_cells = cells[context_cells_mask]
-
-        external_cells_mask = (
-                    (cells >= self.external_cells_range[0]) &
-                    (cells < self.external_cells_range[1])
-            )
-        external_cells = cells[external_cells_mask]
-
-        internal_cells_vars = internal_cells // self.n_hidden_states
-        context_cells_vars = (
-            self.n_hidden_vars +
-            (context_cells - self.context_cells_range[0]) // self.n_context_states
-        )
-        external_cells_vars = (
-            self.n_hidden_vars + self.n_hidden_vars +
-            (external_cells - self.external_cells_range[0]) // self.n_external_states
-        )
-
-        vars_ = np.empty_like(cells, dtype=UINT_DTYPE)
-        vars_[internal_cells_mask] = internal_cells_vars
-        vars_[context_cells_mask] = context_cells_vars
-        vars_[external_cells_mask] = external_cells_vars
-        return vars_
+        return self.var_for_cell[cells]
 
     def _grow_new_segments(
             self,
@@ -1003,7 +1643,10 @@ class Layer:
         candidate_vars = np.unique(self._vars_for_cells(growth_candidates))
         # free space for new segments
         n_segments_after_growing = len(factors.segments_in_use) + len(new_segment_cells)
-        if n_segments_after_growing > factors.max_segments:
+        if (
+                factors.max_segments is not None
+                and n_segments_after_growing > factors.max_segments
+        ):
             n_segments_to_prune = n_segments_after_growing - factors.max_segments
             factors.prune_segments(n_segments_to_prune)
 
@@ -1025,6 +1668,16 @@ class Layer:
         factor_score = factor_score[active_factors_mask[factors_with_segments]]
         factors_with_segments = factors_with_segments[active_factors_mask[factors_with_segments]]
 
+        if self.batched_growth:
+            return self._grow_new_segments_batched(
+                new_segment_cells,
+                growth_candidates,
+                candidate_vars,
+                factors_with_segments,
+                factor_score,
+                factors
+            )
+
         new_segments = list()
 
         # each cell corresponds to one variable
@@ -1067,14 +1720,7 @@ class Layer:
                 # exclude self-loop
                 candidate_vars_for_cell = candidate_vars[np.isin(candidate_vars, var, invert=True)]
                 # select cells for a new factor
-                var_score = factors.var_score.copy()
-
-                used_vars, counts = np.unique(
-                    factors.factor_vars[factors.factors_in_use].flatten(),
-                    return_counts=True
-                )
-                # TODO can we make it more static to not compute it in cycle?
-                var_score[used_vars] *= np.exp(-self.unused_vars_boost * counts)
+                var_score = factors.var_score * np.exp(-self.unused_vars_boost * factors.var_usage)
                 var_score[self.n_hidden_vars + self.n_context_vars:] += self.external_vars_boost
 
                 var_score = var_score[candidate_vars_for_cell]
@@ -1092,21 +1738,7 @@ class Layer:
                     replace=False
                 )
 
-                factor_id = factors.factor_connections.createSegment(
-                    var,
-                    maxSegmentsPerCell=factors.max_factors_per_var
-                )
-
-                factors.factor_connections.growSynapses(
-                    factor_id,
-                    variables,
-                    0.6,
-                    self._legacy_rng,
-                    maxNew=factors.n_vars_per_factor
-                )
-
-                factors.factor_vars[factor_id] = variables
-                factors.factors_in_use = np.append(factors.factors_in_use, factor_id)
+                factor_id = factors.add_factor(var, variables, self._legacy_rng)
 
             candidates = self._filter_cells_by_vars(growth_candidates, variables)
 
@@ -1114,24 +1746,125 @@ class Layer:
             if len(candidates) < factors.n_vars_per_factor:
                 continue
 
-            new_segment = factors.connections.createSegment(cell, factors.max_segments_per_cell)
-
-            factors.connections.growSynapses(
-                new_segment,
+            new_segment = factors.add_segment(
+                cell,
+                factor_id,
                 candidates,
-                0.6,
-                self._legacy_rng,
-                maxNew=factors.n_vars_per_factor
+                self._legacy_rng
             )
 
-            factors.factor_for_segment[new_segment] = factor_id
-            factors.log_factor_values_per_segment[new_segment] = factors.initial_log_factor_value
-            factors.receptive_fields[new_segment] = candidates
-
             new_segments.append(new_segment)
 
         return np.array(new_segments, dtype=UINT_DTYPE)
 
+    def _grow_new_segments_batched(
+            self,
+            new_segment_cells,
+            growth_candidates,
+            candidate_vars,
+            factors_with_segments,
+            factor_score,
+            factors: Factors
+    ):
+        """
+            Vectorized version of the segment growth loop. Factors and
+            variables of new factors are sampled for all cells at once
+            with the Gumbel-max trick, var usage is taken before growing.
+        """
+        n_segments = factors.connections.getSegmentCounts(new_segment_cells)
+        cells = new_segment_cells[n_segments < factors.max_segments_per_cell]
+
+        if len(cells) == 0:
+            return np.empty(0, dtype=UINT_DTYPE)
+
+        cell_vars = self.var_for_cell[cells]
+
+        # factors with scores for every hidden var, empty slots stand for new factors
+        factor_slots = np.full(
+            (self.n_hidden_vars, factors.max_factors_per_var),
+            fill_value=-1,
+            dtype=INT_TYPE
+        )
+        slot_scores = np.zeros((self.n_hidden_vars, factors.max_factors_per_var))
+
+        if len(factors_with_segments) > 0:
+            vars_for_factors = factors.var_for_factor[factors_with_segments]
+            sort_inxs = np.argsort(vars_for_factors, kind='stable')
+            vars_for_factors = vars_for_factors[sort_inxs]
+
+            _, starts, counts = np.unique(
+                vars_for_factors,
+                return_index=True,
+                return_counts=True
+            )
+            slots = np.arange(len(vars_for_factors)) - np.repeat(starts, counts)
+
+            factor_slots[vars_for_factors, slots] = factors_with_segments[sort_inxs]
+            slot_scores[vars_for_factors, slots] = factor_score[sort_inxs]
+
+        # sample factors from softmax of their scores
+        slot_keys = slot_scores[cell_vars] + self._rng.gumbel(size=(len(cells), factors.max_factors_per_var))
+        factor_ids = factor_slots[cell_vars, np.argmax(slot_keys, axis=-1)]
+
+        new_factor_cells = np.flatnonzero(factor_ids == -1)
+
+        if len(new_factor_cells) > 0:
+            var_score = factors.var_score * np.exp(-self.unused_vars_boost * factors.var_usage)
+            var_score[self.n_hidden_vars + self.n_context_vars:] += self.external_vars_boost
+
+            var_logits = np.full(self.total_vars, fill_value=-np.inf)
+            var_logits[candidate_vars] = var_score[candidate_vars]
+
+            var_keys = np.tile(var_logits, (len(new_factor_cells), 1))
+            # exclude self-loop
+            var_keys[np.arange(len(new_factor_cells)), cell_vars[new_factor_cells]] = -np.inf
+            var_keys += self._rng.gumbel(size=var_keys.shape)
+
+            # sampling without replacement from softmax of var scores
+            sampled_vars = np.argsort(-var_keys, axis=-1)[:, :factors.n_vars_per_factor]
+            is_sampled = np.isfinite(
+                np.take_along_axis(var_keys, sampled_vars, axis=-1)
+            )
+
+            for cell_id, variables, mask in zip(new_factor_cells, sampled_vars, is_sampled):
+                # sample size can't be bigger than number of variables
+                if not np.any(mask):
+                    continue
+
+                factor_ids[cell_id] = factors.add_factor(
+                    cell_vars[cell_id],
+                    variables[mask],
+                    self._legacy_rng
+                )
+
+        has_factor = factor_ids != -1
+        cells = cells[has_factor]
+        factor_ids = factor_ids[has_factor]
+
+        # receptive fields from growth candidates within factor variables
+        candidates_mask = np.any(
+            self.var_for_cell[growth_candidates].reshape((1, -1, 1)) ==
+            factors.factor_vars[factor_ids].reshape((len(factor_ids), 1, -1)),
+            axis=-1
+        )
+
+        # don't create a segment that will never activate
+        can_grow = np.count_nonzero(candidates_mask, axis=-1) >= factors.n_vars_per_factor
+
+        new_segments = [
+            factors.add_segment(
+                cell,
+                factor_id,
+                growth_candidates[mask],
+                self._legacy_rng
+            )
+            for cell, factor_id, mask in zip(
+                cells[can_grow], factor_ids[can_grow], candidates_mask[can_grow]
+            )
+        ]
+
+        return np.array(new_segments, dtype=UINT_DTYPE)
+
     @staticmethod
     def draw_messages(
             messages,
@@ -0,0 +1,354 @@
+#  Copyright (c) 2023 Autonomous Non-Profit Organization "Artificial Intelligence Research
+#  Institute" (AIRI); Moscow Institute of Physics and Technology (National Research University).
+#  All rights reserved.
+#
+#  Licensed under the AGPLv3 license. See LICENSE in the project root for license information.
+
+from unittest import TestCase, mock
+from tempfile import TemporaryDirectory
+from hima.modules.belief.cortial_column.layer import Layer, Factors
+from htm.bindings.sdr import SDR
+from htm.bindings.math import Random
+import yaml
+import numpy as np
+
+
+class TestLayer(TestCase):
+    def setUp(self) -> None:
+        with open('configs/layer_default.yaml', 'r') as file:
+            self.config = yaml.load(file, Loader=yaml.Loader)
+
+        self.layer = Layer(
+            **self.config
+        )
+        self._rng = np.random.default_rng(self.config['seed'])
+
+    def _initial_context(self):
+        context = np.zeros(self.layer.context_input_size)
+        context[np.arange(self.layer.n_hidden_vars) * self.layer.n_hidden_states] = 1
+        return context
+
+    def _step(self, learn=True):
+        external_messages = np.zeros(self.layer.external_input_size)
+        external_messages[self._rng.integers(self.layer.external_input_size)] = 1
+
+        self.layer.set_external_messages(external_messages)
+        self.layer.predict()
+        self.layer.observe(
+            np.array([self._rng.integers(self.layer.n_obs_states)]),
+            learn=learn
+        )
+        self.layer.set_context_messages(self.layer.internal_forward_messages)
+
+    def _predict_with_backend(self, backend):
+        snapshot = self.layer.make_state_snapshot()
+
+        self.layer.backend = backend
+        self.layer.predict()
+        prediction = self.layer.prediction_cells.copy()
+
+        self.layer.restore_last_snapshot(snapshot)
+        return prediction
+
+    def test_numba_backend(self):
+        self.layer.reset()
+        self.layer.set_context_messages(self._initial_context())
+
+        for _ in range(200):
+            self.layer.set_external_messages(
+                self.layer._rng.dirichlet(np.ones(self.layer.external_input_size))
+            )
+
+            numpy_prediction = self._predict_with_backend('numpy')
+            numba_prediction = self._predict_with_backend('numba')
+
+            self.assertTrue(np.allclose(numpy_prediction, numba_prediction, atol=1e-6))
+
+            self.layer.backend = 'numpy'
+            self._step()
+
+    def test_predict_batch(self):
+        self.layer.reset()
+        self.layer.set_context_messages(self._initial_context())
+
+        for _ in range(200):
+            self._step()
+
+        n_actions = self.layer.external_input_size
+        contexts = list()
+        for _ in range(n_actions):
+            self._step(learn=False)
+            contexts.append(self.layer.context_messages.copy())
+
+        # a shared context and a context per row
+        for context_messages in (contexts[-1], np.array(contexts)):
+            batch_cells, batch_columns = self.layer.predict_batch(
+                context_messages, np.eye(n_actions)
+            )
+
+            for action in range(n_actions):
+                snapshot = self.layer.make_state_snapshot()
+
+                self.layer.set_context_messages(
+                    context_messages if context_messages.ndim == 1 else context_messages[action]
+                )
+                self.layer.set_external_messages(np.eye(n_actions)[action])
+                self.layer.predict()
+
+                self.assertTrue(np.allclose(batch_cells[action], self.layer.prediction_cells))
+                self.assertTrue(
+                    np.allclose(batch_columns[action], self.layer.prediction_columns)
+                )
+
+                self.layer.restore_last_snapshot(snapshot)
+
+    def test_float32_drift(self):
+        predictions = dict()
+
+        for dtype in ('float64', 'float32'):
+            self.layer = Layer(
+                **dict(self.config, dtype=dtype)
+            )
+            self._rng = np.random.default_rng(self.config['seed'])
+
+            self.layer.reset()
+            self.layer.set_context_messages(self._initial_context())
+
+            predictions[dtype] = list()
+            for _ in range(300):
+                self._step()
+                predictions[dtype].append(self.layer.prediction_columns.copy())
+
+            self.assertEqual(self.layer.prediction_columns.dtype, np.dtype(dtype))
+            self.assertEqual(self.layer.internal_forward_messages.dtype, np.dtype(dtype))
+            self.assertEqual(self.layer.context_factors.synapse_efficiency.dtype, np.dtype(dtype))
+
+        drift = np.abs(
+            np.array(predictions['float64']) - np.array(predictions['float32'])
+        ).max()
+
+        self.assertLess(drift, 1e-4)
+
+    def test_save_load(self):
+        self.layer.reset()
+        self.layer.set_context_messages(self._initial_context())
+
+        for _ in range(100):
+            self._step()
+
+        with TemporaryDirectory() as path:
+            self.layer.save(path)
+            layers = dict(saved=self.layer, loaded=Layer.load(path, mmap_mode=None))
+
+        predictions = dict()
+        for name, layer in layers.items():
+            self.layer = layer
+            self._rng = np.random.default_rng(self.config['seed'])
+
+            predictions[name] = list()
+            for _ in range(100):
+                self._step()
+                predictions[name].append(self.layer.prediction_columns.copy())
+
+        self.assertTrue(np.array_equal(predictions['saved'], predictions['loaded']))
+
+    def test_factor_score(self):
+        self.layer.reset()
+        self.layer.set_context_messages(self._initial_context())
+
+        for _ in range(300):
+            self._step()
+
+        factors = self.layer.context_factors
+        factors.update_factor_score()
+
+        segments = factors.segments_in_use
+        activity = factors.segment_activity[segments] * factors.activity_scale
+        score = np.exp(factors.log_factor_values_per_segment[segments]) * activity
+        factor_for_segment = factors.factor_for_segment[segments]
+
+        expected = np.array([
+            score[factor_for_segment == factor].mean() for factor in factors.factors_in_use
+        ])
+
+        self.assertTrue(np.allclose(factors.factor_score, expected))
+
+        n_segments = len(segments) // 10
+        pruned = factors.prune_segments(n_segments)
+        self.assertEqual(len(pruned), n_segments)
+        self.assertLessEqual(score[np.isin(segments, pruned)].max(), np.sort(score)[n_segments])
+
+    def test_segment_activity(self):
+        # few segments, so they are pruned and their ids are reused
+        self.config['context_factors_conf']['max_segments'] = 50
+        self.layer = Layer(**self.config)
+
+        get_active_segments = Factors.get_active_segments
+        add_segment = Factors.add_segment
+        created_segments = list()
+        n_checks = 0
+
+        def checked_get_active_segments(factors, active_cells, channel='default'):
+            nonlocal n_checks
+            active_segments = get_active_segments(factors, active_cells, channel)
+
+            sdr = SDR(factors.n_cells)
+            sdr.sparse = np.unique(active_cells)
+            n_active_synapses = np.asarray(factors.connections.computeActivity(sdr, False))
+            expected = np.flatnonzero(n_active_synapses >= factors.n_vars_per_factor)
+
+            self.assertTrue(np.array_equal(np.sort(active_segments), expected), channel)
+            n_checks += 1
+            return active_segments
+
+        def recorded_add_segment(factors, *args, **kwargs):
+            segment = add_segment(factors, *args, **kwargs)
+            created_segments.append(segment)
+            return segment
+
+        with mock.patch.object(Factors, 'get_active_segments', checked_get_active_segments), \
+                mock.patch.object(Factors, 'add_segment', recorded_add_segment):
+            self.layer.reset()
+            self.layer.set_context_messages(self._initial_context())
+
+            for _ in range(300):
+                self._step()
+
+        self.assertGreater(n_checks, 0)
+        # some segments were destroyed and their ids were given to new segments
+        self.assertLess(len(set(created_segments)), len(created_segments))
+
+
+    def test_batched_growth(self):
+        conf = self.config['context_factors_conf']
+        # small limits, so that growth runs into them
+        conf['max_segments_per_cell'] = 3
+        conf['max_factors_per_var'] = 2
+        self.layer = Layer(**dict(self.config, batched_growth=True))
+        factors = self.layer.context_factors
+
+        self.layer.reset()
+        self.layer.set_context_messages(self._initial_context())
+
+        for step in range(300):
+            self._step()
+
+            if step % 25 != 0:
+                continue
+
+            segments_in_use = set(factors.segments_in_use)
+            segments_on_cells = [
+                set(factors.connections.segmentsForCell(cell)) for cell in range(factors.n_cells)
+            ]
+            self.assertEqual(set().union(*segments_on_cells), segments_in_use)
+            self.assertLessEqual(max(map(len, segments_on_cells)), conf['max_segments_per_cell'])
+
+            for cell in range(factors.n_cells):
+                sdr = SDR(factors.n_cells)
+                sdr.sparse = [cell]
+                n_active_synapses = np.asarray(factors.connections.computeActivity(sdr, False))
+                self.assertEqual(
+                    factors.segments_for_cell[cell], set(np.flatnonzero(n_active_synapses > 0))
+                )
+                self.assertLessEqual(factors.segments_for_cell[cell], segments_in_use)
+
+            receptive_fields = factors.receptive_fields[factors.segments_in_use]
+            for receptive_field in self.layer.var_for_cell[receptive_fields]:
+                self.assertEqual(len(np.unique(receptive_field)), factors.n_vars_per_factor)
+
+            var_for_factor = factors.var_for_factor[factors.factors_in_use]
+            for var in range(factors.n_vars):
+                factors_for_var = set(factors.factor_connections.segmentsForCell(var))
+                self.assertEqual(
+                    factors_for_var, set(factors.factors_in_use[var_for_factor == var])
+                )
+                self.assertLessEqual(len(factors_for_var), conf['max_factors_per_var'])
+
+            self.assertTrue(np.array_equal(
+                factors.var_usage,
+                np.bincount(
+                    factors.factor_vars[factors.factors_in_use].flatten(),
+                    minlength=factors.n_vars
+                )
+            ))
+
+        self.assertGreater(len(factors.segments_in_use), 0)
+
+class TestFactors(TestCase):
+    def setUp(self) -> None:
+        # two hidden vars (cells 0-3) with factors over two context vars (cells 4-7)
+        self.factors = Factors(
+            n_cells=8,
+            n_vars=4,
+            n_hidden_states=2,
+            n_hidden_vars=2,
+            n_vars_per_factor=2,
+            max_factors_per_var=1,
+            factor_lr=0.1,
+            synapse_lr=0.1,
+            segment_activity_lr=0.01,
+            var_score_lr=0.01,
+            initial_log_factor_value=0,
+            initial_synapse_value=0.5,
+            max_segments=4,
+            fraction_of_segments_to_prune=0.1,
+            max_segments_per_cell=8
+        )
+        self._rng = np.random.default_rng(0)
+        self._htm_rng = Random(0)
+
+    def test_capacity_growth(self):
+        factors = self.factors
+        initial_capacity = factors.segments_capacity
+        factor_for_var = [
+            factors.add_factor(var, np.array([2, 3]), self._htm_rng) for var in range(2)
+        ]
+        # the tracker has to grow its storage too
+        factors.get_active_segments(np.arange(4, 8))
+
+        segments_on_cell = [set() for _ in range(factors.n_cells)]
+        segments_from_cell = [set() for _ in range(factors.n_cells)]
+
+        for i in range(24):
+            cell = i % 4
+            presynaptic_cells = np.array([4, 6]) + self._rng.integers(2, size=2)
+            before = {name: getattr(factors, name).copy() for name in Factors.SEGMENT_ARRAYS}
+
+            segment = factors.add_segment(
+                cell, factor_for_var[cell // 2], presynaptic_cells, self._htm_rng
+            )
+            # distinctive values to check that they survive the growth
+            factors.log_factor_values_per_segment[segment] = -i
+            factors.synapse_efficiency[segment] = i / 24
+            factors.segment_activity[segment] = i + 1
+
+            segments_on_cell[cell].add(segment)
+            for presynaptic_cell in presynaptic_cells:
+                segments_from_cell[presynaptic_cell].add(segment)
+
+            for name, values in before.items():
+                old_segments = np.arange(len(values)) != segment
+                self.assertTrue(
+                    np.array_equal(getattr(factors, name)[:len(values)][old_segments],
+                                   values[old_segments]),
+                    name
+                )
+                self.assertEqual(getattr(factors, name).dtype, values.dtype)
+
+        self.assertGreaterEqual(factors.segments_capacity, 4 * initial_capacity)
+
+        for cell in range(factors.n_cells):
+            self.assertEqual(set(factors.connections.segmentsForCell(cell)), segments_on_cell[cell])
+            self.assertEqual(factors.segments_for_cell[cell], segments_from_cell[cell])
+
+            sdr = SDR(factors.n_cells)
+            sdr.sparse = [cell]
+            n_active_synapses = np.asarray(factors.connections.computeActivity(sdr, False))
+            self.assertEqual(
+                set(np.flatnonzero(n_active_synapses > 0)), segments_from_cell[cell]
+            )
+
+        self.assertTrue(np.array_equal(
+            factors.get_active_segments(np.arange(4, 8)),
+            np.sort(np.fromiter(set().union(*segments_on_cell), dtype=int))
+        ))